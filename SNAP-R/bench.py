@@ -0,0 +1,277 @@
+#!/opt/homebrew/bin/uv run --script
+# /// script
+# requires-python = ">=3.13"
+# dependencies = [
+#     "typer",
+#     "requests",
+#     "urllib3",
+#     "numpy",
+# ]
+# ///
+
+"""
+Throughput benchmarks for query.py against mock_server.py.
+
+Each scenario starts a mock server, runs one query.py command against it in
+a scratch directory and reports records/s, server-side latency, peak RSS of
+the crawler and the requests it wasted on 401s, 429s, errors and repeats.
+Results can be saved and compared with an earlier run to spot regressions.
+"""
+
+import csv
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import typer
+
+from mock_server import MockState, start_server, TOKEN_PATH, WORK_ITEM_PATH
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger(__name__)
+
+# Create the Typer app
+app = typer.Typer(help="SNAPR crawler benchmarks")
+
+# Constants
+QUERY_SCRIPT = Path(__file__).resolve().parent / "query.py"
+TOP_ACN = "Z1865690"
+DEFAULT_COUNT = 2000
+DEFAULT_LATENCY = "lognormal:50,0.4"
+DEFAULT_THRESHOLD = 0.10  # relative change reported as a regression
+UNLIMITED_RATE = "1000"  # --rate for runs that should only be limited by the server
+
+# Each scenario: mock server settings and the query.py arguments to run
+SCENARIOS: Dict[str, Dict] = {
+    "sequential": {
+        "mock": {},
+        "args": ["query", "-w", "1", "--rate", UNLIMITED_RATE],
+    },
+    "concurrent": {
+        "mock": {},
+        "args": ["query", "-w", "8", "--rate", UNLIMITED_RATE],
+    },
+    "faults": {
+        "mock": {"gap_rate": 0.01, "error_rate": 0.02, "token_ttl": 10.0, "rate_limit": 150.0},
+        "args": ["query", "-w", "8", "--rate", UNLIMITED_RATE],
+    },
+    "store": {
+        "mock": {},
+        "args": ["query", "-w", "8", "--rate", UNLIMITED_RATE, "--store", "sqlite:results.db"],
+    },
+    "sharded": {
+        "mock": {},
+        "args": ["crawl", "--from", "{top}", "--to", "{bottom}", "-n", "4", "-w", "4", "--rate", UNLIMITED_RATE],
+    },
+}
+
+# Metrics compared between runs; True if higher is better
+METRICS = {
+    "records_per_s": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "peak_rss_mb": False,
+    "wasted_requests": False,
+}
+
+def git_revision() -> str:
+    """Describe the checked-out revision of query.py, or "unknown"."""
+    try:
+        result = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=QUERY_SCRIPT.parent, capture_output=True, text=True, timeout=10,
+        )
+        return result.stdout.strip() or "unknown"
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+
+def write_token_config(work_dir: Path, token_url: str) -> None:
+    """Give the scratch directory a token configuration that refreshes against the mock."""
+    config = {"curl_command": [
+        "curl", token_url,
+        "-H", "Content-Type: application/x-www-form-urlencoded",
+        "--data-raw", "grant_type=refresh_token&refresh_token=mock-refresh-0&client_id=bench",
+    ]}
+    with open(work_dir / "snapr_config.json", 'w') as f:
+        json.dump(config, f, indent=2)
+
+def count_records(work_dir: Path) -> int:
+    """Count the records a run saved to its CSV output or store."""
+    for name in ("output.csv", "crawl.csv"):
+        path = work_dir / name
+        if path.exists():
+            with open(path, 'r', newline='') as f:
+                return sum(1 for _ in csv.DictReader(f))
+    db_path = work_dir / "results.db"
+    if db_path.exists():
+        import sqlite3
+        with sqlite3.connect(db_path) as conn:
+            return conn.execute("SELECT COUNT(*) FROM work_items").fetchone()[0]
+    return 0
+
+def run_scenario(name: str, count: int, latency: str, timeout: float) -> Dict:
+    """
+    Run one scenario against a fresh mock server.
+    
+    Args:
+        name: The scenario in SCENARIOS
+        count: How many ACNs the mock serves
+        latency: The mock's latency distribution
+        timeout: Seconds before the run is killed
+    
+    Returns:
+        The measurements of the run
+    """
+    scenario = SCENARIOS[name]
+    state = MockState(top=TOP_ACN, count=count, latency=latency, **scenario["mock"])
+    server = start_server(state)
+    base = f"http://127.0.0.1:{server.server_port}"
+    env = dict(os.environ, SNAPR_BASE_URL=f"{base}{WORK_ITEM_PATH.rstrip('/')}", SNAPR_TOKEN_URL=f"{base}{TOKEN_PATH}")
+    env.pop("SNAPR_TOKEN_BROKER", None)
+    args = [arg.format(top=TOP_ACN, bottom=f"{state.prefix}{state.bottom}") for arg in scenario["args"]]
+    if args[0] == "query":
+        args += ["--start-acn", TOP_ACN]
+    
+    try:
+        with tempfile.TemporaryDirectory(prefix=f"snapr-bench-{name}-") as work_dir:
+            work_dir = Path(work_dir)
+            write_token_config(work_dir, env["SNAPR_TOKEN_URL"])
+            with open(work_dir / "run.log", 'w') as log:
+                started = time.monotonic()
+                process = subprocess.Popen([sys.executable, str(QUERY_SCRIPT)] + args, cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+                # Reap the child with wait4, which reports the peak RSS of this child alone
+                while True:
+                    pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+                    if pid:
+                        break
+                    if time.monotonic() - started > timeout:
+                        logger.error(f"{name}: still running after {timeout:.0f}s, killing it")
+                        process.kill()
+                        _, status, usage = os.wait4(process.pid, 0)
+                        break
+                    time.sleep(0.1)
+                elapsed = time.monotonic() - started
+                process.returncode = os.waitstatus_to_exitcode(status)
+            records = count_records(work_dir)
+            if process.returncode != 0:
+                logger.warning(f"{name}: exited with {process.returncode}; last lines of its log:\n"
+                               + "".join((work_dir / "run.log").read_text().splitlines(True)[-5:]))
+    finally:
+        server.shutdown()
+        server.server_close()
+    
+    stats = state.stats()
+    return {
+        "scenario": name,
+        "records": records,
+        "seconds": round(elapsed, 2),
+        "records_per_s": round(records / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": stats["latency_ms"]["p50"],
+        "p99_ms": stats["latency_ms"]["p99"],
+        # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+        "peak_rss_mb": round(usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+        "requests": stats["requests"],
+        "wasted_requests": stats["wasted_requests"],
+        "by_status": stats["by_status"],
+        "token_requests": stats["token_requests"],
+    }
+
+def format_report(results: List[Dict], baseline: Optional[Dict[str, Dict]] = None, threshold: float = DEFAULT_THRESHOLD) -> str:
+    """
+    Format results as a table, with the change against a baseline if given.
+    
+    Args:
+        results: Measurements from run_scenario
+        baseline: Earlier measurements keyed by scenario
+        threshold: Relative change flagged as a regression
+    
+    Returns:
+        The table
+    """
+    columns = ["scenario", "records", "seconds", "records_per_s", "p50_ms", "p99_ms", "peak_rss_mb", "requests", "wasted_requests"]
+    rows = [columns]
+    for result in results:
+        row = [str(result.get(column)) for column in columns]
+        previous = (baseline or {}).get(result["scenario"])
+        if previous:
+            for metric, higher_is_better in METRICS.items():
+                old, new = previous.get(metric), result.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                flag = " !" if (change < -threshold if higher_is_better else change > threshold) else ""
+                row[columns.index(metric)] += f" ({change:+.0%}{flag})"
+        rows.append(row)
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows)
+
+def load_history(path: Path) -> List[Dict]:
+    """Load saved benchmark runs, oldest first."""
+    if not path.exists():
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)
+
+@app.command()
+def run(
+    scenarios: List[str] = typer.Option(None, "--scenario", "-s", help=f"Scenarios to run (default: all of {', '.join(SCENARIOS)})"),
+    count: int = typer.Option(DEFAULT_COUNT, "--count", "-n", min=1, help="ACNs served by the mock"),
+    latency: str = typer.Option(DEFAULT_LATENCY, "--latency", help="Mock response time distribution in ms, e.g. lognormal:50,0.4"),
+    timeout: float = typer.Option(600.0, "--timeout", help="Seconds before a run is killed"),
+    save: Path = typer.Option(None, "--save", help="Append the results to this JSON history file"),
+    compare: Path = typer.Option(None, "--compare", help="Compare with the latest run of another revision in this history file"),
+    threshold: float = typer.Option(DEFAULT_THRESHOLD, "--threshold", help="Relative change flagged with ! as a regression"),
+    label: str = typer.Option(None, "--label", help="Name of this run in the history (default: git describe)"),
+):
+    """
+    Run benchmark scenarios and print a report.
+    
+    Examples:
+        ./bench.py                                   # All scenarios, 2000 ACNs each
+        ./bench.py -s concurrent -s sharded -n 5000
+        ./bench.py --save bench.json                 # Record a baseline
+        ./bench.py --compare bench.json              # Show changes against it; ! marks regressions
+    """
+    scenarios = scenarios or list(SCENARIOS)
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        raise typer.BadParameter(f"Unknown scenario(s) {', '.join(unknown)}; choose from {', '.join(SCENARIOS)}")
+    label = label or git_revision()
+    
+    baseline = None
+    if compare:
+        previous = [entry for entry in load_history(compare) if entry["label"] != label]
+        if previous:
+            baseline = {result["scenario"]: result for result in previous[-1]["results"]}
+            logger.info(f"Comparing with {previous[-1]['label']} from {time.strftime('%Y-%m-%d %H:%M', time.localtime(previous[-1]['timestamp']))}")
+        else:
+            logger.warning(f"No run of another revision in {compare} to compare with")
+    
+    results = []
+    for name in scenarios:
+        logger.info(f"Running {name} against {count} ACNs...")
+        results.append(run_scenario(name, count, latency, timeout))
+        logger.info(f"{name}: {results[-1]['records']} records in {results[-1]['seconds']}s")
+    
+    typer.echo(format_report(results, baseline, threshold))
+    
+    if save:
+        history = load_history(save)
+        history.append({"label": label, "timestamp": time.time(), "count": count, "latency": latency, "results": results})
+        with open(save, 'w') as f:
+            json.dump(history, f, indent=2)
+        logger.info(f"Saved results as {label} to {save}")
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,431 @@
+#!/opt/homebrew/bin/uv run --script
+# /// script
+# requires-python = ">=3.13"
+# dependencies = [
+#     "typer",
+# ]
+# ///
+
+"""
+Local stand-in for the SNAPR work item and token endpoints.
+
+Serves generated work items for a range of ACNs with configurable latency,
+404 gaps, token expiry, rate limiting and server errors, so query.py can be
+load-tested without touching snapr-service.bis.gov. Point query.py at it with
+
+    SNAPR_BASE_URL=http://127.0.0.1:8780/api/workItems/stela
+    SNAPR_TOKEN_URL=http://127.0.0.1:8780/token
+
+GET /_stats returns request counters and POST /_reset clears them.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import random
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+
+import typer
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[logging.StreamHandler()]
+)
+logger = logging.getLogger(__name__)
+
+# Create the Typer app
+app = typer.Typer(help="Mock SNAPR API server")
+
+# Constants
+DEFAULT_PORT = 8780
+DEFAULT_TOP_ACN = "Z1865690"
+DEFAULT_COUNT = 10000
+DEFAULT_LATENCY = "lognormal:80,0.5"
+WORK_ITEM_PATH = "/api/workItems/stela/"
+TOKEN_PATH = "/token"
+
+DIVISIONS = [
+    "SENSORS AND AVIATION DIVISION",
+    "ELECTRONICS AND MATERIALS DIVISION",
+    "NUCLEAR AND MISSILE TECHNOLOGY CONTROLS DIVISION",
+    "CHEMICAL AND BIOLOGICAL CONTROLS DIVISION",
+    "INFORMATION TECHNOLOGY CONTROLS DIVISION",
+]
+DECISIONS = ["Approved", "Approved w/Conditions", "Returned Without Action", "Rejected"]
+AGENCIES = ["Department of Defense", "Department of State", "Department of Energy"]
+FIRST_REGISTRATION = date(2024, 1, 2)
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    Parse a latency distribution such as "lognormal:80,0.5".
+    
+    Supported forms, all in milliseconds: fixed:MS, uniform:LO,HI,
+    exp:MEAN and lognormal:MEDIAN,SIGMA.
+    
+    Args:
+        spec: The distribution
+    
+    Returns:
+        A function drawing a delay in seconds from a random generator
+    """
+    kind, _, params = spec.partition(":")
+    try:
+        values = [float(value) for value in params.split(",")] if params else []
+    except ValueError:
+        values = []
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0] / 1000
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1]) / 1000
+    if kind == "exp" and len(values) == 1 and values[0] > 0:
+        return lambda rng: rng.expovariate(1 / values[0]) / 1000
+    if kind == "lognormal" and len(values) == 2 and values[0] > 0:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1]) / 1000
+    raise typer.BadParameter(f"Invalid latency '{spec}', expected e.g. fixed:50, uniform:20,200, exp:80 or lognormal:80,0.5")
+
+def fraction(number: int, salt: str) -> float:
+    """Map an ACN number to a stable pseudo-random value in [0, 1)."""
+    digest = hashlib.blake2b(f"{salt}:{number}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2 ** 64
+
+def api_date(day: date) -> str:
+    """Format a date the way the API does (MM/DD/YYYY)."""
+    return day.strftime("%m/%d/%Y")
+
+def make_work_item(prefix: str, number: int, bottom: int, age: float, complete_after: float) -> Dict:
+    """
+    Generate the work item for an ACN.
+    
+    The item only depends on the ACN, so repeated requests return the same
+    record, except that pending items complete once the server has been
+    running for their share of complete_after seconds.
+    
+    Args:
+        prefix: The ACN prefix
+        number: The ACN number
+        bottom: The lowest existing ACN number, registered first
+        age: Seconds since the server started
+        complete_after: Seconds after which every pending item has completed (0 = never)
+    
+    Returns:
+        The work item as returned by the API
+    """
+    rng = random.Random(number)
+    registered = FIRST_REGISTRATION + timedelta(days=(number - bottom) // 40)
+    status_draw = rng.random()
+    completed = status_draw < 0.7 or (complete_after > 0 and age >= complete_after * fraction(number, "complete"))
+    on_hold = not completed and status_draw > 0.95
+    finished = registered + timedelta(days=rng.randint(5, 60))
+    
+    completed_referrals: List[Dict] = []
+    pending_referrals: List[Dict] = []
+    for agency in rng.sample(AGENCIES, rng.randint(0, len(AGENCIES))):
+        referred = registered + timedelta(days=rng.randint(1, 5))
+        if completed or rng.random() < 0.5:
+            closed = min(finished, referred + timedelta(days=rng.randint(0, 20)))
+            completed_referrals.append({"agency": agency, "referralDate": api_date(referred), "closedDate": api_date(closed)})
+        else:
+            pending_referrals.append({"agency": agency, "referralDate": api_date(referred), "closedDate": None})
+    
+    if completed:
+        status = "COMPLETED"
+    elif on_hold:
+        status = f"HOLD WITHOUT ACTION ({api_date(registered + timedelta(days=21))})"
+    else:
+        status = "PENDING"
+    return {
+        "acn": f"{prefix}{number}",
+        "caseNumber": f"D{1390000 + number % 100000}" if rng.random() < 0.6 else None,
+        "completedReferrals": completed_referrals,
+        "completionDate": api_date(finished) if completed else None,
+        "finalDecision": rng.choice(DECISIONS) if completed else None,
+        "pendingReferrals": pending_referrals,
+        "registrationDate": api_date(registered),
+        "renewingDivision": rng.choice(DIVISIONS),
+        "renewingOffice": "OFFICE OF NATIONAL SECURITY AND TECHNOLOGY TRANSFER CONTROLS",
+        "reopenDate": None,
+        "reviewStatus": status,
+        "type": "Export License Application",
+    }
+
+class MockState:
+    """
+    Configuration and counters shared by the request handlers.
+    
+    Server-side faults are decided here: which ACNs exist, which tokens are
+    valid, when requests are rate limited and which requests fail.
+    """
+    
+    def __init__(
+        self,
+        top: str = DEFAULT_TOP_ACN,
+        count: int = DEFAULT_COUNT,
+        gap_rate: float = 0.0,
+        latency: str = DEFAULT_LATENCY,
+        token_ttl: float = 3600.0,
+        rate_limit: float = 0.0,
+        burst_every: float = 0.0,
+        burst_duration: float = 0.0,
+        error_rate: float = 0.0,
+        complete_after: float = 0.0,
+        seed: int = 0,
+    ):
+        self.prefix = top[0]
+        self.top = int(top[1:])
+        self.bottom = self.top - count + 1
+        self.gap_rate = gap_rate
+        self.latency = parse_latency(latency)
+        self.token_ttl = token_ttl
+        self.rate_limit = rate_limit
+        self.burst_every = burst_every
+        self.burst_duration = burst_duration
+        self.error_rate = error_rate
+        self.complete_after = complete_after
+        self.started = time.time()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens: Dict[str, float] = {}
+        self._bucket = rate_limit
+        self._bucket_updated = time.monotonic()
+        self.reset()
+    
+    def reset(self) -> None:
+        """Clear the request counters."""
+        with self._lock:
+            self.requests = 0
+            self.token_requests = 0
+            self.by_status: Dict[str, int] = {}
+            self.acns: Dict[str, int] = {}
+            self.answered = set()
+            self.latencies: List[float] = []
+            self.bytes_sent = 0
+    
+    def exists(self, number: int) -> bool:
+        """Check whether an ACN has a work item."""
+        return self.bottom <= number <= self.top and fraction(number, "gap") >= self.gap_rate
+    
+    def issue_token(self) -> Dict:
+        """Issue an access token and a rotated refresh token."""
+        with self._lock:
+            self.token_requests += 1
+            token = f"mock-{self.token_requests}-{self._rng.getrandbits(32):08x}"
+            self._tokens[token] = time.time() + self.token_ttl
+        return {"access_token": token, "expires_in": int(self.token_ttl), "refresh_token": f"mock-refresh-{self.token_requests}"}
+    
+    def authorized(self, token: str) -> bool:
+        """Check a bearer token; with a token TTL of 0 every request is authorized."""
+        if self.token_ttl <= 0:
+            return True
+        with self._lock:
+            return self._tokens.get(token, 0.0) > time.time()
+    
+    def throttled(self) -> Optional[float]:
+        """
+        Decide whether a request is rate limited.
+        
+        Returns:
+            The Retry-After delay in seconds, or None to serve the request
+        """
+        if self.burst_every > 0 and (time.time() - self.started) % self.burst_every < self.burst_duration:
+            return max(1.0, self.burst_duration - (time.time() - self.started) % self.burst_every)
+        if self.rate_limit <= 0:
+            return None
+        with self._lock:
+            now = time.monotonic()
+            self._bucket = min(self.rate_limit, self._bucket + (now - self._bucket_updated) * self.rate_limit)
+            self._bucket_updated = now
+            if self._bucket >= 1:
+                self._bucket -= 1
+                return None
+        return 1.0
+    
+    def draw(self) -> Dict[str, float]:
+        """Draw the latency and fault outcome of one request."""
+        with self._lock:
+            return {"delay": self.latency(self._rng), "fault": self._rng.random()}
+    
+    def record(self, acn: Optional[str], status: int, elapsed: float, size: int) -> None:
+        """Count a served request."""
+        with self._lock:
+            self.requests += 1
+            self.by_status[str(status)] = self.by_status.get(str(status), 0) + 1
+            if acn is not None:
+                self.acns[acn] = self.acns.get(acn, 0) + 1
+                if status in (200, 304, 404):
+                    self.answered.add(acn)
+            self.latencies.append(elapsed)
+            self.bytes_sent += size
+    
+    def stats(self) -> Dict:
+        """Summarize the counters since the last reset."""
+        with self._lock:
+            latencies = sorted(self.latencies)
+            by_status = dict(self.by_status)
+            acns = len(self.acns)
+            answered = len(self.answered)
+            requests = self.requests
+            token_requests = self.token_requests
+            bytes_sent = self.bytes_sent
+        
+        def percentile(p: float) -> Optional[float]:
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000, 1)
+        
+        return {
+            "requests": requests,
+            "token_requests": token_requests,
+            "by_status": by_status,
+            "unique_acns": acns,
+            # Every ACN needs one answered request; the rest went to 401s, 429s, 5xx and repeats
+            "wasted_requests": requests - answered,
+            "bytes_sent": bytes_sent,
+            "latency_ms": {"p50": percentile(50), "p90": percentile(90), "p99": percentile(99)},
+            "uptime": round(time.time() - self.started, 1),
+        }
+
+class MockHandler(BaseHTTPRequestHandler):
+    """Serve work items, tokens and counters from the server's MockState."""
+    
+    protocol_version = "HTTP/1.1"
+    
+    def log_message(self, format, *args):
+        logger.debug("%s - %s" % (self.address_string(), format % args))
+    
+    @property
+    def state(self) -> MockState:
+        return self.server.state
+    
+    def _send(self, status: int, body: Optional[Dict] = None, headers: Optional[Dict[str, str]] = None) -> int:
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+        return len(data)
+    
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        if self.path == TOKEN_PATH:
+            self._send(200, self.state.issue_token())
+        elif self.path == "/_reset":
+            self.state.reset()
+            self._send(200, {"reset": True})
+        else:
+            self._send(404, {"error": "not found"})
+    
+    def do_GET(self):
+        if self.path == "/_stats":
+            self._send(200, self.state.stats())
+            return
+        if not self.path.startswith(WORK_ITEM_PATH):
+            self._send(404, {"error": "not found"})
+            return
+        
+        started = time.monotonic()
+        acn = self.path[len(WORK_ITEM_PATH):]
+        status, size = self._serve_work_item(acn)
+        self.state.record(acn, status, time.monotonic() - started, size)
+    
+    def _serve_work_item(self, acn: str):
+        state = self.state
+        token = self.headers.get("Authorization", "").removeprefix("Bearer ")
+        if not state.authorized(token):
+            return 401, self._send(401, {"error": "Unauthorized"})
+        retry_after = state.throttled()
+        if retry_after is not None:
+            return 429, self._send(429, {"error": "Too Many Requests"}, {"Retry-After": str(math.ceil(retry_after))})
+        
+        draw = state.draw()
+        time.sleep(draw["delay"])
+        if draw["fault"] < state.error_rate:
+            status = random.choice((500, 502, 503))
+            return status, self._send(status, {"error": "Server Error"})
+        
+        try:
+            number = int(acn[1:])
+        except ValueError:
+            return 400, self._send(400, {"error": "Bad ACN"})
+        if acn[:1] != state.prefix or not state.exists(number):
+            return 404, self._send(404, {"error": "Not Found"})
+        
+        record = make_work_item(state.prefix, number, state.bottom, time.time() - state.started, state.complete_after)
+        body = json.dumps(record, sort_keys=True).encode("utf-8")
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            return 304, self._send(304, headers={"ETag": etag})
+        return 200, self._send(200, record, {"ETag": etag})
+
+def start_server(state: MockState, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    Start a mock server on a background thread.
+    
+    Args:
+        state: The configuration and counters to serve with
+        host: The interface to listen on
+        port: The port to listen on; 0 picks a free one
+    
+    Returns:
+        The running server; server.server_port is the port it listens on
+    """
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, name="mock-server", daemon=True).start()
+    return server
+
+@app.command()
+def serve(
+    host: str = typer.Option("127.0.0.1", "--host", help="The interface to listen on"),
+    port: int = typer.Option(DEFAULT_PORT, "--port", "-p", help="The port to listen on"),
+    top: str = typer.Option(DEFAULT_TOP_ACN, "--top", help="The highest ACN that exists"),
+    count: int = typer.Option(DEFAULT_COUNT, "--count", "-n", min=1, help="How many ACNs below --top exist"),
+    gap_rate: float = typer.Option(0.0, "--gap-rate", min=0.0, max=1.0, help="Fraction of ACNs in the range that return 404"),
+    latency: str = typer.Option(DEFAULT_LATENCY, "--latency", help="Response time distribution in ms, e.g. fixed:50, uniform:20,200, exp:80 or lognormal:80,0.5"),
+    token_ttl: float = typer.Option(3600.0, "--token-ttl", help="Seconds until an issued token expires and gets 401s (0 = no auth check)"),
+    rate_limit: float = typer.Option(0.0, "--rate-limit", help="Requests/second served before answering 429 (0 = unlimited)"),
+    burst_every: float = typer.Option(0.0, "--burst-every", help="Answer every request with 429 for --burst-duration seconds out of every N"),
+    burst_duration: float = typer.Option(5.0, "--burst-duration", help="Length of each 429 burst in seconds"),
+    error_rate: float = typer.Option(0.0, "--error-rate", min=0.0, max=1.0, help="Fraction of requests answered with a 5xx error"),
+    complete_after: float = typer.Option(0.0, "--complete-after", help="Seconds after which every pending item has completed (0 = never)"),
+    seed: int = typer.Option(0, "--seed", help="Seed for latencies and faults"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Log every request"),
+):
+    """
+    Run the mock server until interrupted.
+    
+    Examples:
+        ./mock_server.py                                      # 10000 ACNs below Z1865690, ~80ms per request
+        ./mock_server.py --gap-rate 0.02 --error-rate 0.01    # Some 404 gaps and 5xx faults
+        ./mock_server.py --token-ttl 60 --rate-limit 20       # Tokens expire every minute, 429 above 20 req/s
+        ./mock_server.py --burst-every 60 --burst-duration 5  # 5s of 429s every minute
+    """
+    if debug:
+        logger.setLevel(logging.DEBUG)
+    state = MockState(top, count, gap_rate, latency, token_ttl, rate_limit, burst_every, burst_duration, error_rate, complete_after, seed)
+    server = start_server(state, host, port)
+    base = f"http://{host}:{server.server_port}"
+    logger.info(f"Serving {count} ACNs from {state.prefix}{state.bottom} to {top} on {base}")
+    logger.info(f"SNAPR_BASE_URL={base}{WORK_ITEM_PATH.rstrip('/')} SNAPR_TOKEN_URL={base}{TOKEN_PATH}")
+    try:
+        while True:
+            time.sleep(60)
+            logger.info(f"Stats: {json.dumps(state.stats())}")
+    except KeyboardInterrupt:
+        logger.info("Stopping")
+        server.shutdown()
+
+if __name__ == "__main__":
+    app()
@@ -5,18 +5,44 @@
 #     "typer",
 #     "requests",
 #     "urllib3",
+#     "numpy",
 # ]
 # ///
 
+import ast
+import base64
 import csv
+import email.utils
+import fcntl
+import gzip
+import hashlib
+import heapq
+import hmac
 import json
 import logging
+import mmap
+import multiprocessing
 import os
 import random
+import sqlite3
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
 import time
+import urllib.parse
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import islice
+from operator import itemgetter
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Union
+from queue import Queue
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 import requests
 import typer
@@ -38,11 +64,70 @@ app = typer.Typer(help="SNAPR API Query Tool")
 DEFAULT_OUTPUT_PATH = Path("./output")
 DEFAULT_START_ACN = "Z1865690"
 MAX_RETRIES = 3
-BASE_URL = "https://snapr-service.bis.gov/api/workItems/stela"
-TOKEN_URL = "https://bisexternal.ciamlogin.com/16a0fd8f-4db1-4496-8036-56968f632d98/oauth2/v2.0/token"
+DEFAULT_RATE = 4.0  # requests per second when a rate limit is active
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 30.0  # seconds
+DEFAULT_QUEUE_SIZE = 256  # items buffered between pipeline stages
+DEFAULT_MERGE_RUN_SIZE = 50000  # rows sorted in memory at a time by merge
+MERGE_FAN_IN = 64  # sorted runs merged at once
+TOKEN_REFRESH_MARGIN = 300.0  # seconds before expiry to refresh the access token
+DEFAULT_BROKER_PORT = 8765
+DEFAULT_MAX_GAP = 20  # consecutive 404s tolerated before a crawl stops
+DEFAULT_COORDINATOR_PORT = 8766
+DEFAULT_BLOCK_SIZE = 200  # ACNs per coordinator lease
+DEFAULT_LEASE_TTL = 300.0  # seconds before an unrenewed lease is re-issued
+WORKER_POLL_INTERVAL = 5.0  # seconds between lease requests when none is available
+DEFAULT_SERVE_PORT = 8767
+DEFAULT_MEMORY_CACHE_SIZE = 10000  # lookups kept in memory by serve
+NOT_FOUND_TTL = 300.0  # seconds serve remembers a 404, so new ACNs show up soon
+MAX_BATCH_LOOKUP = 1000  # ACNs per batch lookup request
+DEFAULT_METRICS_INTERVAL = 10.0  # seconds between metrics summary lines
+DEFAULT_TARGET_LATENCY = 1.0  # seconds; adaptive concurrency stops growing above this
+CONCURRENCY_BACKOFF = 0.5  # limit multiplier after a 429, 503 or failed request
+LATENCY_BACKOFF = 0.9  # limit multiplier while latency is over target
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+# Both can point at another server, e.g. mock_server.py for benchmarks
+BASE_URL = os.environ.get("SNAPR_BASE_URL", "https://snapr-service.bis.gov/api/workItems/stela")
+TOKEN_URL = os.environ.get("SNAPR_TOKEN_URL", "https://bisexternal.ciamlogin.com/16a0fd8f-4db1-4496-8036-56968f632d98/oauth2/v2.0/token")
 SAVE_POINT_FILE = Path("./snapr_save_point.json")
+JOURNAL_FILE = Path("./snapr_journal.ndjson")
+CACHE_FILE = Path("./snapr_cache.db")
+MISSING_FILE = Path("./snapr_missing.json")
+DEFAULT_MISSING_TTL = "7d"
+RETRY_FILE = Path("./snapr_retry.json")
+RETRY_BACKOFF = 60.0  # seconds before the first retry of a failed ACN, doubled after each failure
+RETRY_MAX_BACKOFF = 6 * 3600.0
+MAX_RETRY_ATTEMPTS = 8  # failures before an ACN is only retried with retry-failed --all
+WATCH_STATE_FILE = Path("./snapr_watch.json")
+DEFAULT_POLL_INTERVAL = "5m"  # between watch ticks
+DEFAULT_PROBE_SIZE = 10  # ACNs above the high-water mark probed at a time
+MAX_PROBE_BATCHES = 50  # probe batches per watch tick
+DEFAULT_RECHECK_INTERVAL = "1h"  # first re-check of a pending item, doubled while it doesn't change
+DEFAULT_RECHECK_MAX = "7d"
+DEFAULT_RECENT = "90d"  # pending items registered longer ago than this are not watched
+
+# How long a cached response is served without asking the server, by reviewStatus
+# ("*" applies to every other status)
+DEFAULT_CACHE_TTLS = {
+    "COMPLETED": 30 * 86400,
+    "*": 6 * 3600,
+}
 CONFIG_FILE = Path("./snapr_config.json")
 
+# Columns returned by the work item endpoint, in the order used by output.csv
+CSV_FIELDS = [
+    "acn", "caseNumber", "completedReferrals", "completionDate", "finalDecision", "pendingReferrals",
+    "registrationDate", "renewingDivision", "renewingOffice", "reopenDate", "reviewStatus", "type",
+]
+
+# Columns of the referrals table, one row per referral of a work item
+REFERRAL_FIELDS = ["acn", "agency", "referralDate", "closedDate", "state"]
+
+# Output formats and their file extensions; ndjson can also end in .gz or .zst
+OUTPUT_FORMATS = {"csv": ".csv", "ndjson": ".ndjson", "parquet": ".parquet"}
+COMPRESSED_SUFFIXES = (".gz", ".zst")
+
 # User agents for rotation
 USER_AGENTS = [
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/134.0.0.0 Safari/537.36",
@@ -70,24 +155,516 @@ def get_headers(token: str, user_id: str = "199785") -> Dict[str, str]:
         "x-user": user_id,
     }
 
-def create_session() -> requests.Session:
-    """Create a session with retry capabilities."""
+def create_session(pool_size: int = 10) -> requests.Session:
+    """
+    Create a session that retries a failed connection once.
+    
+    Error responses are not retried here, so a bad ACN never stalls a crawl
+    with backoff sleeps. 429s are handled by query_acn and other failures
+    go to the RetryQueue.
+    
+    Args:
+        pool_size: The number of pooled connections to keep per host
+    """
     session = requests.Session()
     
     # Configure retry strategy
     retry_strategy = Retry(
-        total=MAX_RETRIES,
-        backoff_factor=1,
-        status_forcelist=[429, 500, 502, 503, 504],
+        total=1,
+        connect=1,
+        read=0,
+        status=0,
+        backoff_factor=0,
         allowed_methods=["GET"]
     )
     
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=pool_size, pool_maxsize=pool_size)
     session.mount("http://", adapter)
     session.mount("https://", adapter)
     
     return session
 
+class RateLimiter:
+    """
+    Thread-safe token bucket shared by every fetch worker.
+    
+    Tokens refill at `rate` per second up to `burst`. A 429 from the server
+    pauses the whole bucket for the Retry-After period, so the configured rate
+    is a hard ceiling on the load we send regardless of the number of workers.
+    """
+    
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+    
+    def acquire(self) -> None:
+        """Block until a request may be sent."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+    
+    def pause(self, seconds: float) -> None:
+        """
+        Stop handing out tokens for the given number of seconds.
+        
+        Args:
+            seconds: How long every worker should back off
+        """
+        with self._lock:
+            until = time.monotonic() + seconds
+            if until > self._paused_until:
+                self._paused_until = until
+                # Start refilling from empty once the pause is over
+                self._tokens = 0
+                self._updated = until
+        logger.warning(f"Rate limited by server, pausing all requests for {seconds:.1f}s")
+
+class SharedRateLimiter(RateLimiter):
+    """
+    RateLimiter whose bucket lives in shared memory.
+    
+    One instance caps the total request rate of every process it is passed
+    to when they are started, e.g. the shards of a crawl.
+    """
+    
+    def __init__(self, rate: float, burst: Optional[float] = None, context=None):
+        context = context or multiprocessing.get_context()
+        # tokens, updated, paused_until
+        self._state = context.RawArray('d', 3)
+        super().__init__(rate, burst)
+        self._lock = context.Lock()
+    
+    @property
+    def _tokens(self) -> float:
+        return self._state[0]
+    
+    @_tokens.setter
+    def _tokens(self, value: float) -> None:
+        self._state[0] = value
+    
+    @property
+    def _updated(self) -> float:
+        return self._state[1]
+    
+    @_updated.setter
+    def _updated(self, value: float) -> None:
+        self._state[1] = value
+    
+    @property
+    def _paused_until(self) -> float:
+        return self._state[2]
+    
+    @_paused_until.setter
+    def _paused_until(self, value: float) -> None:
+        self._state[2] = value
+
+class ConcurrencyController:
+    """
+    Adaptive limit on the requests in flight, in the AIMD style of TCP congestion control.
+    
+    Workers take a slot with acquire() before each request and return it with
+    release(). Until the first sign of congestion the limit doubles every round
+    trip (slow start); after that it grows by one per round trip while the
+    smoothed latency stays under the target. A 429, a 503 or a failed request
+    halves it, latency over the target shrinks it by 10%. Requests sent before
+    the last decrease cannot cause another, so a burst of 429s counts once. The
+    limit only grows while every slot is in use and never leaves 1..ceiling.
+    """
+    
+    def __init__(self, ceiling: int, target_latency: float = DEFAULT_TARGET_LATENCY, initial: int = 1):
+        self.ceiling = ceiling
+        self.target_latency = target_latency
+        self.limit = float(max(1, min(initial, ceiling)))
+        self.latency: Optional[float] = None  # exponentially smoothed, in seconds
+        self.decreases = 0
+        self.lowest = self.highest = self.limit
+        self._in_flight = 0
+        self._slow_start = True
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        # Time-weighted limit since slow start ended, for the steady state
+        self._changed = time.monotonic()
+        self._steady_since: Optional[float] = None
+        self._steady_area = 0.0
+        metrics.set("snapr_concurrency_limit", int(self.limit))
+    
+    def acquire(self) -> float:
+        """
+        Block until fewer requests than the limit are in flight and take a slot.
+        
+        Returns:
+            The time the slot was taken, to pass to release()
+        """
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+        return time.monotonic()
+    
+    def release(self, started: float, status: Optional[int]) -> None:
+        """
+        Return a slot and adjust the limit to the outcome of its request.
+        
+        Args:
+            started: What acquire() returned
+            status: The HTTP status of the response, None if none arrived
+        """
+        latency = time.monotonic() - started
+        with self._condition:
+            saturated = self._in_flight >= int(self.limit)
+            self._in_flight -= 1
+            self.latency = latency if self.latency is None else 0.9 * self.latency + 0.1 * latency
+            if status is None or status in (429, 503):
+                self._decrease(started, CONCURRENCY_BACKOFF, str(status) if status else "request failed")
+            elif self.latency > self.target_latency:
+                self._decrease(started, LATENCY_BACKOFF, f"latency {self.latency * 1000:.0f}ms over the {self.target_latency * 1000:.0f}ms target")
+            elif saturated and self.limit < self.ceiling:
+                self._set(self.limit + (1.0 if self._slow_start else 1.0 / self.limit))
+            self._condition.notify_all()
+    
+    def _decrease(self, started: float, factor: float, reason: str) -> None:
+        if started < self._last_decrease:
+            return
+        self._last_decrease = time.monotonic()
+        self.decreases += 1
+        old = int(self.limit)
+        if self._slow_start:
+            self._slow_start = False
+            self._steady_since = self._last_decrease
+        self._set(max(1.0, self.limit * factor))
+        logger.info(f"Concurrency {old} -> {int(self.limit)} ({reason})")
+    
+    def _set(self, limit: float) -> None:
+        now = time.monotonic()
+        if self._steady_since is not None:
+            self._steady_area += self.limit * (now - max(self._changed, self._steady_since))
+        self._changed = now
+        old = int(self.limit)
+        self.limit = min(limit, float(self.ceiling))
+        self.lowest = min(self.lowest, self.limit)
+        self.highest = max(self.highest, self.limit)
+        if int(self.limit) > old:
+            logger.debug(f"Concurrency {old} -> {int(self.limit)}")
+            if int(self.limit) == self.ceiling:
+                logger.info(f"Concurrency reached the ceiling of {self.ceiling}")
+        metrics.set("snapr_concurrency_limit", int(self.limit))
+    
+    def steady_state(self) -> float:
+        """The time-weighted mean limit since slow start ended, or the current limit."""
+        with self._condition:
+            if self._steady_since is None:
+                return self.limit
+            now = time.monotonic()
+            elapsed = now - self._steady_since
+            area = self._steady_area + self.limit * (now - max(self._changed, self._steady_since))
+            return area / elapsed if elapsed > 0 else self.limit
+    
+    def summary(self) -> str:
+        latency = f", smoothed latency {self.latency * 1000:.0f}ms" if self.latency is not None else ""
+        return (f"Adaptive concurrency settled at {self.steady_state():.1f} requests in flight "
+                f"(now {int(self.limit)}, range {int(self.lowest)}-{int(self.highest)} of {self.ceiling}, "
+                f"{self.decreases} decrease(s){latency})")
+
+def parse_retry_after(value: Optional[str], default: float = 5.0) -> float:
+    """
+    Parse a Retry-After header value.
+    
+    Args:
+        value: The header value, either delay-seconds or an HTTP date
+        default: The delay to use if the header is missing or malformed
+        
+    Returns:
+        The number of seconds to wait
+    """
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+class Histogram:
+    """
+    Distribution of observed values in fixed buckets, as Prometheus keeps them.
+    
+    Quantiles are estimated by interpolating within the bucket they fall in,
+    which is accurate enough to tell a 50ms p99 from a 500ms one.
+    """
+    
+    def __init__(self, bounds: List[float] = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+    
+    def observe(self, value: float) -> None:
+        """Record one value."""
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+    
+    def quantile(self, q: float) -> float:
+        """Estimate the value below which a fraction q of the observations fall."""
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+            seen += count
+        return self.max
+
+class Metrics:
+    """
+    Counters and histograms describing a crawl, safe to update from any thread.
+    
+    Series are a metric name plus labels, e.g.
+    inc("snapr_requests_total", status="200"). render() produces the
+    Prometheus text format, summary() the periodic one-line report and
+    profile() the timing breakdown printed by --profile.
+    """
+    
+    # Type and help text of every metric
+    DESCRIPTIONS = {
+        "snapr_requests_total": ("counter", "API requests by HTTP status (error = no response)"),
+        "snapr_request_duration_seconds": ("histogram", "API request latency"),
+        "snapr_request_retries_total": ("counter", "API requests repeated after a 429 or 401"),
+        "snapr_response_bytes_total": ("counter", "API response body bytes received"),
+        "snapr_rate_limit_wait_seconds_total": ("counter", "Time spent waiting for the rate limiter, summed over workers"),
+        "snapr_token_refreshes_total": ("counter", "Access tokens obtained, by reason"),
+        "snapr_token_request_duration_seconds": ("histogram", "Token endpoint latency"),
+        "snapr_records_saved_total": ("counter", "Records written to the output"),
+        "snapr_sink_flush_duration_seconds": ("histogram", "Time to write and sync one batch"),
+        "snapr_concurrency_limit": ("gauge", "Requests the adaptive controller allows in flight"),
+        "snapr_lookups_total": ("counter", "Lookups answered by serve, by where the answer came from"),
+    }
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self._last_summary = (self.started, 0.0, 0.0)
+    
+    def inc(self, name: str, value: float = 1.0, **labels: str) -> None:
+        """Add to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0.0) + value
+    
+    def set(self, name: str, value: float, **labels: str) -> None:
+        """Set a gauge."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = value
+    
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Record a value in a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+    
+    def total(self, name: str) -> float:
+        """Sum a counter over all its labels."""
+        with self._lock:
+            return sum(value for (series, _), value in self.counters.items() if series == name)
+    
+    def by_label(self, name: str, label: str) -> Dict[str, float]:
+        """Sum a counter per value of one label."""
+        totals: Dict[str, float] = {}
+        with self._lock:
+            for (series, labels), value in self.counters.items():
+                if series == name:
+                    key = dict(labels).get(label, "")
+                    totals[key] = totals.get(key, 0.0) + value
+        return totals
+    
+    def merged(self, name: str) -> Histogram:
+        """Combine a histogram over all its labels."""
+        merged = Histogram()
+        with self._lock:
+            for (series, _), histogram in self.histograms.items():
+                if series == name:
+                    merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+                    merged.count += histogram.count
+                    merged.sum += histogram.sum
+                    merged.max = max(merged.max, histogram.max)
+        return merged
+    
+    def render(self) -> str:
+        """Format every series in the Prometheus text exposition format."""
+        def label_text(labels: Tuple) -> str:
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+        
+        lines = []
+        with self._lock:
+            for name, (kind, help_text) in self.DESCRIPTIONS.items():
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                for (series, labels), value in sorted(self.counters.items()):
+                    if series == name:
+                        lines.append(f"{name}{label_text(labels)} {value:g}")
+                for (series, labels), histogram in sorted(self.histograms.items(), key=itemgetter(0)):
+                    if series != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.bounds + [float("inf")], histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                        lines.append(f"{name}_bucket{label_text(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{label_text(labels)} {histogram.sum:g}")
+                    lines.append(f"{name}_count{label_text(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+    
+    def write_textfile(self, path: Path) -> None:
+        """Write render() to a file atomically, e.g. for node_exporter's textfile collector."""
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+    
+    def summary(self) -> str:
+        """Describe progress since the start and the rates since the last summary."""
+        now = time.monotonic()
+        requests_total = self.total("snapr_requests_total")
+        saved = self.total("snapr_records_saved_total")
+        last_time, last_requests, last_saved = self._last_summary
+        self._last_summary = (now, requests_total, saved)
+        interval = max(now - last_time, 1e-6)
+        latency = self.merged("snapr_request_duration_seconds")
+        statuses = ", ".join(f"{status}: {count:.0f}" for status, count in sorted(self.by_label("snapr_requests_total", "status").items()))
+        return (f"Metrics: {requests_total:.0f} requests ({(requests_total - last_requests) / interval:.1f}/s), "
+                f"p50 {latency.quantile(0.5) * 1000:.0f}ms, p99 {latency.quantile(0.99) * 1000:.0f}ms"
+                + (f" [{statuses}]" if statuses else "")
+                + f"; {self.total('snapr_request_retries_total'):.0f} retries, "
+                f"{self.total('snapr_token_refreshes_total'):.0f} token refreshes, "
+                f"{self.total('snapr_response_bytes_total') / 1e6:.1f} MB received; "
+                f"{saved:.0f} records saved ({(saved - last_saved) / interval:.1f}/s)"
+                + (f"; concurrency {self.total('snapr_concurrency_limit'):.0f}" if self.total("snapr_concurrency_limit") else ""))
+    
+    def profile(self) -> List[str]:
+        """Break down where the crawl spent its time, one line per instrumented step."""
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        lines = [f"Wall time {elapsed:.1f}s; times below are summed over workers"]
+        for name, label in (
+            ("snapr_request_duration_seconds", "API requests"),
+            ("snapr_token_request_duration_seconds", "Token requests"),
+            ("snapr_sink_flush_duration_seconds", "Sink flushes"),
+        ):
+            histogram = self.merged(name)
+            if not histogram.count:
+                continue
+            lines.append(f"{label}: {histogram.count} calls, {histogram.sum:.1f}s total ({histogram.sum / elapsed:.0%} of wall time), "
+                         f"mean {histogram.sum / histogram.count * 1000:.0f}ms, p50 {histogram.quantile(0.5) * 1000:.0f}ms, "
+                         f"p99 {histogram.quantile(0.99) * 1000:.0f}ms, max {histogram.max * 1000:.0f}ms")
+        waited = self.total("snapr_rate_limit_wait_seconds_total")
+        if waited:
+            lines.append(f"Rate limiter: {waited:.1f}s waiting ({waited / elapsed:.0%} of wall time)")
+        return lines
+
+# Metrics of this process, updated by query_acn, token refreshes and sinks
+metrics = Metrics()
+
+class MetricsReporter:
+    """
+    Log a metrics summary and rewrite the metrics textfile at an interval.
+    
+    Runs on a background thread between start() and stop(); stop() reports
+    one last time so the final numbers are never lost.
+    """
+    
+    def __init__(self, interval: float = DEFAULT_METRICS_INTERVAL, textfile: Optional[Path] = None):
+        self.interval = interval
+        self.textfile = textfile
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def report(self) -> None:
+        """Log the summary line and write the textfile once."""
+        if self.interval > 0:
+            logger.info(metrics.summary())
+        if self.textfile is not None:
+            try:
+                metrics.write_textfile(self.textfile)
+            except OSError as e:
+                logger.warning(f"Failed to write metrics to {self.textfile}: {e}")
+    
+    def start(self) -> None:
+        """Start reporting in the background."""
+        if self._thread is None and (self.interval > 0 or self.textfile is not None):
+            self._thread = threading.Thread(target=self._run, name="metrics-reporter", daemon=True)
+            self._thread.start()
+    
+    def stop(self) -> None:
+        """Stop reporting and report the final numbers."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+            self.report()
+    
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval if self.interval > 0 else DEFAULT_METRICS_INTERVAL):
+            self.report()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """HTTP handler serving the process metrics at GET /metrics for Prometheus to scrape."""
+    
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"Metrics endpoint: {format % args}")
+    
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_metrics_server(host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    Serve the process metrics over HTTP in a background thread.
+    
+    Args:
+        host: The address to listen on
+        port: The port to listen on (0 picks a free port)
+        
+    Returns:
+        The running server; its port is server.server_port
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
 def load_config() -> Dict:
     """
     Load the configuration from a file.
@@ -150,118 +727,359 @@ def save_config(config: Dict) -> None:
     except Exception as e:
         logger.error(f"Failed to save configuration: {e}")
 
-def get_token_from_curl() -> Dict:
+def parse_curl_command(curl_command: List[str]) -> Tuple[Dict[str, str], str]:
     """
-    Get a new token using the curl command from the configuration.
+    Extract the headers and form body from a stored curl command.
     
+    Args:
+        curl_command: The curl command split into arguments
+        
     Returns:
-        The token response as a dictionary
+        A tuple of (headers, body)
+    """
+    headers = {}
+    body = ""
+    args = iter(curl_command)
+    for arg in args:
+        if arg in ("-H", "--header"):
+            name, _, value = next(args, "").partition(":")
+            headers[name.strip()] = value.strip()
+        elif arg in ("--data-raw", "--data", "-d"):
+            body = next(args, "")
+    return headers, body
+
+def with_refresh_token(body: str, refresh_token: str) -> str:
     """
-    logger.info("Requesting new access token...")
+    Rewrite a token request body to use a refresh token grant.
     
-    # Load the curl command from the configuration
-    config = load_config()
-    curl_command = config.get("curl_command", [])
+    Works for both the refresh token bodies written by the uu command and the
+    authorization code bodies captured from the browser.
     
-    # Log the curl command for debugging
-    logger.info(f"Using curl command with {len(curl_command)} parts")
-    logger.info(f"First few parts: {curl_command[:3]}")
-    logger.info(f"Last few parts: {curl_command[-2:] if len(curl_command) >= 2 else curl_command}")
+    Args:
+        body: The form-encoded request body
+        refresh_token: The refresh token to use
+        
+    Returns:
+        The new form-encoded request body
+    """
+    fields = [
+        (key, value) for key, value in urllib.parse.parse_qsl(body, keep_blank_values=True)
+        if key not in ("code", "code_verifier", "redirect_uri", "grant_type", "refresh_token")
+    ]
+    fields += [("grant_type", "refresh_token"), ("refresh_token", refresh_token)]
+    return urllib.parse.urlencode(fields, quote_via=urllib.parse.quote)
+
+def jwt_expiry(token: str) -> Optional[float]:
+    """
+    Read the expiry time from a JWT access token without verifying it.
     
-    # Check if the curl command is valid
-    if not curl_command or len(curl_command) < 2:
-        logger.error("Invalid curl command. Please update the curl command using the update-curl command.")
+    Args:
+        token: The access token
+        
+    Returns:
+        The expiry as a Unix timestamp, or None if the token is not a JWT
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
         return None
+
+class TokenManager:
+    """
+    Obtain access tokens from TOKEN_URL and cache them until they expire.
     
-    try:
-        # Fix malformed refresh token in the curl command before executing
-        fixed_curl_command = []
-        for part in curl_command:
-            if isinstance(part, str) and '--data-raw' in part and 'refresh_token=' in part:
-                logger.info("Checking for malformed refresh token in curl command...")
-                import re
-                # Extract the refresh token parameter
-                refresh_token_match = re.search(r'refresh_token=([^&]+)', part)
-                if refresh_token_match:
-                    old_refresh_token = refresh_token_match.group(1)
-                    logger.debug(f"Found refresh token: {old_refresh_token[:10]}...")
-                    
-                    # Check if it's a JSON string or contains a JSON object
-                    if (old_refresh_token.startswith('{') and old_refresh_token.endswith('}')) or '"refresh_token":' in old_refresh_token:
-                        logger.info("Found malformed refresh token in config (JSON object)")
-                        try:
-                            # Try to find and extract the refresh_token value from the string
-                            token_match = re.search(r'"refresh_token":"([^"]+)"', old_refresh_token)
-                            if token_match:
-                                actual_token = token_match.group(1)
-                                logger.info(f"Extracted actual refresh token: {actual_token[:10]}...")
-                                # Replace the JSON string with just the refresh token
-                                fixed_part = part.replace(f"refresh_token={old_refresh_token}", f"refresh_token={actual_token}")
-                                fixed_curl_command.append(fixed_part)
-                                # Update the config for future use
-                                config["curl_command"] = curl_command.copy()
-                                for i, cmd_part in enumerate(config["curl_command"]):
-                                    if isinstance(cmd_part, str) and '--data-raw' in cmd_part and 'refresh_token=' in cmd_part:
-                                        config["curl_command"][i] = fixed_part
-                                save_config(config)
-                                logger.info("Updated config with fixed refresh token")
-                                continue
-                            else:
-                                logger.warning("Could not extract refresh token from JSON string")
-                        except Exception as e:
-                            logger.warning(f"Error fixing refresh token: {e}")
-            # If no special handling needed or if handling failed, use the original part
-            fixed_curl_command.append(part)
-        
-        # Execute the fixed curl command and capture the output
-        logger.info("Executing curl command...")
-        result = subprocess.run(fixed_curl_command, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            logger.error(f"Failed to get token: {result.stderr}")
-            return None
+    Tokens are requested over the given session using the headers and body of
+    the stored curl command, and the rotated refresh token is written back to
+    the configuration. Once started, a background thread refreshes the token
+    ahead of expiry so callers don't block on auth. Refreshes are
+    single-flight: concurrent callers wait for the one in progress.
+    """
+    
+    def __init__(self, session: requests.Session, token: Optional[str] = None, refresh_margin: float = TOKEN_REFRESH_MARGIN):
+        self.session = session
+        self.refresh_margin = refresh_margin
+        self._token = token
+        # A token passed on the command line is trusted until it expires or gets a 401
+        self._expires_at = (jwt_expiry(token) or float("inf")) if token else 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def _valid(self) -> bool:
+        return self._token is not None and time.time() < self._expires_at
+    
+    @property
+    def expires_at(self) -> float:
+        """When the cached token expires, as a Unix timestamp."""
+        return self._expires_at
+    
+    def get(self) -> Optional[str]:
+        """
+        Return a valid access token, fetching one if needed.
         
-        # Log the output for debugging
-        logger.info(f"Curl command output length: {len(result.stdout)}")
-        logger.info(f"Curl command output preview: {result.stdout[:100]}...")
+        Returns:
+            The access token or None if one could not be obtained
+        """
+        if self._valid():
+            return self._token
+        return self.refresh(reason="expired")
+    
+    def invalidate(self, stale_token: Optional[str]) -> Optional[str]:
+        """
+        Report that a token was rejected (401) and get a replacement.
         
-        # Parse the JSON response
-        try:
-            token_data = json.loads(result.stdout)
-            logger.info(f"Successfully parsed JSON response with keys: {token_data.keys()}")
+        Args:
+            stale_token: The token the server rejected
             
-            # Update the config with the new refresh token if available
-            if 'refresh_token' in token_data:
-                # Get the current curl command
-                current_curl = config.get("curl_command", [])
-                
-                # Update the refresh token in the curl command
-                for i, part in enumerate(current_curl):
-                    if isinstance(part, str) and '--data-raw' in part and 'refresh_token=' in part:
-                        # Extract the refresh token parameter
-                        import re
-                        refresh_token_match = re.search(r'refresh_token=([^&]+)', part)
-                        if refresh_token_match:
-                            old_refresh_token = refresh_token_match.group(1)
-                            # Replace the old token with the new one
-                            logger.info("Updating refresh token in config with new token")
-                            new_part = part.replace(f"refresh_token={old_refresh_token}", f"refresh_token={token_data['refresh_token']}")
-                            current_curl[i] = new_part
-                            # Update the config
-                            config["curl_command"] = current_curl
-                            save_config(config)
-                            logger.info("Updated config with new refresh token")
+        Returns:
+            A new access token or None if one could not be obtained
+        """
+        return self.refresh(stale_token=stale_token, force=True, reason="401")
+    
+    def refresh(self, stale_token: Optional[str] = None, force: bool = False, reason: str = "scheduled") -> Optional[str]:
+        """
+        Request a new access token unless another caller already did.
+        
+        Args:
+            stale_token: Only refresh if this is still the cached token
+            force: Refresh even if the cached token has not expired
+            reason: Why the token is refreshed, counted in the metrics
             
-            return token_data
-        except json.JSONDecodeError as e:
-            logger.error(f"Failed to parse JSON response: {e}")
-            logger.error(f"Response: {result.stdout}")
+        Returns:
+            The access token or None if one could not be obtained
+        """
+        with self._lock:
+            if self._valid() and (not force or self._token != stale_token):
+                return self._token
+            token_data = self._request_token()
+            if not token_data:
+                return None
+            self._token = token_data["access_token"]
+            self._expires_at = time.time() + float(token_data.get("expires_in", 3600))
+            metrics.inc("snapr_token_refreshes_total", reason=reason)
+            logger.info(f"Obtained access token valid for {int(self._expires_at - time.time())}s")
+            return self._token
+    
+    def _request_token(self) -> Optional[Dict]:
+        logger.info("Requesting new access token...")
+        config = load_config()
+        curl_command = config.get("curl_command", [])
+        if not curl_command or len(curl_command) < 2:
+            logger.error("Invalid curl command. Please update the curl command using the update-curl command.")
             return None
-    except Exception as e:
-        logger.error(f"Error getting token: {e}")
+        
+        headers, body = parse_curl_command(curl_command)
+        started = time.monotonic()
+        try:
+            response = self.session.post(TOKEN_URL, headers=headers, data=body, timeout=30)
+            token_data = response.json()
+            metrics.observe("snapr_token_request_duration_seconds", time.monotonic() - started)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(f"Error getting token: {e}")
+            return None
+        
+        if "access_token" not in token_data:
+            logger.error(f"No access token in response ({response.status_code}): {json.dumps(token_data)[:200]}")
+            logger.error("Please update the curl command using the update-curl command.")
+            return None
+        
+        # Refresh tokens rotate, so the next request must use the new one
+        if token_data.get("refresh_token"):
+            for i, part in enumerate(curl_command):
+                if part == body:
+                    curl_command[i] = with_refresh_token(body, token_data["refresh_token"])
+            config["curl_command"] = curl_command
+            save_config(config)
+            logger.info("Updated config with new refresh token")
+        
+        return token_data
+    
+    def start(self) -> None:
+        """Start refreshing the token in the background ahead of expiry."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="token-refresh", daemon=True)
+            self._thread.start()
+    
+    def stop(self) -> None:
+        """Stop the background refresh thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+    
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            # Refresh a margin before expiry, but never less than halfway through the token's life
+            remaining = self._expires_at - time.time()
+            wait = max(remaining - self.refresh_margin, remaining / 2, 0)
+            if self._stop.wait(min(wait, 3600)):
+                return
+            if self._expires_at - time.time() > self.refresh_margin:
+                continue
+            if self.refresh(stale_token=self._token, force=True) is None:
+                # Try again shortly; callers will also retry on their own
+                self._stop.wait(30)
+
+def parse_duration(value: str) -> float:
+    """
+    Parse a duration such as "90", "15m", "6h" or "30d" into seconds.
+    
+    Args:
+        value: The duration; a plain number is taken as seconds
+        
+    Returns:
+        The duration in seconds
+    """
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    value = value.strip().lower()
+    try:
+        if value and value[-1] in units:
+            return float(value[:-1]) * units[value[-1]]
+        return float(value)
+    except ValueError:
+        raise typer.BadParameter(f"Invalid duration '{value}', expected e.g. 90, 15m, 6h or 30d")
+
+def parse_cache_ttls(overrides: Optional[List[str]]) -> Dict[str, float]:
+    """
+    Build the cache TTL policy from --cache-ttl STATUS=DURATION options.
+    
+    Args:
+        overrides: Values such as "COMPLETED=30d" or "*=1h"
+        
+    Returns:
+        The TTL in seconds by reviewStatus
+    """
+    ttls = dict(DEFAULT_CACHE_TTLS)
+    for override in overrides or []:
+        status, sep, duration = override.partition("=")
+        if not sep:
+            raise typer.BadParameter(f"Invalid --cache-ttl '{override}', expected STATUS=DURATION")
+        ttls[status.strip()] = parse_duration(duration)
+    return ttls
+
+class ResponseCache:
+    """
+    On-disk cache of work item responses keyed by ACN.
+    
+    Stores the response body with its ETag and Last-Modified headers. A
+    response is served without a request while younger than the TTL for its
+    reviewStatus; after that it is revalidated with a conditional request. In
+    offline mode only cached responses are served. Safe to share between
+    fetch threads.
+    """
+    
+    def __init__(self, db_path: Path, ttls: Optional[Dict[str, float]] = None, offline: bool = False, revalidate: bool = False):
+        self.db_path = db_path
+        self.ttls = ttls or dict(DEFAULT_CACHE_TTLS)
+        self.offline = offline
+        # Always ask the server, but still send conditional requests
+        self.revalidate = revalidate
+        self.hits = self.revalidated = self.misses = 0
+        self._lock = threading.Lock()
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                acn TEXT PRIMARY KEY,
+                body TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                review_status TEXT,
+                validated_at REAL NOT NULL
+            )
+            """
+        )
+    
+    def get(self, acn: str) -> Optional[Dict]:
+        """
+        Look up the cached entry for an ACN.
+        
+        Returns:
+            A dict with body, etag, last_modified, review_status and validated_at, or None
+        """
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT body, etag, last_modified, review_status, validated_at FROM responses WHERE acn = ?", (acn,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("body", "etag", "last_modified", "review_status", "validated_at"), row))
+    
+    def is_fresh(self, entry: Dict) -> bool:
+        """Check whether an entry can be served without asking the server."""
+        if self.offline:
+            return True
+        if self.revalidate:
+            return False
+        ttl = self.ttls.get(entry["review_status"], self.ttls.get("*", 0))
+        return time.time() - entry["validated_at"] < ttl
+    
+    def count_hit(self) -> None:
+        """Count a response served from the cache without a request."""
+        with self._lock:
+            self.hits += 1
+    
+    def put(self, acn: str, response: requests.Response, data: Dict) -> None:
+        """Store a 200 response and count it as fetched."""
+        with self._lock, self.conn:
+            self.misses += 1
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (acn, body, etag, last_modified, review_status, validated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (acn, response.text, response.headers.get("ETag"), response.headers.get("Last-Modified"), data.get("reviewStatus"), time.time()),
+            )
+    
+    def touch(self, acn: str) -> None:
+        """Mark an entry as just revalidated (304 Not Modified) and count it."""
+        with self._lock, self.conn:
+            self.revalidated += 1
+            self.conn.execute("UPDATE responses SET validated_at = ? WHERE acn = ?", (time.time(), acn))
+    
+    def delete(self, acn: str) -> None:
+        """Forget an entry, e.g. after the ACN returned 404."""
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM responses WHERE acn = ?", (acn,))
+    
+    def close(self) -> None:
+        """Close the database."""
+        logger.info(f"Response cache: {self.hits} served from cache, {self.revalidated} revalidated, {self.misses} fetched")
+        with self._lock:
+            self.conn.close()
+
+def open_cache(cache_path: Optional[Path], offline: bool = False, ttl_overrides: Optional[List[str]] = None, revalidate: bool = False) -> Optional[ResponseCache]:
+    """
+    Open the response cache for a command, if one was requested.
+    
+    Args:
+        cache_path: The --cache path, or None
+        offline: Serve only from the cache (implies the default cache path)
+        ttl_overrides: --cache-ttl values
+        revalidate: Always revalidate cached responses with the server
+        
+    Returns:
+        The cache or None if caching is off
+    """
+    if cache_path is None and not offline:
         return None
+    cache_path = cache_path or CACHE_FILE
+    if offline and not cache_path.exists():
+        raise typer.BadParameter(f"--offline needs an existing cache, {cache_path} not found")
+    cache = ResponseCache(cache_path, parse_cache_ttls(ttl_overrides), offline=offline, revalidate=revalidate)
+    logger.info(f"Using response cache {cache_path}{' (offline)' if offline else ''}")
+    return cache
 
-def query_acn(session: requests.Session, acn: str, token: str) -> Dict:
+def query_acn(
+    session: requests.Session,
+    acn: str,
+    token: str,
+    limiter: Optional[RateLimiter] = None,
+    cache: Optional[ResponseCache] = None,
+    controller: Optional[ConcurrencyController] = None,
+) -> Dict:
     """
     Query the SNAPR API for a specific ACN.
     
@@ -269,26 +1087,83 @@ def query_acn(session: requests.Session, acn: str, token: str) -> Dict:
         session: The requests session
         acn: The ACN to query
         token: The authentication token
+        limiter: Optional shared rate limiter; replaces the random delay and
+            handles 429 responses by pausing every worker
+        cache: Optional response cache; fresh entries are served without a
+            request and stale ones are revalidated with a conditional request
+        controller: Optional adaptive concurrency limit; each request holds
+            one of its slots and reports its latency and status back
         
     Returns:
-        The JSON response as a dictionary or an empty dictionary with just the ACN if an error occurs
+        The JSON response as a dictionary, None for a 404, or
+        {"acn": ..., "error": {"status": ..., "message": ...}} if the request failed
     """
     url = f"{BASE_URL}/{acn}"
     
+    cached = cache.get(acn) if cache is not None else None
+    if cached is not None and cache.is_fresh(cached):
+        cache.count_hit()
+        logger.debug(f"Served ACN {acn} from cache")
+        return json.loads(cached["body"])
+    if cache is not None and cache.offline:
+        logger.debug(f"ACN {acn} not in cache (offline)")
+        return None
+    
     try:
-        # Add jitter to delay between requests (anti-crawling)
-        delay = random.uniform(0.1, 0.7)
-        time.sleep(delay)
-        
-        # Rotate user agent and get headers
-        headers = get_headers(token)
+        for attempt in range(MAX_RETRIES + 1):
+            if limiter is not None:
+                waited = time.monotonic()
+                limiter.acquire()
+                metrics.inc("snapr_rate_limit_wait_seconds_total", time.monotonic() - waited)
+            else:
+                # Add jitter to delay between requests (anti-crawling)
+                delay = random.uniform(0.1, 0.7)
+                time.sleep(delay)
+            
+            # Rotate user agent and get headers
+            headers = get_headers(token)
+            if cached is not None:
+                if cached["etag"]:
+                    headers["if-none-match"] = cached["etag"]
+                if cached["last_modified"]:
+                    headers["if-modified-since"] = cached["last_modified"]
+            
+            # Make the request
+            started = controller.acquire() if controller is not None else time.monotonic()
+            try:
+                response = session.get(url, headers=headers, timeout=10)
+            except BaseException:
+                if controller is not None:
+                    controller.release(started, None)
+                raise
+            if controller is not None:
+                controller.release(started, response.status_code)
+            metrics.observe("snapr_request_duration_seconds", time.monotonic() - started)
+            metrics.inc("snapr_requests_total", status=str(response.status_code))
+            metrics.inc("snapr_response_bytes_total", len(response.content))
+            
+            # Honor the server's rate limit, across all workers if they share a limiter
+            if response.status_code == 429 and attempt < MAX_RETRIES:
+                metrics.inc("snapr_request_retries_total", reason="429")
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                if limiter is not None:
+                    limiter.pause(retry_after)
+                else:
+                    time.sleep(retry_after)
+                continue
+            break
         
-        # Make the request
-        response = session.get(url, headers=headers, timeout=10)
+        # The cached copy is still current
+        if response.status_code == 304 and cached is not None:
+            cache.touch(acn)
+            logger.debug(f"ACN {acn} not modified, served from cache")
+            return json.loads(cached["body"])
         
         # Check for 404 error
         if response.status_code == 404:
-            logger.info(f"ACN {acn} not found (404)")
+            logger.debug(f"ACN {acn} not found (404)")
+            if cached is not None:
+                cache.delete(acn)
             return None
         
         # Check for 401 error (unauthorized)
@@ -301,7 +1176,9 @@ def query_acn(session: requests.Session, acn: str, token: str) -> Dict:
         
         # Parse the JSON response
         data = response.json()
-        logger.info(f"Successfully queried ACN {acn}")
+        logger.debug(f"Successfully queried ACN {acn}")
+        if cache is not None:
+            cache.put(acn, response, data)
         return data
         
     except requests.exceptions.HTTPError as e:
@@ -311,67 +1188,1113 @@ def query_acn(session: requests.Session, acn: str, token: str) -> Dict:
             logger.warning(f"Unauthorized (401) for ACN {acn} - token may have expired")
             return {"acn": acn, "error": {"status": 401, "message": "Unauthorized"}}
         logger.error(f"HTTP error occurred for ACN {acn}: {e}")
-        # Return empty data with just the ACN for non-404 errors after retries
-        return {"acn": acn}
+        return {"acn": acn, "error": {"status": e.response.status_code, "message": str(e)}}
     except requests.exceptions.RequestException as e:
+        metrics.inc("snapr_requests_total", status="error")
         logger.error(f"Request error occurred for ACN {acn}: {e}")
-        return {"acn": acn}
+        return {"acn": acn, "error": {"status": None, "message": str(e)}}
     except json.JSONDecodeError as e:
         logger.error(f"JSON decode error occurred for ACN {acn}: {e}")
-        return {"acn": acn}
+        return {"acn": acn, "error": {"status": response.status_code, "message": f"Invalid JSON: {e}"}}
     except Exception as e:
         logger.error(f"Unexpected error occurred for ACN {acn}: {e}")
-        return {"acn": acn}
+        return {"acn": acn, "error": {"status": None, "message": str(e)}}
 
-def decrement_acn(acn: str) -> str:
+def is_unauthorized(data: Optional[Dict]) -> bool:
+    """Check whether a query_acn result is a 401 marker."""
+    return isinstance(data, dict) and "error" in data and data["error"].get("status") == 401
+
+class BrokerTokenClient:
     """
-    Decrement the ACN number.
+    Token source that gets access tokens from a shared token broker.
+    
+    Has the same interface as TokenManager, so crawler processes can use
+    either. Tokens are cached locally until shortly before they expire, and
+    a rejected token is reported to the broker, which refreshes it once no
+    matter how many processes report it.
+    """
+    
+    def __init__(self, broker_url: str, session: requests.Session, secret: Optional[str] = None):
+        self.broker_url = broker_url.rstrip("/")
+        self.session = session
+        self.headers = {"Authorization": f"Bearer {secret}"} if secret else {}
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+    
+    def _call(self, method: str, path: str, payload: Optional[Dict] = None) -> Optional[str]:
+        try:
+            response = self.session.request(method, f"{self.broker_url}{path}", json=payload, headers=self.headers, timeout=60)
+            response.raise_for_status()
+            token_data = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(f"Token broker at {self.broker_url} failed: {e}")
+            return None
+        self._token = token_data["access_token"]
+        self._expires_at = token_data["expires_at"]
+        return self._token
+    
+    def get(self) -> Optional[str]:
+        """Return a valid access token from the local cache or the broker."""
+        with self._lock:
+            if self._token is not None and time.time() < self._expires_at - 30:
+                return self._token
+            return self._call("GET", "/token")
+    
+    def invalidate(self, stale_token: Optional[str]) -> Optional[str]:
+        """Report a rejected token to the broker and get its replacement."""
+        with self._lock:
+            if self._token != stale_token and time.time() < self._expires_at - 30:
+                return self._token
+            return self._call("POST", "/invalidate", {"token": stale_token})
+    
+    def start(self) -> None:
+        """Nothing to do; the broker refreshes tokens in the background."""
+    
+    def stop(self) -> None:
+        """Nothing to do; the broker refreshes tokens in the background."""
+
+def make_token_source(session: requests.Session, token: Optional[str] = None, broker_url: Optional[str] = None) -> Union[TokenManager, BrokerTokenClient]:
+    """
+    Create the token source for a crawl.
     
     Args:
-        acn: The ACN to decrement (format: Z#######)
+        session: The requests session
+        token: An access token given on the command line
+        broker_url: The URL of a shared token broker, if one should be used
         
     Returns:
-        The decremented ACN
+        A BrokerTokenClient if a broker URL is given, otherwise a TokenManager
     """
-    prefix = acn[0]  # Should be 'Z'
-    number = int(acn[1:])
-    return f"{prefix}{number - 1}"
+    if broker_url:
+        logger.info(f"Using token broker at {broker_url}")
+        return BrokerTokenClient(broker_url, session, os.environ.get("SNAPR_SECRET"))
+    return TokenManager(session, token)
 
-def save_state(current_acn: str, output_path: Path, count: int) -> None:
+class TokenBrokerHandler(BaseHTTPRequestHandler):
     """
-    Save the current state to a file.
+    HTTP handler for the token broker.
     
-    Args:
-        current_acn: The current ACN
-        output_path: The output path for the CSV file
-        count: The number of records processed so far
+    GET /token returns the cached access token and POST /invalidate with
+    {"token": ...} replaces a rejected one. Both answer with
+    {"access_token": ..., "expires_at": ...}. If a secret is set, requests
+    must carry it as "Authorization: Bearer <secret>".
     """
-    save_data = {
-        "current_acn": current_acn,
-        "output_path": str(output_path),
-        "count": count,
-        "timestamp": time.time()
-    }
     
-    try:
-        with open(SAVE_POINT_FILE, 'w') as f:
-            json.dump(save_data, f)
-        logger.info(f"Saved state to {SAVE_POINT_FILE}")
-    except Exception as e:
-        logger.error(f"Failed to save state: {e}")
+    tokens: TokenManager
+    secret: Optional[str] = None
+    
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"Token broker: {format % args}")
+    
+    def _authorized(self) -> bool:
+        if not self.secret:
+            return True
+        if hmac.compare_digest(self.headers.get("Authorization", "").encode(), f"Bearer {self.secret}".encode()):
+            return True
+        logger.warning(f"Rejected request for {self.path} from {self.client_address[0]} without the secret")
+        self.send_error(401, "Missing or wrong secret")
+        return False
+    
+    def _reply(self, token: Optional[str]) -> None:
+        if token is None:
+            self.send_error(503, "Could not obtain an access token")
+            return
+        body = json.dumps({"access_token": token, "expires_at": self.tokens.expires_at}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_GET(self) -> None:
+        if self.path != "/token":
+            self.send_error(404)
+            return
+        if not self._authorized():
+            return
+        self._reply(self.tokens.get())
+    
+    def do_POST(self) -> None:
+        if self.path != "/invalidate":
+            self.send_error(404)
+            return
+        if not self._authorized():
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self.send_error(400, "Invalid JSON")
+            return
+        logger.info("Token reported as rejected by a crawler")
+        self._reply(self.tokens.invalidate(payload.get("token")))
 
-def load_state() -> Optional[Dict]:
+def start_token_broker(tokens: TokenManager, host: str = "127.0.0.1", port: int = 0,
+                       secret: Optional[str] = None) -> ThreadingHTTPServer:
     """
-    Load the saved state from a file.
+    Serve tokens from a TokenManager over HTTP in a background thread.
     
+    Args:
+        tokens: The token manager that owns the refresh token
+        host: The address to listen on
+        port: The port to listen on (0 picks a free port)
+        secret: The shared secret clients must send, if any
+        
     Returns:
-        The saved state as a dictionary or None if no state is found
+        The running server; its port is server.server_port
     """
-    if not SAVE_POINT_FILE.exists():
-        return None
+    handler = type("BoundTokenBrokerHandler", (TokenBrokerHandler,), {"tokens": tokens, "secret": secret})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="token-broker", daemon=True).start()
+    return server
+
+def check_listen_address(host: str, secret: Optional[str]) -> None:
+    """
+    Refuse to hand out tokens on a non-loopback address without a secret.
     
-    try:
-        with open(SAVE_POINT_FILE, 'r') as f:
+    Args:
+        host: The address the server will listen on
+        secret: The shared secret clients must send, if any
+    """
+    if not secret and host not in ("127.0.0.1", "localhost", "::1"):
+        raise typer.BadParameter(f"--secret (or SNAPR_SECRET) is required to listen on {host}")
+
+def fetch_acn(
+    session: requests.Session,
+    acn: str,
+    tokens: Union[TokenManager, BrokerTokenClient],
+    limiter: Optional[RateLimiter] = None,
+    cache: Optional[ResponseCache] = None,
+    missing: Optional["NegativeCache"] = None,
+    controller: Optional[ConcurrencyController] = None,
+) -> Optional[Dict]:
+    """
+    Query an ACN, re-authenticating once if the token is rejected.
+    
+    Args:
+        session: The requests session
+        acn: The ACN to query
+        tokens: The token source that supplies access tokens
+        limiter: Optional shared rate limiter
+        cache: Optional response cache
+        missing: Optional negative cache; known-missing ACNs are not requested
+        controller: Optional adaptive concurrency limit
+        
+    Returns:
+        The query_acn result; still a 401 marker if no new token could be obtained
+    """
+    if missing is not None and missing.is_missing(acn):
+        logger.debug(f"ACN {acn} is known to be missing, skipping request")
+        return None
+    data = _fetch_acn(session, acn, tokens, limiter, cache, controller)
+    # Offline cache misses say nothing about the server
+    if missing is not None and not (cache is not None and cache.offline):
+        if data is None:
+            missing.add(acn)
+        elif not is_error_result(data):
+            missing.mark_live(acn)
+    return data
+
+def _fetch_acn(
+    session: requests.Session,
+    acn: str,
+    tokens: Union[TokenManager, BrokerTokenClient],
+    limiter: Optional[RateLimiter],
+    cache: Optional[ResponseCache],
+    controller: Optional[ConcurrencyController] = None,
+) -> Optional[Dict]:
+    token = tokens.get()
+    if token is None:
+        return {"acn": acn, "error": {"status": 401, "message": "No access token"}}
+    data = query_acn(session, acn, token, limiter, cache, controller)
+    if is_unauthorized(data):
+        logger.warning("Token rejected (401 Unauthorized). Refreshing...")
+        token = tokens.invalidate(token)
+        if token is not None:
+            metrics.inc("snapr_request_retries_total", reason="401")
+            data = query_acn(session, acn, token, limiter, cache, controller)
+    return data
+
+def fetch_in_order(
+    fetch: Callable[[str], Optional[Dict]],
+    acns: Iterator[str],
+    workers: int = 1,
+) -> Iterator[Tuple[str, Optional[Dict]]]:
+    """
+    Fetch ACNs with up to `workers` requests in flight and yield the results in ACN order.
+    
+    With a single worker this is a plain sequential loop. Otherwise a sliding
+    window of futures is kept full; results are yielded strictly in the order
+    of `acns`, so callers can stop, checkpoint and write exactly as they would
+    sequentially. Closing the generator cancels everything still queued.
+    
+    Args:
+        fetch: The function that fetches a single ACN
+        acns: The ACNs to fetch, in order
+        workers: The maximum number of requests in flight
+        
+    Yields:
+        Tuples of (acn, result)
+    """
+    acns = iter(acns)
+    if workers <= 1:
+        for acn in acns:
+            yield acn, fetch(acn)
+        return
+    
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch")
+    window = deque()
+    try:
+        for acn in islice(acns, workers):
+            window.append((acn, pool.submit(fetch, acn)))
+        while window:
+            acn, future = window.popleft()
+            result = future.result()
+            # Refill the window before handing the result to the caller
+            for next_acn in islice(acns, 1):
+                window.append((next_acn, pool.submit(fetch, next_acn)))
+            yield acn, result
+    finally:
+        for _, future in window:
+            future.cancel()
+        pool.shutdown(wait=True)
+
+# Marks the end of a pipeline stage's output
+_END_OF_STAGE = object()
+
+class PipelineStage:
+    """
+    One stage of a Pipeline, running on its own thread.
+    
+    The stage iterates `source` or takes items from the previous stage's queue,
+    passes each to `handler` and puts whatever it returns on its own queue.
+    Time spent working, waiting for input and blocked on a full output queue
+    is counted separately: the stage that is busy while the others wait is
+    the bottleneck.
+    """
+    
+    def __init__(self, name: str, handler: Optional[Callable] = None, source: Optional[Iterator] = None):
+        self.name = name
+        self.handler = handler
+        self.source = source
+        self.inbox: Optional[Queue] = None
+        self.outbox: Optional[Queue] = None
+        self.stop_event: Optional[threading.Event] = None
+        self.error: Optional[BaseException] = None
+        self.items = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+        self.blocked = 0.0
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name=f"stage-{name}", daemon=True)
+    
+    def _emit(self, item) -> None:
+        if self.outbox is None:
+            return
+        started = time.monotonic()
+        self.outbox.put(item)
+        self.blocked += time.monotonic() - started
+    
+    def _items(self) -> Iterator:
+        if self.inbox is None:
+            # Producing items is this stage's work
+            while not self.stop_event.is_set():
+                started = time.monotonic()
+                item = next(self.source, _END_OF_STAGE)
+                self.busy += time.monotonic() - started
+                if item is _END_OF_STAGE:
+                    return
+                yield item
+            return
+        while True:
+            started = time.monotonic()
+            item = self.inbox.get()
+            self.waiting += time.monotonic() - started
+            if item is _END_OF_STAGE:
+                return
+            yield item
+    
+    def _run(self) -> None:
+        self._started = time.monotonic()
+        items = self._items()
+        try:
+            for item in items:
+                self.items += 1
+                if self.handler is None:
+                    self._emit(item)
+                    continue
+                started = time.monotonic()
+                results = self.handler(item)
+                for result in results or ():
+                    self.busy += time.monotonic() - started
+                    self._emit(result)
+                    started = time.monotonic()
+                self.busy += time.monotonic() - started
+        except BaseException as e:
+            self.error = e
+            logger.error(f"Pipeline stage {self.name} failed: {e}")
+            self.stop_event.set()
+            # Keep consuming so the stage feeding this one never blocks
+            for _ in items:
+                pass
+        finally:
+            if self.inbox is None and hasattr(self.source, "close"):
+                self.source.close()
+            self._emit(_END_OF_STAGE)
+    
+    def start(self) -> None:
+        self._thread.start()
+    
+    def join(self, timeout: Optional[float] = None) -> None:
+        self._thread.join(timeout)
+    
+    def is_alive(self) -> bool:
+        return self._thread.is_alive()
+    
+    def summary(self) -> str:
+        """Describe the stage's throughput and where its time went."""
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        parts = [f"{self.name}: {self.items} items ({self.items / elapsed:.1f}/s)", f"busy {self.busy / elapsed:.0%}"]
+        if self.inbox is not None:
+            parts.append(f"waiting {self.waiting / elapsed:.0%}")
+        if self.outbox is not None:
+            parts.append(f"blocked {self.blocked / elapsed:.0%}, queued {self.outbox.qsize()}")
+        return ", ".join(parts)
+
+class Pipeline:
+    """
+    Stages connected by bounded queues, each running on its own thread.
+    
+    A full queue blocks the stage feeding it, so a slow stage slows the ones
+    before it instead of letting work pile up in memory. stop() ends the
+    source stage; everything it already produced still flows through the
+    remaining stages.
+    """
+    
+    def __init__(self, queue_size: int = DEFAULT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self.stages: List[PipelineStage] = []
+        self.stop_event = threading.Event()
+    
+    def add(self, stage: PipelineStage) -> PipelineStage:
+        """Append a stage that takes its input from the last stage added."""
+        stage.stop_event = self.stop_event
+        if self.stages:
+            self.stages[-1].outbox = Queue(maxsize=self.queue_size)
+            stage.inbox = self.stages[-1].outbox
+        self.stages.append(stage)
+        return stage
+    
+    def stop(self) -> None:
+        """Stop producing new items."""
+        self.stop_event.set()
+    
+    def log_summary(self) -> None:
+        logger.info("Pipeline: " + "; ".join(stage.summary() for stage in self.stages))
+    
+    def run(self, report_interval: Optional[float] = None) -> None:
+        """
+        Run every stage until all items have passed through.
+        
+        Args:
+            report_interval: Log the stage counters every N seconds
+            
+        Raises:
+            The first error raised by a stage
+        """
+        for stage in self.stages:
+            stage.start()
+        last_report = time.monotonic()
+        try:
+            for stage in self.stages:
+                while stage.is_alive():
+                    stage.join(0.5)
+                    if report_interval and time.monotonic() - last_report >= report_interval:
+                        self.log_summary()
+                        last_report = time.monotonic()
+        except KeyboardInterrupt:
+            # Let what was fetched so far reach the sink
+            self.stop()
+            for stage in self.stages:
+                stage.join()
+            raise
+        for stage in self.stages:
+            if stage.error is not None:
+                raise stage.error
+
+def decrement_acn(acn: str) -> str:
+    """
+    Decrement the ACN number.
+    
+    Args:
+        acn: The ACN to decrement (format: Z#######)
+        
+    Returns:
+        The decremented ACN
+    """
+    prefix = acn[0]  # Should be 'Z'
+    number = int(acn[1:])
+    return f"{prefix}{number - 1}"
+
+def iter_acns(start_acn: str) -> Iterator[str]:
+    """
+    Generate ACNs from the start ACN downwards.
+    
+    Args:
+        start_acn: The first ACN to yield
+        
+    Yields:
+        The start ACN followed by each decremented ACN
+    """
+    acn = start_acn
+    while True:
+        yield acn
+        acn = decrement_acn(acn)
+
+def write_json_atomic(path: Path, data: Dict) -> None:
+    """
+    Write JSON to a file so readers only ever see the old or the new content.
+    
+    Args:
+        path: The file to write
+        data: The data to serialize
+    """
+    # Unique per writer so parallel crawlers in one directory don't collide
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+@contextmanager
+def file_lock(path: Path) -> Iterator[None]:
+    """
+    Hold an exclusive lock on a file shared by several crawler processes.
+    
+    The lock is taken on a .lock sidecar because write_json_atomic replaces
+    the file itself. Hold it across reading, merging and writing the file.
+    
+    Args:
+        path: The shared file
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_name(f"{path.name}.lock"), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def acn_to_int(acn: str) -> int:
+    """Return the numeric part of an ACN (format: Z#######)."""
+    return int(acn[1:])
+
+def int_to_acn(number: int, prefix: str = "Z") -> str:
+    """Build an ACN from its numeric part."""
+    return f"{prefix}{number}"
+
+class IntervalSet:
+    """
+    Set of integers stored as sorted, disjoint, closed ranges.
+    
+    Adjacent and overlapping ranges are merged on insert, so a crawl over
+    millions of consecutive ACNs is kept as a handful of ranges.
+    """
+    
+    def __init__(self, ranges: Optional[List[Tuple[int, int]]] = None):
+        self._starts: List[int] = []
+        self._ends: List[int] = []
+        for lo, hi in ranges or []:
+            self.add_range(lo, hi)
+    
+    def add_range(self, lo: int, hi: int) -> None:
+        """Add every integer from lo to hi inclusive."""
+        # Ranges that overlap or touch [lo, hi] are [i, j)
+        i = bisect_left(self._ends, lo - 1)
+        j = bisect_right(self._starts, hi + 1)
+        if i < j:
+            lo = min(lo, self._starts[i])
+            hi = max(hi, self._ends[j - 1])
+        self._starts[i:j] = [lo]
+        self._ends[i:j] = [hi]
+    
+    def add(self, number: int) -> None:
+        """Add a single integer."""
+        self.add_range(number, number)
+    
+    def discard_range(self, lo: int, hi: int) -> None:
+        """Remove every integer from lo to hi inclusive."""
+        i = bisect_left(self._ends, lo)
+        j = bisect_right(self._starts, hi)
+        if i >= j:
+            return
+        starts, ends = [], []
+        if self._starts[i] < lo:
+            starts.append(self._starts[i])
+            ends.append(lo - 1)
+        if self._ends[j - 1] > hi:
+            starts.append(hi + 1)
+            ends.append(self._ends[j - 1])
+        self._starts[i:j] = starts
+        self._ends[i:j] = ends
+    
+    def discard(self, number: int) -> None:
+        """Remove a single integer."""
+        self.discard_range(number, number)
+    
+    def __contains__(self, number: int) -> bool:
+        i = bisect_right(self._starts, number) - 1
+        return i >= 0 and self._ends[i] >= number
+    
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        return iter(zip(self._starts, self._ends))
+    
+    def __len__(self) -> int:
+        return sum(hi - lo + 1 for lo, hi in self)
+    
+    def __bool__(self) -> bool:
+        return bool(self._starts)
+    
+    def union(self, other: "IntervalSet") -> "IntervalSet":
+        """Return a new set with the integers of both sets."""
+        result = IntervalSet(list(self))
+        for lo, hi in other:
+            result.add_range(lo, hi)
+        return result
+    
+    def missing(self, lo: int, hi: int) -> "IntervalSet":
+        """Return the integers from lo to hi inclusive that are not in the set."""
+        result = IntervalSet([(lo, hi)])
+        for start, end in self:
+            if end >= lo and start <= hi:
+                result.discard_range(start, end)
+        return result
+    
+    def bounds(self) -> Optional[Tuple[int, int]]:
+        """Return the lowest and highest integer, or None if the set is empty."""
+        if not self._starts:
+            return None
+        return self._starts[0], self._ends[-1]
+
+class Journal:
+    """
+    Append-only journal of per-ACN crawl outcomes.
+    
+    Each line records one outcome: "ok", "404", "error" or "401". The latest
+    outcome for an ACN wins. Outcomes are held in memory as one IntervalSet per
+    outcome, and `compact` rewrites the file as a single line of ranges. Lines
+    are buffered and appended by `flush`, which callers run after the records
+    they describe are on disk, so the journal never claims more than was saved.
+    Several crawlers may append to the same journal, but only compact it while
+    none are running.
+    """
+    
+    OUTCOMES = ("ok", "404", "error", "401")
+    
+    def __init__(self, path: Path):
+        self.path = path
+        self.prefix = "Z"
+        self.outcomes = {outcome: IntervalSet() for outcome in self.OUTCOMES}
+        self._pending: List[str] = []
+        self._load()
+    
+    def _load(self) -> None:
+        if not self.path.exists():
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash can leave a partial last line
+                    logger.warning(f"Skipping malformed line in {self.path}")
+                    continue
+                if "compacted" in entry:
+                    self.prefix = entry.get("prefix", self.prefix)
+                    for outcome, ranges in entry["compacted"].items():
+                        for lo, hi in ranges:
+                            self._apply(lo, hi, outcome)
+                else:
+                    self.prefix = entry["acn"][0]
+                    number = acn_to_int(entry["acn"])
+                    self._apply(number, number, entry["outcome"])
+    
+    def _apply(self, lo: int, hi: int, outcome: str) -> None:
+        for name, ranges in self.outcomes.items():
+            if name == outcome:
+                ranges.add_range(lo, hi)
+            else:
+                ranges.discard_range(lo, hi)
+    
+    def record(self, acn: str, outcome: str) -> None:
+        """
+        Record the outcome for an ACN.
+        
+        Args:
+            acn: The ACN
+            outcome: One of "ok", "404", "error" or "401"
+        """
+        number = acn_to_int(acn)
+        self.prefix = acn[0]
+        self._apply(number, number, outcome)
+        self._pending.append(json.dumps({"acn": acn, "outcome": outcome, "ts": round(time.time(), 3)}))
+    
+    def flush(self) -> None:
+        """Append the buffered outcomes to the journal file and sync it."""
+        if not self._pending:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a') as f:
+            # Several crawler processes may share one journal
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write("\n".join(self._pending) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending = []
+    
+    def compact(self) -> None:
+        """Rewrite the journal as a single line of outcome ranges."""
+        self.flush()
+        write_json_atomic(self.path, {
+            "compacted": {outcome: [list(r) for r in ranges] for outcome, ranges in self.outcomes.items()},
+            "prefix": self.prefix,
+            "ts": round(time.time(), 3),
+        })
+    
+    def done(self) -> IntervalSet:
+        """Return the ACNs that were fetched or confirmed missing."""
+        return self.outcomes["ok"].union(self.outcomes["404"])
+    
+    def is_saved(self, acn: str) -> bool:
+        """Check whether the record for an ACN has been saved."""
+        return acn_to_int(acn) in self.outcomes["ok"]
+
+class NegativeCache:
+    """
+    Persistent record of ACNs that returned 404, with a TTL.
+    
+    Missing ACNs are kept as IntervalSets bucketed by the hour they were
+    checked, so a sparse range costs a few ranges per hour and whole buckets
+    expire at once. ACNs above the highest live ACN seen are never treated as
+    missing, because that is where new applications appear. Safe to share
+    between fetch threads, and between processes: save() merges with what
+    other processes saved under a file lock.
+    """
+    
+    BUCKET_SECONDS = 3600
+    
+    def __init__(self, path: Path, ttl: float, recheck: bool = False):
+        self.path = path
+        self.ttl = ttl
+        # Still record 404s, but don't skip any requests
+        self.recheck = recheck
+        self.highest_live = 0
+        self.skipped = 0
+        self._buckets: Dict[int, IntervalSet] = {}
+        # ACN numbers found live since the last save, to remove from the file
+        self._live = set()
+        self._lock = threading.Lock()
+        self._dirty = False
+        self.highest_live, self._buckets = self._read()
+        self._expire()
+    
+    def _read(self) -> Tuple[int, Dict[int, IntervalSet]]:
+        if not self.path.exists():
+            return 0, {}
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            buckets = {int(bucket): IntervalSet([tuple(r) for r in ranges]) for bucket, ranges in data.get("buckets", {}).items()}
+            return data.get("highest_live", 0), buckets
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load negative cache {self.path}: {e}")
+            return 0, {}
+    
+    def _expired(self, bucket: int, now: float) -> bool:
+        # A bucket lives until its newest possible entry is older than the TTL
+        return bucket + self.BUCKET_SECONDS < now - self.ttl
+    
+    def _expire(self) -> None:
+        now = time.time()
+        for bucket in [b for b in self._buckets if self._expired(b, now)]:
+            del self._buckets[bucket]
+            self._dirty = True
+    
+    def is_missing(self, acn: str) -> bool:
+        """Check whether an ACN is known to be missing and can be skipped."""
+        if self.recheck:
+            return False
+        number = acn_to_int(acn)
+        with self._lock:
+            if number > self.highest_live:
+                return False
+            now = time.time()
+            missing = any(number in ranges for bucket, ranges in self._buckets.items() if not self._expired(bucket, now))
+            if missing:
+                self.skipped += 1
+        return missing
+    
+    def add(self, acn: str) -> None:
+        """Record that an ACN returned 404."""
+        number = acn_to_int(acn)
+        self.add_range(number, number)
+    
+    def add_range(self, lo: int, hi: int) -> None:
+        """Record that every ACN number from lo to hi returned 404."""
+        bucket = int(time.time() // self.BUCKET_SECONDS * self.BUCKET_SECONDS)
+        with self._lock:
+            self._buckets.setdefault(bucket, IntervalSet()).add_range(lo, hi)
+            self._dirty = True
+    
+    def mark_live(self, acn: str) -> None:
+        """Record that an ACN exists."""
+        number = acn_to_int(acn)
+        with self._lock:
+            if number > self.highest_live:
+                self.highest_live = number
+            for ranges in self._buckets.values():
+                ranges.discard(number)
+            # Another process may have recorded it as missing
+            self._live.add(number)
+            self._dirty = True
+    
+    def save(self) -> None:
+        """Merge the cache with the file on disk and write it, if it changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                with file_lock(self.path):
+                    # Other processes may have saved since we loaded
+                    highest_live, buckets = self._read()
+                    for bucket, ranges in self._buckets.items():
+                        buckets[bucket] = buckets[bucket].union(ranges) if bucket in buckets else ranges
+                    for number in self._live:
+                        for ranges in buckets.values():
+                            ranges.discard(number)
+                    self.highest_live = max(self.highest_live, highest_live)
+                    self._buckets = buckets
+                    self._expire()
+                    write_json_atomic(self.path, {
+                        "highest_live": self.highest_live,
+                        "buckets": {str(bucket): [list(r) for r in ranges] for bucket, ranges in self._buckets.items() if ranges},
+                    })
+                self._live.clear()
+                self._dirty = False
+            except OSError as e:
+                logger.error(f"Failed to save negative cache {self.path}: {e}")
+    
+    def close(self) -> None:
+        """Save the cache and report how many requests it saved."""
+        self.save()
+        if self.skipped:
+            logger.info(f"Negative cache: skipped {self.skipped} known-missing ACNs")
+
+def open_negative_cache(path: Optional[Path], ttl: str = DEFAULT_MISSING_TTL, recheck: bool = False) -> Optional[NegativeCache]:
+    """
+    Open the negative cache for a command.
+    
+    Args:
+        path: The --missing-cache path, or None to disable it
+        ttl: How long a 404 is trusted, e.g. "7d"
+        recheck: Request known-missing ACNs again anyway
+        
+    Returns:
+        The negative cache or None if disabled
+    """
+    if path is None:
+        return None
+    return NegativeCache(path, parse_duration(ttl), recheck)
+
+class RetryQueue:
+    """
+    Persistent queue of ACNs whose request failed, retried later with backoff.
+    
+    Failed ACNs are parked here instead of being retried inline, so a crawl
+    keeps moving. Each failure doubles the wait before the next attempt, from
+    RETRY_BACKOFF up to RETRY_MAX_BACKOFF. After MAX_RETRY_ATTEMPTS failures an
+    ACN is given up on and only retried with retry-failed --all. Safe to share
+    between fetch threads, and between processes: save() merges with what
+    other processes saved under a file lock.
+    """
+    
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dirty = False
+        # ACNs added or removed since the last save, to apply to the file
+        self._changed = set()
+        self.entries: Dict[str, Dict] = self._read()
+    
+    def _read(self) -> Dict[str, Dict]:
+        if not self.path.exists():
+            return {}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f).get("entries", {})
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load retry queue {self.path}: {e}")
+            return {}
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def __contains__(self, acn: str) -> bool:
+        return acn in self.entries
+    
+    def add(self, acn: str, error: Optional[Dict], immediate: bool = False) -> None:
+        """
+        Record a failed attempt and schedule the next one.
+        
+        Args:
+            acn: The ACN that failed
+            error: The "error" part of the query_acn result
+            immediate: Make the next attempt due right away
+        """
+        now = time.time()
+        with self._lock:
+            entry = self.entries.setdefault(acn, {"attempts": 0, "first_failed": round(now, 3)})
+            entry["attempts"] += 1
+            entry["error"] = error
+            delay = 0 if immediate else min(RETRY_BACKOFF * 2 ** (entry["attempts"] - 1), RETRY_MAX_BACKOFF)
+            entry["next_at"] = round(now + delay, 3)
+            self._changed.add(acn)
+            self._dirty = True
+    
+    def remove(self, acn: str) -> None:
+        """Drop an ACN that no longer needs retrying."""
+        with self._lock:
+            if self.entries.pop(acn, None) is not None:
+                self._changed.add(acn)
+                self._dirty = True
+    
+    def due(self, everything: bool = False) -> List[str]:
+        """
+        Return the ACNs whose next attempt is due, highest first.
+        
+        Args:
+            everything: Ignore the schedule and include ACNs given up on
+        """
+        now = time.time()
+        with self._lock:
+            acns = [
+                acn for acn, entry in self.entries.items()
+                if everything or (entry["next_at"] <= now and entry["attempts"] < MAX_RETRY_ATTEMPTS)
+            ]
+        return sorted(acns, key=acn_to_int, reverse=True)
+    
+    def exhausted(self) -> List[str]:
+        """Return the ACNs that have been given up on."""
+        with self._lock:
+            return [acn for acn, entry in self.entries.items() if entry["attempts"] >= MAX_RETRY_ATTEMPTS]
+    
+    def save(self) -> None:
+        """Merge the queue with the file on disk and write it, if it changed."""
+        with self._lock:
+            if not self._dirty:
+                return
+            try:
+                with file_lock(self.path):
+                    # Other processes may have saved since we loaded
+                    entries = self._read()
+                    for acn in self._changed:
+                        if acn in self.entries:
+                            entries[acn] = self.entries[acn]
+                        else:
+                            entries.pop(acn, None)
+                    self.entries = entries
+                    write_json_atomic(self.path, {"entries": dict(entries)})
+                self._changed.clear()
+                self._dirty = False
+            except OSError as e:
+                logger.error(f"Failed to save retry queue {self.path}: {e}")
+
+def open_retry_queue(path: Optional[Path]) -> Optional[RetryQueue]:
+    """
+    Open the retry queue for a command.
+    
+    Args:
+        path: The --retry-queue path, or None to disable it
+        
+    Returns:
+        The retry queue or None if disabled
+    """
+    if path is None:
+        return None
+    return RetryQueue(path)
+
+def drain_retry_queue(
+    queue: RetryQueue,
+    fetch: Callable[[str], Optional[Dict]],
+    sink: "BatchSink",
+    journal: Journal,
+    workers: int = 1,
+    everything: bool = False,
+    include: Optional[List[str]] = None,
+) -> Dict[str, int]:
+    """
+    Retry the due ACNs of a retry queue once each.
+    
+    Recovered records are written to the sink, ACNs that turn out to be
+    missing are dropped, and ACNs that fail again are rescheduled.
+    
+    Args:
+        queue: The retry queue
+        fetch: Fetches one ACN, like fetch_acn
+        sink: Where recovered records are written
+        journal: The journal to record outcomes in
+        workers: Number of requests in flight
+        everything: Ignore the schedule and retry every queued ACN
+        include: Queued ACNs to retry as well even if they are not due yet
+        
+    Returns:
+        The number of ACNs per outcome ("ok", "404" and "error")
+    """
+    counts = {"ok": 0, "404": 0, "error": 0}
+    acns = queue.due(everything)
+    if include:
+        acns = sorted(set(acns).union(acn for acn in include if acn in queue), key=acn_to_int, reverse=True)
+    if not acns:
+        return counts
+    logger.info(f"Retrying {len(acns)} failed ACN(s)")
+    results_in_order = fetch_in_order(fetch, acns, workers)
+    try:
+        for acn, data in results_in_order:
+            if is_unauthorized(data):
+                logger.error("Failed to refresh token, stopping retries")
+                break
+            if data is None:
+                outcome = "404"
+                queue.remove(acn)
+            elif is_error_result(data):
+                outcome = "error"
+                queue.add(acn, data.get("error"))
+            else:
+                outcome = "ok"
+                sink.write(data)
+                queue.remove(acn)
+            journal.record(acn, outcome)
+            counts[outcome] += 1
+            if sink.should_flush():
+                sink.flush()
+                journal.flush()
+                queue.save()
+    finally:
+        results_in_order.close()
+        sink.flush()
+        journal.flush()
+        queue.save()
+    return counts
+
+def format_ranges(ranges: IntervalSet, prefix: str = "Z", limit: Optional[int] = None) -> str:
+    """
+    Format ranges as ACNs, highest first, e.g. "Z1860694-Z1860690, Z1860650".
+    
+    Args:
+        ranges: The ranges to format
+        prefix: The ACN prefix
+        limit: Show at most this many ranges
+        
+    Returns:
+        The formatted ranges
+    """
+    parts = [
+        int_to_acn(hi, prefix) if lo == hi else f"{int_to_acn(hi, prefix)}-{int_to_acn(lo, prefix)}"
+        for lo, hi in reversed(list(ranges))
+    ]
+    if limit is not None and len(parts) > limit:
+        parts = parts[:limit] + [f"... {len(parts) - limit} more"]
+    return ", ".join(parts) or "none"
+
+def probe_boundary(is_live: Callable[[int], bool], anchor: int, direction: int, max_gap: int) -> int:
+    """
+    Find the last live ACN number in one direction from a live anchor.
+    
+    Steps away from the anchor in exponentially growing strides until it
+    lands in a dead region, then bisects back to the boundary. A point only
+    counts as dead if it and the next `max_gap` numbers beyond it are all
+    missing, so holes up to that length are stepped over.
+    
+    Args:
+        is_live: Returns True if the ACN number exists
+        anchor: A live ACN number to start from
+        direction: 1 to search upwards, -1 to search downwards
+        max_gap: The longest hole to treat as part of the live range
+        
+    Returns:
+        The live ACN number furthest from the anchor in that direction
+    """
+    def find_live(start: int) -> Optional[int]:
+        for offset in range(max_gap + 1):
+            number = start + direction * offset
+            if number < 1:
+                return None
+            if is_live(number):
+                return number
+        return None
+    
+    # Gallop until a dead point is found
+    live = anchor
+    step = 1
+    while True:
+        dead = live + direction * step
+        found = find_live(dead)
+        if found is None:
+            break
+        live = found
+        step *= 2
+    
+    # Bisect between the furthest live point and the dead point
+    while abs(dead - live) > 1:
+        mid = live + direction * (abs(dead - live) // 2)
+        found = find_live(mid)
+        if found is None:
+            dead = mid
+        else:
+            live = found
+    return live
+
+def save_state(current_acn: str, output_path: Path, count: int, output_bytes: Optional[int] = None, store: Optional[str] = None, referrals_bytes: Optional[int] = None) -> None:
+    """
+    Save the current state to a file.
+    
+    Args:
+        current_acn: The current ACN
+        output_path: The output path for the CSV file
+        count: The number of records processed so far
+        output_bytes: The size of the output file that matches this state, if known
+        store: The result store spec if results go to a store instead of the CSV file
+        referrals_bytes: The size of the referrals sidecar that matches this state, if known
+    """
+    save_data = {
+        "current_acn": current_acn,
+        "output_path": str(output_path),
+        "count": count,
+        "timestamp": time.time()
+    }
+    if output_bytes is not None:
+        save_data["output_bytes"] = output_bytes
+    if store is not None:
+        save_data["store"] = store
+    if referrals_bytes is not None:
+        save_data["referrals_bytes"] = referrals_bytes
+    
+    try:
+        write_json_atomic(SAVE_POINT_FILE, save_data)
+        logger.info(f"Saved state to {SAVE_POINT_FILE}")
+    except Exception as e:
+        logger.error(f"Failed to save state: {e}")
+
+def load_state() -> Optional[Dict]:
+    """
+    Load the saved state from a file.
+    
+    Returns:
+        The saved state as a dictionary or None if no state is found
+    """
+    if not SAVE_POINT_FILE.exists():
+        return None
+    
+    try:
+        with open(SAVE_POINT_FILE, 'r') as f:
             state = json.load(f)
         logger.info(f"Loaded state from {SAVE_POINT_FILE}")
         return state
@@ -456,25 +2379,931 @@ def save_to_csv(results: List[Dict], output_path: Path) -> None:
     except Exception as e:
         logger.error(f"Failed to save results to CSV: {e}")
 
-@app.command("update-curl")
-def update_curl(
-    curl_command: str = typer.Argument(..., help="The curl command to use for token refresh"),
-):
+class BatchSink:
     """
-    Update the curl command used for token refresh.
+    Base class for sinks that buffer records and write them in batches.
     
-    The curl command should be a complete curl command that can be used to get a new token.
-    Example:
-        ./query.py update-curl "curl 'https://bisexternal.ciamlogin.com/16a0fd8f-4db1-4496-8036-56968f632d98/oauth2/v2.0/token' -H 'Accept: */*' ... --data-raw '...'"
+    Records are buffered until `batch_size` is reached or `flush_interval`
+    seconds have passed. Subclasses implement `_write_batch`. `size` is the
+    byte length of the output after the last flush for sinks where that
+    identifies a checkpoint, or None where writes are idempotent.
     """
-    logger.info("Updating curl command...")
     
-    # Set debug logging temporarily to see what's happening
-    original_level = logger.level
-    logger.setLevel(logging.DEBUG)
+    size: Optional[int] = None
+    referrals_size: Optional[int] = None
     
-    # Remove backslashes used for line continuation
-    curl_command = curl_command.replace("\\\n", " ")
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE, flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: List[Dict] = []
+        self._last_flush = time.monotonic()
+    
+    def write(self, record: Dict) -> None:
+        """Buffer a record for the next flush."""
+        self._buffer.append(record)
+    
+    def should_flush(self) -> bool:
+        """Check whether the buffered batch is due to be written."""
+        if not self._buffer:
+            return False
+        return len(self._buffer) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval
+    
+    def flush(self) -> int:
+        """
+        Write the buffered records.
+        
+        Returns:
+            The number of records written
+        """
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return 0
+        self._write_batch(self._buffer)
+        written = len(self._buffer)
+        metrics.observe("snapr_sink_flush_duration_seconds", time.monotonic() - self._last_flush, sink=type(self).__name__)
+        metrics.inc("snapr_records_saved_total", written)
+        self._buffer = []
+        return written
+    
+    def _write_batch(self, records: List[Dict]) -> None:
+        raise NotImplementedError
+    
+    def close(self) -> None:
+        """Flush anything still buffered."""
+        self.flush()
+
+class CsvSink(BatchSink):
+    """
+    Stream records to a CSV file in batches.
+    
+    Each batch is appended and fsynced in one go. Storing `size` in the save
+    point lets a resume cut off rows written after the last checkpoint.
+    Referrals are also written as rows of a sidecar CSV (see referrals_path),
+    whose size is tracked the same way in `referrals_size`.
+    """
+    
+    def __init__(self, output_path: Path, batch_size: int = DEFAULT_BATCH_SIZE, flush_interval: float = DEFAULT_FLUSH_INTERVAL, referrals: bool = True):
+        super().__init__(batch_size, flush_interval)
+        self.output_path = output_path
+        self.fieldnames: Optional[List[str]] = None
+        self.size = output_path.stat().st_size if output_path.exists() else 0
+        self.referrals_path = referrals_path(output_path) if referrals else None
+        if self.referrals_path is not None:
+            self.referrals_size = self.referrals_path.stat().st_size if self.referrals_path.exists() else 0
+        # Keep an existing ACN index current as rows are appended
+        self.index = CsvIndex(output_path) if CsvIndex.index_path_for(output_path).exists() else None
+        self._dropped_keys = set()
+    
+    def _read_header(self) -> List[str]:
+        with open(self.output_path, 'r', newline='') as f:
+            return next(csv.reader(f), [])
+    
+    def _write_batch(self, records: List[Dict]) -> None:
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        new_file = self.size == 0
+        if self.fieldnames is None:
+            if not new_file:
+                self.fieldnames = self._read_header()
+            else:
+                keys = set(CSV_FIELDS)
+                for record in records:
+                    keys.update(record.keys())
+                self.fieldnames = sorted(keys)
+        
+        # Columns the file doesn't have can't be appended without corrupting it
+        for record in records:
+            extra = record.keys() - set(self.fieldnames) - self._dropped_keys
+            if extra:
+                logger.warning(f"Dropping fields not in {self.output_path} header: {sorted(extra)}")
+                self._dropped_keys.update(extra)
+        
+        with open(self.output_path, 'a+', newline='') as f:
+            if not new_file:
+                # Add a newline if needed to prevent data corruption
+                f.seek(self.size - 1)
+                if f.read(1) != '\n':
+                    f.write('\n')
+            writer = csv.DictWriter(f, fieldnames=self.fieldnames, extrasaction='ignore')
+            if new_file:
+                writer.writeheader()
+            writer.writerows(records)
+            f.flush()
+            os.fsync(f.fileno())
+            self.size = f.tell()
+        
+        if self.referrals_path is not None:
+            with open(self.referrals_path, 'a', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=REFERRAL_FIELDS)
+                if self.referrals_size == 0:
+                    writer.writeheader()
+                for record in records:
+                    writer.writerows(referral_rows(record))
+                f.flush()
+                os.fsync(f.fileno())
+                self.referrals_size = f.tell()
+        
+        if self.index is not None:
+            self.index.update()
+        
+        logger.debug(f"Flushed {len(records)} records to {self.output_path}")
+
+class NdjsonSink(BatchSink):
+    """
+    Stream records to a newline-delimited JSON file in batches.
+    
+    Records keep their nested structure, so referrals need no sidecar. With a
+    .gz or .zst extension each batch is appended as its own gzip member or
+    zstd frame. Concatenated members are a valid compressed file, and `size`
+    still marks a batch boundary that a resume can cut back to.
+    """
+    
+    def __init__(self, output_path: Path, batch_size: int = DEFAULT_BATCH_SIZE, flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        super().__init__(batch_size, flush_interval)
+        self.output_path = output_path
+        self.size = output_path.stat().st_size if output_path.exists() else 0
+        self._compress: Optional[Callable[[bytes], bytes]] = None
+        if output_path.suffix == ".gz":
+            self._compress = gzip.compress
+        elif output_path.suffix == ".zst":
+            try:
+                import zstandard
+            except ImportError:
+                logger.error("Writing .zst output needs zstandard: pip install zstandard")
+                raise typer.Exit(1)
+            self._compress = zstandard.ZstdCompressor(level=10).compress
+    
+    def _write_batch(self, records: List[Dict]) -> None:
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+        data = "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+        if self._compress is not None:
+            data = self._compress(data)
+        with open(self.output_path, 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            self.size = f.tell()
+        logger.debug(f"Flushed {len(records)} records to {self.output_path}")
+
+class ParquetSink(BatchSink):
+    """
+    Stream records to a Parquet dataset, one part file per batch.
+    
+    A Parquet file can't be appended to once closed, so output.parquet is a
+    directory of part files; pandas, pyarrow and DuckDB read it as one table.
+    Referrals are stored as lists of structs. Every flush writes and syncs a
+    complete part before the save point moves past its records, so a
+    checkpoint never covers rows that a crash could lose. A part left
+    unfinished by a killed run is discarded on the next start, and parts
+    finished after the last save point are discarded by discard_after().
+    """
+    
+    def __init__(self, output_path: Path, batch_size: int = DEFAULT_BATCH_SIZE, flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        super().__init__(batch_size, flush_interval)
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            logger.error("Writing Parquet output needs pyarrow: pip install pyarrow")
+            raise typer.Exit(1)
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.output_path = output_path
+        output_path.mkdir(parents=True, exist_ok=True)
+        # Files starting with a dot are ignored by Parquet readers
+        for stale_path in output_path.glob(".part-*.tmp"):
+            logger.warning(f"Discarding {stale_path}, left unfinished by an earlier run; its records have to be fetched again")
+            stale_path.unlink()
+        self._run = f"part-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.parts = 0
+        referral = pyarrow.struct([("agency", pyarrow.string()), ("referralDate", pyarrow.string()), ("closedDate", pyarrow.string())])
+        self.schema = pyarrow.schema([
+            (field, pyarrow.list_(referral) if field in ("completedReferrals", "pendingReferrals") else pyarrow.string())
+            for field in CSV_FIELDS
+        ])
+        self._dropped_keys = set()
+    
+    @staticmethod
+    def discard_after(output_path: Path, timestamp: float) -> None:
+        """
+        Delete the parts finished after a save point was written.
+        
+        Parts are finished before the save point that covers them, so any
+        part younger than the save point holds records a resume fetches again.
+        
+        Args:
+            output_path: The Parquet dataset directory
+            timestamp: The save point's timestamp
+        """
+        for part_path in output_path.glob("part-*.parquet"):
+            if part_path.stat().st_mtime > timestamp:
+                logger.warning(f"Discarding {part_path}, written after the last save point")
+                part_path.unlink()
+    
+    def _to_row(self, record: Dict) -> Dict:
+        extra = record.keys() - set(CSV_FIELDS) - self._dropped_keys
+        if extra:
+            logger.warning(f"Dropping fields not in the Parquet schema: {sorted(extra)}")
+            self._dropped_keys.update(extra)
+        row = {}
+        for field in CSV_FIELDS:
+            value = record.get(field)
+            if field in ("completedReferrals", "pendingReferrals"):
+                row[field] = [
+                    {key: referral.get(key) for key in ("agency", "referralDate", "closedDate")}
+                    for referral in parse_referrals(value)
+                ]
+            else:
+                row[field] = None if value is None or value == '' else str(value)
+        return row
+    
+    def _write_batch(self, records: List[Dict]) -> None:
+        self.parts += 1
+        name = f"{self._run}-{self.parts:05d}.parquet"
+        part_path = self.output_path / name
+        tmp_path = self.output_path / f".{name}.tmp"
+        table = self._pa.Table.from_pylist([self._to_row(record) for record in records], schema=self.schema)
+        self._pq.write_table(table, str(tmp_path), compression="zstd")
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, part_path)
+        logger.debug(f"Wrote {len(records)} records to {part_path}")
+    
+    def close(self) -> None:
+        """Flush anything still buffered."""
+        super().close()
+        if self.parts:
+            logger.info(f"Wrote {self.parts} part file(s) to {self.output_path}")
+
+def resolve_output(output_path: Path, output_format: Optional[str] = None) -> Tuple[Path, str]:
+    """
+    Work out the format of an output file and give the path its extension.
+    
+    Args:
+        output_path: The output path as given, with or without an extension
+        output_format: csv, ndjson or parquet; None infers it from the
+            extension and falls back to csv
+        
+    Returns:
+        The output path with the format's extension, and the format
+    """
+    compression = output_path.suffix if output_path.suffix in COMPRESSED_SUFFIXES else ""
+    stem = output_path.with_suffix("") if compression else output_path
+    extension = stem.suffix
+    if output_format is None:
+        output_format = next((name for name, suffix in OUTPUT_FORMATS.items() if suffix == extension),
+                             "ndjson" if compression else "csv")
+        if extension == ".jsonl":
+            output_format = "ndjson"
+    if output_format not in OUTPUT_FORMATS:
+        raise typer.BadParameter(f"--format must be {', '.join(OUTPUT_FORMATS)}")
+    if compression and output_format != "ndjson":
+        raise typer.BadParameter(f"Only ndjson output can be compressed, e.g. output.ndjson{compression}")
+    if extension != OUTPUT_FORMATS[output_format] and not (output_format == "ndjson" and extension == ".jsonl"):
+        stem = Path(f"{stem}{OUTPUT_FORMATS[output_format]}")
+    return Path(f"{stem}{compression}"), output_format
+
+def open_sink(output_path: Path, output_format: str, batch_size: int = DEFAULT_BATCH_SIZE,
+              flush_interval: float = DEFAULT_FLUSH_INTERVAL) -> BatchSink:
+    """
+    Open the sink for an output file resolved by resolve_output.
+    
+    Args:
+        output_path: The output file, or directory for parquet
+        output_format: csv, ndjson or parquet
+        batch_size: Records per write
+        flush_interval: Maximum seconds between writes
+        
+    Returns:
+        The sink
+    """
+    if output_format == "ndjson":
+        return NdjsonSink(output_path, batch_size=batch_size, flush_interval=flush_interval)
+    if output_format == "parquet":
+        return ParquetSink(output_path, batch_size=batch_size, flush_interval=flush_interval)
+    return CsvSink(output_path, batch_size=batch_size, flush_interval=flush_interval)
+
+def to_iso_date(value: Optional[str]) -> Optional[str]:
+    """
+    Convert an API date (MM/DD/YYYY) to ISO format (YYYY-MM-DD).
+    
+    Args:
+        value: The date as returned by the API
+        
+    Returns:
+        The ISO date, or None if the value is empty or not a date
+    """
+    if not value or len(value) != 10 or value[2] != '/' or value[5] != '/':
+        return None
+    return f"{value[6:]}-{value[:2]}-{value[3:5]}"
+
+def parse_referrals(value: Union[None, str, List[Dict]]) -> List[Dict]:
+    """
+    Parse a referral list as returned by the API or stored in a result CSV.
+    
+    CSV cells written by earlier versions hold the Python repr of the list;
+    those are only evaluated as literals if they are not valid JSON.
+    
+    Args:
+        value: The list itself, its JSON or repr form, or an empty value
+        
+    Returns:
+        The referrals, or an empty list if the value can't be parsed
+    """
+    if not value:
+        return []
+    if isinstance(value, list):
+        return value
+    try:
+        referrals = json.loads(value)
+    except ValueError:
+        try:
+            referrals = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            logger.warning(f"Could not parse referrals: {value[:80]}")
+            return []
+    return referrals if isinstance(referrals, list) else []
+
+def referral_rows(record: Dict) -> List[Dict]:
+    """
+    Flatten the referrals of a record into rows of the referrals table.
+    
+    Args:
+        record: A work item, from the API or read back from a result CSV
+        
+    Returns:
+        One row per referral with REFERRAL_FIELDS and ISO dates
+    """
+    rows = []
+    for state, key in (("completed", "completedReferrals"), ("pending", "pendingReferrals")):
+        for referral in parse_referrals(record.get(key)):
+            rows.append({
+                "acn": record["acn"],
+                "agency": referral.get("agency"),
+                "referralDate": to_iso_date(referral.get("referralDate")),
+                "closedDate": to_iso_date(referral.get("closedDate")),
+                "state": state,
+            })
+    return rows
+
+def referrals_path(output_path: Path) -> Path:
+    """Return the referrals sidecar of a result CSV, e.g. output.referrals.csv."""
+    return output_path.with_name(f"{output_path.stem}.referrals.csv")
+
+def write_referrals_csv(records: Iterator[Dict], path: Path) -> int:
+    """
+    Write the referrals of records to a referrals CSV, replacing it.
+    
+    Args:
+        records: Work items, from the API or read back from a result CSV
+        path: The referrals CSV to write
+        
+    Returns:
+        The number of referral rows written
+    """
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    written = 0
+    with open(tmp_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REFERRAL_FIELDS)
+        writer.writeheader()
+        for record in records:
+            rows = referral_rows(record)
+            writer.writerows(rows)
+            written += len(rows)
+    os.replace(tmp_path, path)
+    return written
+
+def iter_csv_records(path: Path) -> Iterator[Dict]:
+    """Yield the records of a result CSV, decoded with decode_csv_record."""
+    with open(path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            if row.get("acn"):
+                yield decode_csv_record(row)
+
+class CsvIndex:
+    """
+    Sidecar index of a result CSV mapping each ACN to the byte offset of its row.
+    
+    The index file (output.csv.idx for output.csv) holds a header with the
+    CSV's inode and the number of bytes indexed, followed by one fixed-size
+    (ACN number, offset) entry per row in file order. update() only scans
+    bytes appended since the last update; a CSV that was replaced or cut
+    short is indexed again from scratch. For an ACN that appears in several
+    rows the last row wins, as it does for every other reader of these files.
+    """
+    
+    MAGIC = b"SNAPIDX1"
+    HEADER = struct.Struct("<8sQQ")
+    ENTRY = struct.Struct("<qq")
+    
+    def __init__(self, csv_path: Path, index_path: Optional[Path] = None):
+        self.csv_path = csv_path
+        self.index_path = index_path or self.index_path_for(csv_path)
+        self.offsets: Dict[int, int] = {}
+        self.prefix = "Z"
+        self._inode = 0
+        self._indexed = 0
+        self._load()
+    
+    @staticmethod
+    def index_path_for(csv_path: Path) -> Path:
+        """Return the index file of a result CSV."""
+        return csv_path.with_name(f"{csv_path.name}.idx")
+    
+    def _load(self) -> None:
+        if not self.index_path.exists():
+            return
+        data = self.index_path.read_bytes()
+        if len(data) < self.HEADER.size:
+            return
+        magic, inode, indexed = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            logger.warning(f"Ignoring {self.index_path}: not an ACN index")
+            return
+        entries = array("q")
+        entries.frombytes(data[self.HEADER.size:len(data) - (len(data) - self.HEADER.size) % self.ENTRY.size])
+        self.offsets = dict(zip(entries[0::2], entries[1::2]))
+        self._inode = inode
+        self._indexed = indexed
+    
+    def __len__(self) -> int:
+        return len(self.offsets)
+    
+    def __contains__(self, acn: str) -> bool:
+        return acn_to_int(acn) in self.offsets
+    
+    def update(self) -> int:
+        """
+        Index rows appended to the CSV since the last update.
+        
+        Returns:
+            The number of rows indexed
+        """
+        if not self.csv_path.exists():
+            return 0
+        stat = self.csv_path.stat()
+        rebuild = stat.st_ino != self._inode or stat.st_size < self._indexed
+        if rebuild:
+            self.offsets = {}
+            self._indexed = 0
+        if stat.st_size == self._indexed and not rebuild:
+            return 0
+        
+        entries = array("q")
+        with open(self.csv_path, 'rb') as f:
+            header = f.readline()
+            columns = next(csv.reader([header.decode("utf-8")]), [])
+            if "acn" not in columns:
+                return 0
+            acn_column = columns.index("acn")
+            offset = max(self._indexed, len(header))
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                # A quoted cell can span lines; a row ends where the quotes balance
+                while line.count(b'"') % 2:
+                    more = f.readline()
+                    if not more:
+                        break
+                    line += more
+                if not line.endswith(b"\n"):
+                    # A partial last row is indexed once it is complete
+                    break
+                if acn_column == 0 and not line.startswith(b'"'):
+                    acn = line[:line.find(b",")].decode("utf-8")
+                else:
+                    acn = next(csv.reader([line.decode("utf-8")]), [""] * (acn_column + 1))[acn_column]
+                if acn:
+                    self.prefix = acn[0]
+                    number = acn_to_int(acn)
+                    self.offsets[number] = offset
+                    entries.extend((number, offset))
+                offset += len(line)
+        
+        self._inode = stat.st_ino
+        self._indexed = offset
+        header_bytes = self.HEADER.pack(self.MAGIC, self._inode, self._indexed)
+        if rebuild or not self.index_path.exists():
+            tmp_path = self.index_path.with_name(f"{self.index_path.name}.tmp")
+            with open(tmp_path, 'wb') as f:
+                f.write(header_bytes)
+                entries.tofile(f)
+            os.replace(tmp_path, self.index_path)
+        else:
+            # Append the new entries, then move the header past them
+            with open(self.index_path, 'r+b') as f:
+                f.seek(0, os.SEEK_END)
+                entries.tofile(f)
+                f.flush()
+                f.seek(0)
+                f.write(header_bytes)
+        return len(entries) // 2
+    
+    def offset(self, acn: str) -> Optional[int]:
+        """Return the byte offset of an ACN's row, or None if it isn't indexed."""
+        return self.offsets.get(acn_to_int(acn))
+    
+    def get(self, acn: str) -> Optional[Dict]:
+        """
+        Read one record by seeking to its row through mmap.
+        
+        Args:
+            acn: The ACN to look up
+            
+        Returns:
+            The record decoded with decode_csv_record, or None if it isn't indexed
+        """
+        return self.get_many([acn]).get(acn)
+    
+    def get_many(self, acns: List[str]) -> Dict[str, Dict]:
+        """
+        Read several records by seeking to their rows through mmap.
+        
+        Args:
+            acns: The ACNs to look up
+            
+        Returns:
+            The records found, keyed by ACN
+        """
+        wanted = [(acn, self.offset(acn)) for acn in acns]
+        wanted = [(acn, offset) for acn, offset in wanted if offset is not None]
+        if not wanted:
+            return {}
+        records = {}
+        with open(self.csv_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            columns = next(csv.reader([mm[:mm.find(b"\n")].decode("utf-8")]))
+            for acn, offset in wanted:
+                end = mm.find(b"\n", offset)
+                while end != -1 and mm[offset:end + 1].count(b'"') % 2:
+                    end = mm.find(b"\n", end + 1)
+                line = mm[offset:end if end != -1 else len(mm)].decode("utf-8")
+                row = next(csv.reader([line]), [])
+                record = decode_csv_record(dict(zip(columns, row)))
+                if record.get("acn") == acn:
+                    records[acn] = record
+                else:
+                    logger.warning(f"{self.index_path} is out of date for {acn}; rebuild it with lookup --rebuild")
+        return records
+    
+    def acns(self) -> List[str]:
+        """Return the indexed ACNs in descending order."""
+        return [int_to_acn(number, self.prefix) for number in sorted(self.offsets, reverse=True)]
+
+def open_csv_index(csv_path: Path, rebuild: bool = False) -> CsvIndex:
+    """
+    Open the ACN index of a result CSV, creating or updating it as needed.
+    
+    Args:
+        csv_path: The result CSV
+        rebuild: Index the whole file again
+        
+    Returns:
+        The up-to-date index
+    """
+    index_path = CsvIndex.index_path_for(csv_path)
+    if rebuild and index_path.exists():
+        index_path.unlink()
+    index = CsvIndex(csv_path, index_path)
+    added = index.update()
+    if added:
+        logger.debug(f"Indexed {added} rows of {csv_path}")
+    return index
+
+def decode_csv_record(row: Dict[str, str]) -> Dict:
+    """
+    Turn a row read back from a result CSV into the shape returned by the API.
+    
+    Empty cells become None and referral lists are parsed back from their
+    JSON or Python literal form.
+    
+    Args:
+        row: The row as read by csv.DictReader
+        
+    Returns:
+        The record as a dictionary
+    """
+    record = {}
+    for key, value in row.items():
+        if key is None:
+            continue
+        if value == '' or value is None:
+            record[key] = None
+        elif key in ("completedReferrals", "pendingReferrals"):
+            record[key] = parse_referrals(value)
+        else:
+            record[key] = value
+    return record
+
+def _canonical_value(key: str, value):
+    # Empty cells, None and [] all mean "no value"; referral order carries no meaning
+    if value is None or value == '' or value == []:
+        return None
+    if key in ("completedReferrals", "pendingReferrals") and isinstance(value, list):
+        return sorted(value, key=lambda referral: json.dumps(referral, sort_keys=True))
+    return value
+
+def canonical_record(record: Dict) -> str:
+    """
+    Serialize a record so that equal records serialize identically.
+    
+    Keys are sorted, empty values dropped and referrals put in a fixed order,
+    so a record read back from a CSV, whatever its column order or referral
+    encoding, matches the same record from the API or a store.
+    
+    Args:
+        record: The record as returned by the API or decode_csv_record
+        
+    Returns:
+        The canonical JSON form
+    """
+    canonical = {}
+    for key, value in record.items():
+        value = _canonical_value(key, value)
+        if value is not None:
+            canonical[key] = value
+    return json.dumps(canonical, sort_keys=True, separators=(",", ":"))
+
+def record_digest(record: Dict) -> bytes:
+    """Hash the canonical form of a record."""
+    return hashlib.blake2b(canonical_record(record).encode("utf-8"), digest_size=16).digest()
+
+def is_terminal(record: Dict) -> bool:
+    """
+    Check whether a work item has reached a state that no longer changes.
+    
+    Args:
+        record: The work item record
+        
+    Returns:
+        True if the item is COMPLETED with a final decision and no pending referrals
+    """
+    return (
+        record.get("reviewStatus") == "COMPLETED"
+        and bool(record.get("finalDecision"))
+        and not record.get("pendingReferrals")
+    )
+
+def needs_refresh(record: Dict, since: Optional[str] = None) -> bool:
+    """
+    Check whether a record should be re-fetched by the refresh command.
+    
+    Args:
+        record: The work item record
+        since: Also select records registered on or after this ISO date
+        
+    Returns:
+        True if the record is non-terminal or newer than the cutoff
+    """
+    if not is_terminal(record):
+        return True
+    registered = to_iso_date(record.get("registrationDate"))
+    return bool(since and registered and registered >= since)
+
+def is_error_result(data: Dict) -> bool:
+    """Check whether a query_acn result is an error placeholder rather than a record."""
+    return "error" in data or set(data) == {"acn"}
+
+class SqliteStore(BatchSink):
+    """
+    Result store backed by SQLite, keyed by ACN.
+    
+    Each batch is upserted in a single transaction, so re-crawling or
+    resuming never creates duplicates. The full record is kept as JSON next
+    to indexed columns for the fields we filter on, and its referrals are
+    kept as rows of the referrals table.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS work_items (
+            acn TEXT PRIMARY KEY,
+            reviewStatus TEXT,
+            registrationDate TEXT,
+            renewingDivision TEXT,
+            data TEXT NOT NULL,
+            fetched_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_work_items_review_status ON work_items (reviewStatus);
+        CREATE INDEX IF NOT EXISTS idx_work_items_registration_date ON work_items (registrationDate);
+        CREATE INDEX IF NOT EXISTS idx_work_items_renewing_division ON work_items (renewingDivision);
+        CREATE TABLE IF NOT EXISTS referrals (
+            acn TEXT NOT NULL,
+            agency TEXT,
+            referralDate TEXT,
+            closedDate TEXT,
+            state TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_referrals_acn ON referrals (acn);
+        CREATE INDEX IF NOT EXISTS idx_referrals_agency ON referrals (agency);
+    """
+    
+    def __init__(self, db_path: Path, batch_size: int = DEFAULT_BATCH_SIZE, flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        super().__init__(batch_size, flush_interval)
+        self.db_path = db_path
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        # query writes from its sink stage thread; the store is only ever used by one thread at a time
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+    
+    @property
+    def spec(self) -> str:
+        """The --store value that opens this store."""
+        return f"sqlite:{self.db_path}"
+    
+    def _write_batch(self, records: List[Dict]) -> None:
+        self.upsert_many(records)
+        logger.debug(f"Upserted {len(records)} records into {self.db_path}")
+    
+    def upsert_many(self, records: List[Dict], fetched_at: Optional[float] = None) -> None:
+        """
+        Insert or update records by ACN in one transaction.
+        
+        Args:
+            records: The records to store
+            fetched_at: When the records were captured (defaults to now)
+        """
+        fetched_at = fetched_at if fetched_at is not None else time.time()
+        rows = [
+            (
+                record["acn"],
+                record.get("reviewStatus"),
+                to_iso_date(record.get("registrationDate")),
+                record.get("renewingDivision"),
+                json.dumps(record),
+                fetched_at,
+            )
+            for record in records
+        ]
+        with self.conn:
+            self.conn.executemany(
+                """
+                INSERT INTO work_items (acn, reviewStatus, registrationDate, renewingDivision, data, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (acn) DO UPDATE SET
+                    reviewStatus = excluded.reviewStatus,
+                    registrationDate = excluded.registrationDate,
+                    renewingDivision = excluded.renewingDivision,
+                    data = excluded.data,
+                    fetched_at = excluded.fetched_at
+                """,
+                rows,
+            )
+            self._replace_referrals(records)
+    
+    def _replace_referrals(self, records: List[Dict]) -> None:
+        self.conn.executemany("DELETE FROM referrals WHERE acn = ?", [(record["acn"],) for record in records])
+        self.conn.executemany(
+            "INSERT INTO referrals (acn, agency, referralDate, closedDate, state) VALUES (?, ?, ?, ?, ?)",
+            [tuple(row[field] for field in REFERRAL_FIELDS) for record in records for row in referral_rows(record)],
+        )
+    
+    def rebuild_referrals(self) -> int:
+        """
+        Rebuild the referrals table from the stored records.
+        
+        Returns:
+            The number of referral rows written
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM referrals")
+            batch = []
+            for record in self.iter_records():
+                batch.append(record)
+                if len(batch) >= 1000:
+                    self._replace_referrals(batch)
+                    batch = []
+            self._replace_referrals(batch)
+        return self.conn.execute("SELECT COUNT(*) FROM referrals").fetchone()[0]
+    
+    def get(self, acn: str) -> Optional[Dict]:
+        """
+        Look up a single record.
+        
+        Args:
+            acn: The ACN to look up
+            
+        Returns:
+            The record or None if it is not in the store
+        """
+        row = self.conn.execute("SELECT data FROM work_items WHERE acn = ?", (acn,)).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def get_entry(self, acn: str) -> Optional[Tuple[Dict, float]]:
+        """
+        Look up a single record and when it was fetched.
+        
+        Args:
+            acn: The ACN to look up
+            
+        Returns:
+            (record, fetched_at) or None if it is not in the store
+        """
+        row = self.conn.execute("SELECT data, fetched_at FROM work_items WHERE acn = ?", (acn,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+    
+    def iter_records(self) -> Iterator[Dict]:
+        """Yield every stored record in descending ACN order."""
+        for (data,) in self.conn.execute("SELECT data FROM work_items ORDER BY acn DESC"):
+            yield json.loads(data)
+    
+    def select_refresh_candidates(self, since: Optional[str] = None) -> List[str]:
+        """
+        Find ACNs whose records may still change.
+        
+        Args:
+            since: Also select records registered on or after this ISO date
+            
+        Returns:
+            The matching ACNs in descending order
+        """
+        rows = self.conn.execute(
+            """
+            SELECT acn FROM work_items
+            WHERE reviewStatus IS NOT 'COMPLETED'
+               OR json_extract(data, '$.finalDecision') IS NULL
+               OR json_array_length(data, '$.pendingReferrals') > 0
+               OR registrationDate >= ?
+            ORDER BY acn DESC
+            """,
+            (since or '9999-12-31',),
+        )
+        return [acn for (acn,) in rows]
+    
+    def count(self) -> int:
+        """Return the number of stored records."""
+        return self.conn.execute("SELECT COUNT(*) FROM work_items").fetchone()[0]
+    
+    def newest_acn(self) -> Optional[str]:
+        """Return the highest stored ACN, or None if the store is empty."""
+        row = self.conn.execute(
+            "SELECT acn FROM work_items ORDER BY CAST(SUBSTR(acn, 2) AS INTEGER) DESC LIMIT 1"
+        ).fetchone()
+        return row[0] if row else None
+    
+    def close(self) -> None:
+        """Flush anything still buffered and close the database."""
+        super().close()
+        self.conn.close()
+
+def open_store(spec: str, batch_size: int = DEFAULT_BATCH_SIZE, flush_interval: float = DEFAULT_FLUSH_INTERVAL) -> SqliteStore:
+    """
+    Open a result store from a --store value.
+    
+    Args:
+        spec: The store spec, e.g. "sqlite:results.db"
+        batch_size: Records per write transaction
+        flush_interval: Maximum seconds between write transactions
+        
+    Returns:
+        The opened store
+    """
+    backend, _, location = spec.partition(":")
+    if backend != "sqlite" or not location:
+        raise typer.BadParameter(f"Unsupported store '{spec}', expected sqlite:<path>")
+    return SqliteStore(Path(location), batch_size=batch_size, flush_interval=flush_interval)
+
+def truncate_to_checkpoint(output_path: Path, output_bytes: int) -> None:
+    """
+    Cut rows written after the last save point off the output file.
+    
+    Rows are flushed before the save point that covers them is written, so a
+    crash in between leaves rows that the resumed crawl will fetch again.
+    
+    Args:
+        output_path: The output CSV file
+        output_bytes: The file size recorded in the save point
+    """
+    if not output_path.exists():
+        return
+    size = output_path.stat().st_size
+    if size > output_bytes:
+        logger.warning(f"Discarding {size - output_bytes} bytes written to {output_path} after the last save point")
+        with open(output_path, 'r+b') as f:
+            f.truncate(output_bytes)
+    elif size < output_bytes:
+        logger.error(f"{output_path} is smaller than recorded in the save point; it was modified outside this tool")
+
+@app.command("update-curl")
+def update_curl(
+    curl_command: str = typer.Argument(..., help="The curl command to use for token refresh"),
+):
+    """
+    Update the curl command used for token refresh.
+    
+    The curl command should be a complete curl command that can be used to get a new token.
+    Example:
+        ./query.py update-curl "curl 'https://bisexternal.ciamlogin.com/16a0fd8f-4db1-4496-8036-56968f632d98/oauth2/v2.0/token' -H 'Accept: */*' ... --data-raw '...'"
+    """
+    logger.info("Updating curl command...")
+    
+    # Set debug logging temporarily to see what's happening
+    original_level = logger.level
+    logger.setLevel(logging.DEBUG)
+    
+    # Remove backslashes used for line continuation
+    curl_command = curl_command.replace("\\\n", " ")
     logger.debug(f"Command after removing line continuations: {curl_command[:50]}...")
     
     # Check if the command starts with curl
@@ -731,158 +3560,2740 @@ def fix_config(
     
     logger.info("Configuration check complete")
 
-@app.command()
-def query(
-    start_acn: str = typer.Option(DEFAULT_START_ACN, "--start-acn", "-s", help="The ACN to start querying from"),
-    output_path: Path = typer.Option(DEFAULT_OUTPUT_PATH, "--output", "-o", help="The path to save the CSV file"),
-    token: str = typer.Option(None, "--token", "-t", help="The authentication token for the SNAPR API (optional)"),
-    limit: int = typer.Option(None, "--limit", "-l", help="Limit the number of ACNs to query (optional)"),
-    resume: bool = typer.Option(False, "--resume", "-r", help="Resume from the last save point"),
+@app.command("token-broker")
+def token_broker_command(
+    host: str = typer.Option("127.0.0.1", "--host", help="The address to listen on"),
+    port: int = typer.Option(DEFAULT_BROKER_PORT, "--port", "-p", help="The port to listen on"),
+    secret: str = typer.Option(None, "--secret", envvar="SNAPR_SECRET", help="Shared secret crawlers must send (required off localhost)"),
     debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
 ):
     """
-    Query the SNAPR API for work items and save the results to a CSV file.
-    
-    The script will start from the specified ACN and work backwards until a 404 error is encountered.
-    If resume is True, it will resume from the last save point.
+    Run a local token broker shared by several crawler processes.
     
-    Examples:
-        ./query.py                                # Run with default settings
-        ./query.py --start-acn Z1865690           # Start from a specific ACN
-        ./query.py --resume                       # Resume from the last save point
-        ./query.py --limit 100                    # Limit to 100 records
-        ./query.py --debug                        # Enable debug logging
+    The broker is the only process that uses the refresh token. It refreshes the
+    access token ahead of expiry and hands it out to any number of crawlers, so
+    parallel runs don't race each other rotating the refresh token. Crawlers send
+    the --secret from the SNAPR_SECRET environment variable.
+    Example:
+        ./query.py token-broker --port 8765
+        ./query.py query --start-acn Z1865690 --token-broker http://127.0.0.1:8765
     """
-    # Set debug logging if requested
     if debug:
         logger.setLevel(logging.DEBUG)
         logger.debug("Debug logging enabled")
-    # Check if we should resume from a save point
-    if resume:
-        state = load_state()
-        if state:
-            current_acn = state["current_acn"]
-            output_path = Path(state["output_path"])
-            start_count = state.get("count", 0)
-            logger.info(f"Resuming from ACN {current_acn}")
-            logger.info(f"Output path: {output_path}")
-            logger.info(f"Already processed {start_count} records")
-        else:
-            logger.warning("No save point found, starting fresh")
-            current_acn = start_acn
-            start_count = 0
-            logger.info(f"Starting query from ACN {start_acn}")
-            logger.info(f"Output path: {output_path}")
+    check_listen_address(host, secret)
+    
+    tokens = TokenManager(create_session())
+    if not tokens.get():
+        logger.error("Failed to get token. Exiting.")
+        raise typer.Exit(1)
+    tokens.start()
+    
+    server = start_token_broker(tokens, host, port, secret)
+    logger.info(f"Token broker listening on http://{host}:{server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        logger.info("Token broker stopped by user")
+    finally:
+        server.shutdown()
+        tokens.stop()
+
+class LookupService:
+    """
+    Answers ACN lookups for the serve command with a warm session and token.
+    
+    A lookup is answered from an in-memory LRU of recent results, then from the
+    result store while the stored record is younger than the TTL for its
+    reviewStatus, and only then from the API. Concurrent lookups of the same
+    ACN share a single request. Fetched records are written through to the
+    store; 404s are remembered in memory for NOT_FOUND_TTL seconds and failed
+    requests not at all. Safe to call from any thread.
+    """
+    
+    def __init__(
+        self,
+        session: requests.Session,
+        tokens: Union[TokenManager, BrokerTokenClient],
+        limiter: Optional[RateLimiter] = None,
+        cache: Optional[ResponseCache] = None,
+        store: Optional[SqliteStore] = None,
+        ttls: Optional[Dict[str, float]] = None,
+        capacity: int = DEFAULT_MEMORY_CACHE_SIZE,
+        workers: int = 4,
+    ):
+        self.session = session
+        self.tokens = tokens
+        self.limiter = limiter
+        self.cache = cache
+        self.store = store
+        self.ttls = ttls or dict(DEFAULT_CACHE_TTLS)
+        self.capacity = capacity
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lookup")
+        self._memory: OrderedDict[str, Tuple[Optional[Dict], float]] = OrderedDict()
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._store_lock = threading.Lock()
+    
+    def _is_fresh(self, record: Optional[Dict], fetched_at: float) -> bool:
+        if record is None:
+            ttl = NOT_FOUND_TTL
+        else:
+            ttl = self.ttls.get(record.get("reviewStatus"), self.ttls.get("*", 0))
+        return time.time() - fetched_at < ttl
+    
+    def _remember(self, acn: str, record: Optional[Dict], fetched_at: float) -> None:
+        with self._lock:
+            self._memory[acn] = (record, fetched_at)
+            self._memory.move_to_end(acn)
+            while len(self._memory) > self.capacity:
+                self._memory.popitem(last=False)
+    
+    def _from_memory(self, acn: str) -> Optional[Tuple[Optional[Dict], float]]:
+        with self._lock:
+            entry = self._memory.get(acn)
+            if entry is not None:
+                self._memory.move_to_end(acn)
+        return entry if entry is not None and self._is_fresh(*entry) else None
+    
+    def lookup(self, acn: str, refresh: bool = False) -> Tuple[Optional[Dict], str]:
+        """
+        Look up one ACN.
+        
+        Args:
+            acn: The ACN to look up
+            refresh: Skip the memory and store, always ask the API
+            
+        Returns:
+            (result, source): the record, None for a 404 or an error result, and
+            memory, store, api or coalesced (shared another lookup's request)
+        """
+        if not refresh:
+            entry = self._from_memory(acn)
+            if entry is not None:
+                metrics.inc("snapr_lookups_total", source="memory")
+                return entry[0], "memory"
+        
+        with self._lock:
+            future = self._in_flight.get(acn)
+            owner = future is None
+            if owner:
+                future = self._in_flight[acn] = Future()
+        if not owner:
+            metrics.inc("snapr_lookups_total", source="coalesced")
+            return future.result(), "coalesced"
+        
+        try:
+            result, source = self._load(acn, refresh)
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[acn]
+        metrics.inc("snapr_lookups_total", source=source)
+        return result, source
+    
+    def _load(self, acn: str, refresh: bool) -> Tuple[Optional[Dict], str]:
+        if not refresh and self.store is not None:
+            with self._store_lock:
+                entry = self.store.get_entry(acn)
+            if entry is not None and self._is_fresh(*entry):
+                self._remember(acn, *entry)
+                return entry[0], "store"
+        
+        data = fetch_acn(self.session, acn, self.tokens, self.limiter, self.cache)
+        if data is not None and is_error_result(data):
+            return data, "api"
+        fetched_at = time.time()
+        self._remember(acn, data, fetched_at)
+        if data is not None and self.store is not None:
+            with self._store_lock:
+                self.store.upsert_many([data], fetched_at)
+        return data, "api"
+    
+    def lookup_many(self, acns: List[str], refresh: bool = False) -> List[Tuple[Optional[Dict], str]]:
+        """Look up several ACNs concurrently; results are in the order of acns."""
+        return list(self.pool.map(lambda acn: self.lookup(acn, refresh), acns))
+    
+    def status(self) -> Dict:
+        """Describe the service for GET /status."""
+        with self._lock:
+            remembered, in_flight = len(self._memory), len(self._in_flight)
+        return {
+            "memory": remembered,
+            "in_flight": in_flight,
+            "lookups": {source: int(count) for source, count in metrics.by_label("snapr_lookups_total", "source").items()},
+            "token_expires_at": getattr(self.tokens, "expires_at", None),
+            "store": self.store.spec if self.store is not None else None,
+        }
+    
+    def close(self) -> None:
+        """Stop the lookup threads and close the store and cache."""
+        self.pool.shutdown(wait=True)
+        if self.store is not None:
+            self.store.close()
+        if self.cache is not None:
+            self.cache.close()
+
+class LookupHandler(MetricsHandler):
+    """
+    HTTP handler for the serve command.
+    
+    GET /acn/<ACN> answers with the work item as the SNAPR API would (404 if
+    there is none, 502 if the request failed) and says where it came from in
+    an X-SNAPR-Source header. POST /lookup with {"acns": [...]} answers with
+    {"records": {...}, "missing": [...], "errors": {...}}. Either takes
+    ?refresh=1 to skip the caches. GET /status describes the service and
+    GET /metrics serves the Prometheus metrics.
+    """
+    
+    protocol_version = "HTTP/1.1"
+    service: LookupService
+    
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"Lookup server: {format % args}")
+    
+    def _send_json(self, data: Optional[Dict], status: int = 200, source: Optional[str] = None) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if source:
+            self.send_header("X-SNAPR-Source", source)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def _refresh(self) -> bool:
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        return query.get("refresh", ["0"])[-1].lower() in ("1", "true", "yes")
+    
+    def do_GET(self) -> None:
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/status":
+            self._send_json(self.service.status())
+            return
+        if not path.startswith("/acn/"):
+            super().do_GET()
+            return
+        acn = path[len("/acn/"):].upper()
+        if not is_acn(acn):
+            self._send_json({"error": f"Invalid ACN '{acn}'"}, 400)
+            return
+        result, source = self.service.lookup(acn, self._refresh())
+        if result is None:
+            self._send_json({"acn": acn, "error": "not found"}, 404, source)
+        elif is_error_result(result):
+            self._send_json(result, 502, source)
+        else:
+            self._send_json(result, 200, source)
+    
+    def do_POST(self) -> None:
+        if urllib.parse.urlsplit(self.path).path != "/lookup":
+            self.send_error(404)
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            acns = [str(acn).upper() for acn in payload.get("acns", [])]
+        except (ValueError, AttributeError, TypeError):
+            self._send_json({"error": "Expected JSON like {\"acns\": [\"Z1865690\"]}"}, 400)
+            return
+        invalid = [acn for acn in acns if not is_acn(acn)]
+        if invalid or len(acns) > MAX_BATCH_LOOKUP:
+            message = f"Invalid ACNs: {', '.join(invalid[:10])}" if invalid else f"At most {MAX_BATCH_LOOKUP} ACNs per request"
+            self._send_json({"error": message}, 400)
+            return
+        
+        reply = {"records": {}, "missing": [], "errors": {}, "sources": {}}
+        acns = list(dict.fromkeys(acns))
+        for acn, (result, source) in zip(acns, self.service.lookup_many(acns, self._refresh())):
+            if result is None:
+                reply["missing"].append(acn)
+            elif is_error_result(result):
+                reply["errors"][acn] = result.get("error")
+            else:
+                reply["records"][acn] = result
+            reply["sources"][source] = reply["sources"].get(source, 0) + 1
+        self._send_json(reply)
+
+def start_lookup_server(service: LookupService, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    Serve ACN lookups from a LookupService over HTTP in a background thread.
+    
+    Args:
+        service: The lookup service
+        host: The address to listen on
+        port: The port to listen on (0 picks a free port)
+        
+    Returns:
+        The running server; its port is server.server_port
+    """
+    handler = type("BoundLookupHandler", (LookupHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="lookup-server", daemon=True).start()
+    return server
+
+@app.command()
+def serve(
+    host: str = typer.Option("127.0.0.1", "--host", help="The address to listen on"),
+    port: int = typer.Option(DEFAULT_SERVE_PORT, "--port", "-p", help="The port to listen on"),
+    store: str = typer.Option(None, "--store", help="Answer from and save fetched records to a result store, e.g. sqlite:results.db"),
+    cache_path: Path = typer.Option(None, "--cache", help=f"Cache responses in this file and revalidate them with conditional requests (e.g. {CACHE_FILE})"),
+    cache_ttl: List[str] = typer.Option(None, "--cache-ttl", help="Answer from memory, the store or the cache for this long by reviewStatus, e.g. COMPLETED=30d or *=6h"),
+    memory_size: int = typer.Option(DEFAULT_MEMORY_CACHE_SIZE, "--memory-size", min=1, help="Lookups kept in memory"),
+    workers: int = typer.Option(4, "--workers", "-w", min=1, help="Requests in flight for batch lookups"),
+    rate: float = typer.Option(DEFAULT_RATE, "--rate", help="Request rate limit in requests/second, shared by all clients"),
+    token: str = typer.Option(None, "--token", "-t", help="The authentication token for the SNAPR API (optional)"),
+    token_broker: str = typer.Option(None, "--token-broker", envvar="SNAPR_TOKEN_BROKER", help="Get tokens from a shared token broker, e.g. http://127.0.0.1:8765"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
+):
+    """
+    Run a local lookup daemon that answers "give me ACN X now" over HTTP/JSON.
+    
+    The session, token and result store stay warm between lookups, so a lookup
+    costs at most one API round trip instead of a whole query.py start-up.
+    Recent results are kept in memory and, with --store, read from and written
+    through to the store; both are trusted for the --cache-ttl of the record's
+    reviewStatus. Identical lookups in flight at the same time share a single
+    request, and all clients share the --rate limit.
+    
+    Example:
+        ./query.py serve --store sqlite:results.db
+        curl http://127.0.0.1:8767/acn/Z1865690
+        curl -d '{"acns": ["Z1865690", "Z1865689"]}' http://127.0.0.1:8767/lookup
+    """
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Debug logging enabled")
+    
+    session = create_session(pool_size=max(workers, 10))
+    tokens = make_token_source(session, token, token_broker)
+    if not tokens.get():
+        logger.error("Failed to get token. Exiting.")
+        raise typer.Exit(1)
+    tokens.start()
+    
+    service = LookupService(
+        session,
+        tokens,
+        RateLimiter(rate) if rate else None,
+        open_cache(cache_path, ttl_overrides=cache_ttl),
+        open_store(store) if store else None,
+        parse_cache_ttls(cache_ttl),
+        memory_size,
+        workers,
+    )
+    server = start_lookup_server(service, host, port)
+    logger.info(f"Lookup server listening on http://{host}:{server.server_port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        logger.info("Lookup server stopped by user")
+    finally:
+        server.shutdown()
+        tokens.stop()
+        service.close()
+
+@app.command()
+def query(
+    start_acn: str = typer.Option(DEFAULT_START_ACN, "--start-acn", "-s", help="The ACN to start querying from"),
+    output_path: Path = typer.Option(DEFAULT_OUTPUT_PATH, "--output", "-o", help="The path to save the results to"),
+    output_format: str = typer.Option(None, "--format", "-f", help="Output format: csv, ndjson or parquet (default: from the --output extension, else csv)"),
+    token: str = typer.Option(None, "--token", "-t", help="The authentication token for the SNAPR API (optional)"),
+    token_broker: str = typer.Option(None, "--token-broker", envvar="SNAPR_TOKEN_BROKER", help="Get tokens from a shared token broker, e.g. http://127.0.0.1:8765"),
+    limit: int = typer.Option(None, "--limit", "-l", help="Limit the number of ACNs to query (optional)"),
+    resume: bool = typer.Option(False, "--resume", "-r", help="Resume from the last save point"),
+    workers: int = typer.Option(1, "--workers", "-w", min=1, help="Number of requests in flight (1 = sequential)"),
+    rate: float = typer.Option(None, "--rate", help=f"Global request rate limit in requests/second (default {DEFAULT_RATE} when --workers > 1)"),
+    adaptive: bool = typer.Option(False, "--adaptive", help="Adapt the requests in flight to the server's latency and 429/503s, up to --workers"),
+    target_latency: float = typer.Option(DEFAULT_TARGET_LATENCY, "--target-latency", help="Seconds of smoothed latency above which --adaptive backs off"),
+    batch_size: int = typer.Option(DEFAULT_BATCH_SIZE, "--batch-size", min=1, help="Write results to disk every N records"),
+    flush_interval: float = typer.Option(DEFAULT_FLUSH_INTERVAL, "--flush-interval", help="Write results to disk at least every N seconds"),
+    store: str = typer.Option(None, "--store", help="Save results to a result store instead of the CSV file, e.g. sqlite:results.db"),
+    journal_path: Path = typer.Option(JOURNAL_FILE, "--journal", help="The journal that records the outcome of every ACN"),
+    max_gap: int = typer.Option(DEFAULT_MAX_GAP, "--max-gap", min=0, help="Stop after more than N consecutive missing ACNs"),
+    cache_path: Path = typer.Option(None, "--cache", help=f"Cache responses in this file and revalidate them with conditional requests (e.g. {CACHE_FILE})"),
+    cache_ttl: List[str] = typer.Option(None, "--cache-ttl", help="Serve cached items of a reviewStatus without asking the server for this long, e.g. COMPLETED=30d or *=6h"),
+    offline: bool = typer.Option(False, "--offline", help="Serve everything from the response cache without network requests"),
+    missing_cache: Path = typer.Option(MISSING_FILE, "--missing-cache", help="Remember ACNs that returned 404 in this file and skip them"),
+    missing_ttl: str = typer.Option(DEFAULT_MISSING_TTL, "--missing-ttl", help="How long a 404 is remembered, e.g. 12h or 7d"),
+    recheck_missing: bool = typer.Option(False, "--recheck-missing", help="Request ACNs remembered as missing anyway"),
+    retry_queue: Path = typer.Option(RETRY_FILE, "--retry-queue", help="Park ACNs whose request failed in this file and retry them later"),
+    queue_size: int = typer.Option(DEFAULT_QUEUE_SIZE, "--queue-size", min=1, help="Results buffered between the fetch, normalize and sink stages"),
+    metrics_interval: float = typer.Option(DEFAULT_METRICS_INTERVAL, "--metrics-interval", help="Log a one-line metrics summary every N seconds (0 = off)"),
+    metrics_file: Path = typer.Option(None, "--metrics-file", help="Keep the metrics in this Prometheus textfile, e.g. for node_exporter"),
+    metrics_port: int = typer.Option(None, "--metrics-port", help="Serve the metrics for Prometheus at http://127.0.0.1:PORT/metrics"),
+    profile: bool = typer.Option(False, "--profile", help="Log where the time went, per stage and per step, at exit"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
+):
+    """
+    Query the SNAPR API for work items and save the results to a CSV file.
+    
+    The script will start from the specified ACN and work backwards until more than
+    --max-gap consecutive ACNs are not found (404). Shorter gaps are skipped and reported.
+    If resume is True, it will resume from the last save point.
+    
+    With --workers above 1 several ACNs are fetched concurrently under a shared
+    token-bucket rate limit (--rate) that also honors 429 Retry-After responses.
+    Results are still processed and saved in ACN order.
+    
+    With --adaptive, --workers is only the ceiling: the number of requests in
+    flight starts at 1, grows while the server answers within --target-latency
+    and halves on 429 or 503 responses. Its decisions are logged and the
+    concurrency it settled on is reported at the end. Raise --rate as well, or
+    the rate limit rather than the server decides the throughput.
+    
+    Results are streamed to the CSV file in batches (--batch-size/--flush-interval).
+    Each batch is synced to disk before the save point is moved past it, so a
+    resumed run neither skips nor duplicates records. Referrals are also written
+    one per row, with ISO dates, to a sidecar CSV (output.referrals.csv for
+    output.csv) or the store's referrals table.
+    
+    Fetching, normalizing results and writing them run as separate pipeline
+    stages on their own threads, connected by queues of --queue-size items, so
+    a slow disk write doesn't stall fetching. The throughput of each stage is
+    logged every --flush-interval seconds.
+    
+    With --store sqlite:PATH records are upserted by ACN into a SQLite database
+    instead, so reruns and resumes never create duplicates.
+    
+    --format ndjson writes one JSON record per line instead, keeping referrals
+    nested; an output name ending in .gz or .zst compresses each batch.
+    --format parquet (needs pyarrow) writes each batch as a part file of an
+    output.parquet directory. On --resume the saved output's format is used.
+    
+    The outcome of every ACN is appended to a journal (--journal) together with
+    each batch. On --resume, ACNs the journal already has saved are skipped.
+    
+    ACNs whose request fails are not retried inline or written as rows. They are
+    parked in a retry queue (--retry-queue), retried once when the crawl ends,
+    and can be retried again later with the retry-failed command.
+    
+    With --cache responses are kept on disk. Cached items are served without a
+    request while younger than their --cache-ttl and are then revalidated with
+    conditional requests. --offline serves everything from the cache.
+    
+    Request latency, status codes, retries, token refreshes, bytes received and
+    records saved are counted and logged as one summary line every
+    --metrics-interval seconds. They can also be scraped by Prometheus
+    (--metrics-port) or written to a textfile (--metrics-file). --profile logs
+    a breakdown of where the time went when the crawl ends.
+    
+    Examples:
+        ./query.py                                # Run with default settings
+        ./query.py --start-acn Z1865690           # Start from a specific ACN
+        ./query.py --resume                       # Resume from the last save point
+        ./query.py --limit 100                    # Limit to 100 records
+        ./query.py --workers 8 --rate 5           # 8 requests in flight, at most 5 requests/second
+        ./query.py -w 32 --adaptive --rate 50     # Find the concurrency the server tolerates
+        ./query.py --store sqlite:results.db      # Upsert into a SQLite store
+        ./query.py -o output.ndjson.gz            # Compressed NDJSON
+        ./query.py -f parquet                     # Parquet dataset in output.parquet/
+        ./query.py --token-broker http://127.0.0.1:8765  # Share tokens with other crawlers
+        ./query.py --cache snapr_cache.db         # Reuse cached responses
+        ./query.py --offline -o test.csv          # Replay a crawl from the cache only
+        ./query.py -w 8 --metrics-port 9108       # Expose metrics to Prometheus
+        ./query.py --debug                        # Enable debug logging
+    """
+    # Set debug logging if requested
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Debug logging enabled")
+    # Check if we should resume from a save point
+    if resume:
+        state = load_state()
+        if state:
+            current_acn = state["current_acn"]
+            output_path = Path(state["output_path"])
+            output_format = None
+            start_count = state.get("count", 0)
+            store = state.get("store", store)
+            if "output_bytes" in state and not store:
+                truncate_to_checkpoint(output_path, state["output_bytes"])
+            elif output_path.is_dir() and not store:
+                ParquetSink.discard_after(output_path, state["timestamp"])
+            if "referrals_bytes" in state and not store:
+                truncate_to_checkpoint(referrals_path(output_path), state["referrals_bytes"])
+            logger.info(f"Resuming from ACN {current_acn}")
+            logger.info(f"Output path: {output_path}")
+            logger.info(f"Already processed {start_count} records")
+        else:
+            logger.warning("No save point found, starting fresh")
+            current_acn = start_acn
+            start_count = 0
+            logger.info(f"Starting query from ACN {start_acn}")
+            logger.info(f"Output path: {output_path}")
     else:
         current_acn = start_acn
         start_count = 0
         logger.info(f"Starting query from ACN {start_acn}")
         logger.info(f"Output path: {output_path}")
     
+    # Use the shared rate limiter whenever requests run concurrently
+    if rate is None and workers > 1:
+        rate = DEFAULT_RATE
+    limiter = RateLimiter(rate) if rate else None
+    if limiter:
+        logger.info(f"Fetching with {workers} worker(s) at up to {rate} requests/second")
+    controller = ConcurrencyController(workers, target_latency) if adaptive and workers > 1 else None
+    if controller:
+        logger.info(f"Adapting concurrency up to {workers} requests in flight, target latency {target_latency * 1000:.0f}ms")
+    
     # Create a session
-    session = create_session()
+    session = create_session(pool_size=max(workers, 10))
     
     # Initialize variables
-    results = []
     count = start_count
     
-    # Add .csv extension if not present
-    if not str(output_path).endswith('.csv'):
-        output_path = Path(f"{output_path}.csv")
+    # Add the format's extension if not present
+    output_path, output_format = resolve_output(output_path, output_format)
     
-    # Get token if not provided
-    if not token:
-        logger.info("No token provided, attempting to get one using the stored curl command")
-        # Check if we have a curl command in the configuration
-        config = load_config()
-        if not config.get("curl_command"):
-            logger.error("No curl command found in configuration. Please update the curl command using the update-curl command.")
-            logger.error("Example: ./query.py update-curl \"curl 'https://bisexternal.ciamlogin.com/...' ...\"")
+    if store:
+        sink = open_store(store, batch_size=batch_size, flush_interval=flush_interval)
+        logger.info(f"Saving results to {sink.spec}")
+    else:
+        sink = open_sink(output_path, output_format, batch_size=batch_size, flush_interval=flush_interval)
+    
+    journal = Journal(journal_path)
+    
+    # The save point only moves past what the sink stage has written
+    saved_acn, saved_count = current_acn, count
+    
+    def commit() -> None:
+        # Rows first, then the save point that covers them, then the journal. A
+        # resume truncates the output to the save point, so journal entries
+        # written before it moved could claim rows that are cut off again.
+        sink.flush()
+        save_state(saved_acn, output_path, saved_count, sink.size, store, sink.referrals_size)
+        journal.flush()
+        if missing:
+            missing.save()
+        if retry is not None:
+            retry.save()
+    
+    cache = open_cache(cache_path, offline, cache_ttl)
+    missing = open_negative_cache(missing_cache, missing_ttl, recheck_missing)
+    retry = open_retry_queue(retry_queue)
+    
+    # Get token if not provided (offline runs never use it)
+    tokens = make_token_source(session, token or ("offline" if offline else None), token_broker)
+    if not tokens.get():
+        logger.error("Failed to get token. Exiting.")
+        sink.close()
+        return
+    tokens.start()
+    
+    def fetch(acn: str) -> Optional[Dict]:
+        return fetch_acn(session, acn, tokens, limiter, cache, missing, controller)
+    
+    acns = iter_acns(current_acn)
+    if resume:
+        acns = (acn for acn in acns if not journal.is_saved(acn))
+    if limit is not None and count >= limit:
+        logger.info(f"Reached limit of {limit} queries")
+        acns = iter(())
+    
+    # Runs of missing ACNs as (first ACN, length)
+    gaps: List[Tuple[str, int]] = []
+    gap_start: Optional[str] = None
+    gap_length = 0
+    
+    # Retry failed ACNs at the end only if the crawl ran its course online
+    drain = not offline
+    failed = 0
+    # Failed in this run; their backoff hasn't run out by the end of a crawl
+    failed_acns: List[str] = []
+    stopped = False
+    
+    def classify(item: Tuple[str, Optional[Dict]]) -> Iterator[Tuple]:
+        # Normalize stage: decide what each result means, in ACN order. Yields
+        # (acn, outcome, record, ACN to resume from, record count) for the sink.
+        nonlocal current_acn, count, gap_start, gap_length, failed, drain, stopped
+        if stopped:
             return
+        acn, data = item
+        current_acn = acn
         
-        token_data = get_token_from_curl()
-        if not token_data:
-            logger.error("Failed to get token. Exiting.")
+        # A 401 here means the token could not be refreshed
+        if is_unauthorized(data):
+            logger.error("Failed to refresh token. Saving state and exiting.")
             logger.error("Please update the curl command using the update-curl command.")
+            drain = False
+            stopped = True
+            pipeline.stop()
+            yield acn, "401", None, acn, count
+            return
+        
+        # A 404 starts or extends a gap; a long enough gap ends the crawl
+        if data is None:
+            if gap_length == 0:
+                gap_start = acn
+            gap_length += 1
+            if gap_length > max_gap:
+                # Resume from the start of the gap
+                current_acn = gap_start
+                logger.info(f"No more data found after ACN {gap_start} ({gap_length} consecutive ACNs missing)")
+                stopped = True
+                pipeline.stop()
+            yield acn, "404", None, current_acn, count
             return
+        if gap_length:
+            logger.info(f"Skipped gap of {gap_length} missing ACN(s) from {gap_start}")
+            gaps.append((gap_start, gap_length))
+            gap_length = 0
+        
+        # Move on to the next ACN
+        current_acn = decrement_acn(acn)
         
-        logger.debug(f"Token data keys: {token_data.keys()}")
-        token = token_data.get("access_token")
-        if not token:
-            logger.error("No access token found in response. Exiting.")
-            logger.error("Response: " + json.dumps(token_data)[:100] + "...")
+        # Failed requests are parked for a later retry instead of written
+        if is_error_result(data):
+            if retry is not None:
+                retry.add(acn, data.get("error"))
+                failed_acns.append(acn)
+            failed += 1
+            yield acn, "error", None, current_acn, count
             return
         
-        logger.info("Successfully obtained token")
+        count += 1
+        yield acn, "ok", data, current_acn, count
+        
+        # Progress is reported by the metrics summary
+        if count % 10 == 0:
+            logger.debug(f"Processed {count} records")
+        
+        # Check if we've reached the limit
+        if limit is not None and count >= limit:
+            logger.info(f"Reached limit of {limit} queries")
+            stopped = True
+            pipeline.stop()
     
+    def save(item: Tuple) -> None:
+        # Sink stage: write records and outcomes, then checkpoint the batch
+        nonlocal saved_acn, saved_count
+        acn, outcome, data, saved_acn, saved_count = item
+        if data is not None:
+            sink.write(data)
+        journal.record(acn, outcome)
+        if sink.should_flush():
+            commit()
+    
+    pipeline = Pipeline(queue_size)
+    pipeline.add(PipelineStage("fetch", source=fetch_in_order(fetch, acns, workers)))
+    pipeline.add(PipelineStage("normalize", classify))
+    pipeline.add(PipelineStage("sink", save))
+    reporter = MetricsReporter(metrics_interval, metrics_file)
+    reporter.start()
+    metrics_server = start_metrics_server(port=metrics_port) if metrics_port is not None else None
+    if metrics_server:
+        logger.info(f"Serving metrics at http://127.0.0.1:{metrics_server.server_port}/metrics")
     try:
-        while True:
-            # Check if we've reached the limit
-            if limit is not None and count >= limit:
-                logger.info(f"Reached limit of {limit} queries")
-                break
-            
-            # Query the ACN
-            data = query_acn(session, current_acn, token)
-            
-            # Handle 401 error (unauthorized) - token might have expired
-            if isinstance(data, dict) and data.get("acn") == current_acn and "error" in data and data["error"].get("status") == 401:
-                logger.warning("Token expired (401 Unauthorized). Attempting to refresh...")
-                
-                # Check if we have a curl command in the configuration
-                config = load_config()
-                if not config.get("curl_command"):
-                    logger.error("No curl command found in configuration. Please update the curl command using the update-curl command.")
-                    logger.error("Example: ./query.py update-curl \"curl 'https://bisexternal.ciamlogin.com/...' ...\"")
-                    save_state(current_acn, output_path, count)
-                    break
-                
-                token_data = get_token_from_curl()
-                if not token_data:
-                    logger.error("Failed to refresh token. Saving state and exiting.")
-                    logger.error("Please update the curl command using the update-curl command.")
-                    save_state(current_acn, output_path, count)
-                    break
-                
-                logger.debug(f"Token refresh data keys: {token_data.keys()}")
-                token = token_data.get("access_token")
-                if not token:
-                    logger.error("No access token found in response. Saving state and exiting.")
-                    logger.error("Response: " + json.dumps(token_data)[:100] + "...")
-                    save_state(current_acn, output_path, count)
-                    break
-                
-                logger.info("Token refreshed. Retrying query...")
-                data = query_acn(session, current_acn, token)
-            
-            # If we get a 404, break the loop
-            if data is None:
-                logger.info(f"No more data found after ACN {current_acn}")
-                break
-            
-            # Add the data to the results
-            results.append(data)
-            count += 1
-            
-            # Log progress every 10 records
-            if count % 10 == 0:
-                logger.info(f"Processed {count} records")
-                # Save state periodically
-                save_state(current_acn, output_path, count)
-            
-            # Decrement the ACN
-            current_acn = decrement_acn(current_acn)
-            
+        pipeline.run(report_interval=flush_interval)
+        
+        if retry is not None and drain:
+            counts = drain_retry_queue(retry, fetch, sink, journal, workers, include=failed_acns)
+            count += counts["ok"]
+            saved_count += counts["ok"]
+            if any(counts.values()):
+                logger.info(f"Retried failed ACNs: {counts['ok']} recovered, {counts['404']} missing, "
+                            f"{counts['error']} still failing")
     except KeyboardInterrupt:
         logger.info("Query interrupted by user")
-        save_state(current_acn, output_path, count)
     except Exception as e:
         logger.error(f"Error occurred: {e}")
-        save_state(current_acn, output_path, count)
     finally:
-        # Save the results to a CSV file
-        save_to_csv(results, output_path)
+        tokens.stop()
+        # Write the last batch and save state
+        commit()
+        sink.close()
+        if cache:
+            cache.close()
+        if missing:
+            missing.close()
+        reporter.stop()
+        if metrics_server:
+            metrics_server.shutdown()
+        pipeline.log_summary()
+        if controller:
+            logger.info(controller.summary())
+        if profile:
+            logger.info("Profile:")
+            for stage in pipeline.stages:
+                logger.info(f"  {stage.summary()}")
+            for line in metrics.profile():
+                logger.info(f"  {line}")
+        if gaps:
+            longest_start, longest = max(gaps, key=lambda gap: gap[1])
+            logger.info(f"Skipped {len(gaps)} gap(s) totalling {sum(length for _, length in gaps)} missing ACNs; "
+                        f"longest was {longest} from {longest_start}")
+        if failed:
+            logger.warning(f"{failed} ACN(s) failed during the crawl" +
+                           (f"; {len(retry)} queued for retry-failed" if retry is not None else ""))
         logger.info(f"Query complete. Processed {count} records.")
 
+@app.command("retry-failed")
+def retry_failed(
+    output_path: Path = typer.Option(DEFAULT_OUTPUT_PATH, "--output", "-o", help="The file to append recovered records to"),
+    output_format: str = typer.Option(None, "--format", "-f", help="Output format: csv, ndjson or parquet (default: from the --output extension, else csv)"),
+    store: str = typer.Option(None, "--store", help="Save recovered records to a result store instead, e.g. sqlite:results.db"),
+    retry_queue: Path = typer.Option(RETRY_FILE, "--retry-queue", help="The retry queue written by query"),
+    everything: bool = typer.Option(False, "--all", help="Retry every queued ACN now, including ones given up on"),
+    from_journal: bool = typer.Option(False, "--from-journal", help="Also queue ACNs the journal records as failed, e.g. by crawl"),
+    journal_path: Path = typer.Option(JOURNAL_FILE, "--journal", help="The journal that records the outcome of every ACN"),
+    token: str = typer.Option(None, "--token", "-t", help="The authentication token for the SNAPR API (optional)"),
+    token_broker: str = typer.Option(None, "--token-broker", envvar="SNAPR_TOKEN_BROKER", help="Get tokens from a shared token broker, e.g. http://127.0.0.1:8765"),
+    workers: int = typer.Option(1, "--workers", "-w", min=1, help="Number of requests in flight (1 = sequential)"),
+    rate: float = typer.Option(DEFAULT_RATE, "--rate", help="Request rate limit in requests/second"),
+    cache_path: Path = typer.Option(None, "--cache", help=f"Cache responses in this file (e.g. {CACHE_FILE})"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
+):
+    """
+    Retry ACNs whose request failed during earlier runs.
+    
+    ACNs in the retry queue are retried once their backoff has passed (or all of
+    them with --all). Recovered records are appended to the output, ACNs that
+    are now missing are dropped and the rest are rescheduled.
+    
+    Examples:
+        ./query.py retry-failed                   # Retry what is due
+        ./query.py retry-failed --all --store sqlite:results.db
+        ./query.py retry-failed --from-journal -o crawl.csv
+    """
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Debug logging enabled")
+    queue = RetryQueue(retry_queue)
+    journal = Journal(journal_path)
+    if from_journal:
+        for lo, hi in journal.outcomes["error"]:
+            for number in range(lo, hi + 1):
+                acn = int_to_acn(number, journal.prefix)
+                if acn not in queue:
+                    queue.add(acn, {"status": None, "message": "Recorded as failed in the journal"}, immediate=True)
+    if not queue:
+        logger.info("Retry queue is empty")
+        return
+    
+    if store:
+        sink = open_store(store)
+    else:
+        sink = open_sink(*resolve_output(output_path, output_format))
+    limiter = RateLimiter(rate)
+    session = create_session(pool_size=max(workers, 10))
+    tokens = make_token_source(session, token, token_broker)
+    if not tokens.get():
+        logger.error("Failed to get token. Exiting.")
+        sink.close()
+        raise typer.Exit(1)
+    cache = open_cache(cache_path)
+    
+    def fetch(acn: str) -> Optional[Dict]:
+        return fetch_acn(session, acn, tokens, limiter, cache)
+    
+    try:
+        counts = drain_retry_queue(queue, fetch, sink, journal, workers, everything)
+    except KeyboardInterrupt:
+        logger.info("Retry interrupted by user")
+        counts = None
+    finally:
+        sink.close()
+        queue.save()
+        if cache:
+            cache.close()
+    if counts is not None:
+        logger.info(f"Recovered {counts['ok']} records, {counts['404']} ACNs missing, {counts['error']} still failing")
+    exhausted = queue.exhausted()
+    logger.info(f"{len(queue)} ACN(s) left in the retry queue" +
+                (f", {len(exhausted)} given up on (use --all)" if exhausted else ""))
+
+@app.command()
+def probe(
+    start_acn: str = typer.Option(DEFAULT_START_ACN, "--start-acn", "-s", help="An ACN near the live range to start probing from"),
+    direction: str = typer.Option("both", "--direction", help="Which boundary to find: up, down or both"),
+    max_gap: int = typer.Option(10, "--max-gap", min=0, help="Treat holes of up to N missing ACNs as part of the live range"),
+    missing_cache: Path = typer.Option(MISSING_FILE, "--missing-cache", help="Remember ACNs that returned 404 in this file and skip them"),
+    missing_ttl: str = typer.Option(DEFAULT_MISSING_TTL, "--missing-ttl", help="How long a 404 is remembered, e.g. 12h or 7d"),
+    recheck_missing: bool = typer.Option(False, "--recheck-missing", help="Request ACNs remembered as missing anyway"),
+    token: str = typer.Option(None, "--token", "-t", help="The authentication token for the SNAPR API (optional)"),
+    token_broker: str = typer.Option(None, "--token-broker", envvar="SNAPR_TOKEN_BROKER", help="Get tokens from a shared token broker, e.g. http://127.0.0.1:8765"),
+    rate: float = typer.Option(DEFAULT_RATE, "--rate", help="Request rate limit in requests/second"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
+):
+    """
+    Find the highest and lowest live ACNs with few requests.
+    
+    Probing steps away from a live ACN in exponentially growing strides and then
+    bisects back to the boundary, stepping over holes of up to --max-gap ACNs.
+    The highest live ACN is the place to start a fresh crawl with --start-acn.
+    
+    Examples:
+        ./query.py probe                          # Find both boundaries around the default start ACN
+        ./query.py probe --direction up           # Only find the newest ACN
+    """
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Debug logging enabled")
+    if direction not in ("up", "down", "both"):
+        raise typer.BadParameter("--direction must be up, down or both")
+    
+    session = create_session()
+    limiter = RateLimiter(rate)
+    tokens = make_token_source(session, token, token_broker)
+    if not tokens.get():
+        logger.error("Failed to get token. Exiting.")
+        raise typer.Exit(1)
+    tokens.start()
+    
+    prefix = start_acn[0]
+    seen: Dict[int, bool] = {}
+    missing = open_negative_cache(missing_cache, missing_ttl, recheck_missing)
+    
+    def is_live(number: int) -> bool:
+        if number not in seen:
+            data = fetch_acn(session, int_to_acn(number, prefix), tokens, limiter, missing=missing)
+            if is_unauthorized(data):
+                raise RuntimeError("Failed to refresh token")
+            # Errors other than 404 still mean the ACN exists
+            seen[number] = data is not None
+        return seen[number]
+    
+    try:
+        # Find a live anchor near the start ACN
+        anchor = next(
+            (number for number in range(acn_to_int(start_acn), acn_to_int(start_acn) - max_gap - 1, -1) if is_live(number)),
+            None,
+        )
+        if anchor is None:
+            logger.error(f"No live ACN within {max_gap} below {start_acn}; try another --start-acn or a larger --max-gap")
+            raise typer.Exit(1)
+        
+        if direction in ("up", "both"):
+            highest = probe_boundary(is_live, anchor, 1, max_gap)
+            typer.echo(f"Highest live ACN: {int_to_acn(highest, prefix)}")
+        if direction in ("down", "both"):
+            lowest = probe_boundary(is_live, anchor, -1, max_gap)
+            typer.echo(f"Lowest live ACN:  {int_to_acn(lowest, prefix)}")
+        typer.echo(f"Requests used:    {len(seen) - (missing.skipped if missing else 0)}")
+    except RuntimeError as e:
+        logger.error(f"{e}. Please update the curl command using the update-curl command.")
+        raise typer.Exit(1)
+    finally:
+        tokens.stop()
+        if missing:
+            missing.close()
+
+def rewrite_csv(output_path: Path, updates: Dict[str, Dict]) -> int:
+    """
+    Replace records in a result CSV in place.
+    
+    The file is streamed into a temporary file with updated rows substituted
+    and then moved over the original, so readers never see a partial file.
+    
+    Args:
+        output_path: The result CSV to update
+        updates: The new records keyed by ACN
+        
+    Returns:
+        The number of rows replaced
+    """
+    tmp_path = output_path.with_name(f"{output_path.name}.tmp")
+    replaced = 0
+    with open(output_path, 'r', newline='') as src, open(tmp_path, 'w', newline='') as dst:
+        reader = csv.DictReader(src)
+        writer = csv.DictWriter(dst, fieldnames=reader.fieldnames, extrasaction='ignore')
+        writer.writeheader()
+        for row in reader:
+            record = updates.get(row.get("acn"))
+            if record is not None:
+                writer.writerow(record)
+                replaced += 1
+            else:
+                writer.writerow(row)
+        dst.flush()
+        os.fsync(dst.fileno())
+    os.replace(tmp_path, output_path)
+    return replaced
+
+@app.command()
+def refresh(
+    input_path: Path = typer.Option(Path("./output.csv"), "--input", "-i", help="The result CSV to refresh in place"),
+    store: str = typer.Option(None, "--store", help="Refresh a result store instead of a CSV file, e.g. sqlite:results.db"),
+    since: str = typer.Option(None, "--since", help="Also refresh items registered on or after this date (YYYY-MM-DD)"),
+    only: List[str] = typer.Option(None, "--acn", "-a", help="Refresh only these ACNs, whatever their state (repeatable)"),
+    token: str = typer.Option(None, "--token", "-t", help="The authentication token for the SNAPR API (optional)"),
+    token_broker: str = typer.Option(None, "--token-broker", envvar="SNAPR_TOKEN_BROKER", help="Get tokens from a shared token broker, e.g. http://127.0.0.1:8765"),
+    workers: int = typer.Option(4, "--workers", "-w", min=1, help="Number of requests in flight"),
+    rate: float = typer.Option(DEFAULT_RATE, "--rate", help="Global request rate limit in requests/second"),
+    limit: int = typer.Option(None, "--limit", "-l", help="Refresh at most N items (optional)"),
+    dry_run: bool = typer.Option(False, "--dry-run", help="Only report which items would be refreshed"),
+    cache_path: Path = typer.Option(None, "--cache", help=f"Revalidate and update cached responses in this file (e.g. {CACHE_FILE})"),
+    offline: bool = typer.Option(False, "--offline", help="Refresh from the response cache without network requests"),
+    missing_cache: Path = typer.Option(MISSING_FILE, "--missing-cache", help="Remember ACNs that returned 404 in this file and skip them"),
+    missing_ttl: str = typer.Option(DEFAULT_MISSING_TTL, "--missing-ttl", help="How long a 404 is remembered, e.g. 12h or 7d"),
+    recheck_missing: bool = typer.Option(False, "--recheck-missing", help="Request ACNs remembered as missing anyway"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
+):
+    """
+    Re-query only the work items that can still change and update them in place.
+    
+    An item is selected if it is not COMPLETED with a final decision, still has
+    pending referrals, or was registered on or after --since. Completed items are
+    never requested again.
+    
+    Examples:
+        ./query.py refresh                              # Refresh output.csv
+        ./query.py refresh --since 2025-04-01           # Also refresh everything registered since April
+        ./query.py refresh --store sqlite:results.db    # Refresh a result store
+        ./query.py refresh -a Z1860693 -a Z1860690      # Refresh two items
+    """
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Debug logging enabled")
+    
+    # Select the items to refresh
+    result_store = open_store(store) if store else None
+    if result_store:
+        if only:
+            acns = [acn for acn in only if result_store.get(acn) is not None]
+        else:
+            acns = result_store.select_refresh_candidates(since)
+        source = result_store.spec
+    else:
+        if not input_path.exists():
+            logger.error(f"Input file {input_path} does not exist")
+            raise typer.Exit(1)
+        if only:
+            # Named items are checked against the ACN index instead of parsing the file
+            index = open_csv_index(input_path)
+            acns = [acn for acn in only if acn in index]
+        else:
+            with open(input_path, 'r', newline='') as f:
+                acns = [row["acn"] for row in map(decode_csv_record, csv.DictReader(f)) if row.get("acn") and needs_refresh(row, since)]
+        source = str(input_path)
+    if only and len(acns) < len(only):
+        logger.warning(f"{len(only) - len(acns)} of the given ACNs are not in {source} and are skipped")
+    if limit is not None:
+        acns = acns[:limit]
+    logger.info(f"Selected {len(acns)} items to refresh from {source}")
+    if dry_run or not acns:
+        if result_store:
+            result_store.close()
+        return
+    
+    limiter = RateLimiter(rate)
+    session = create_session(pool_size=max(workers, 10))
+    # Refreshing always asks the server, but unchanged items cost only a 304
+    cache = open_cache(cache_path, offline, revalidate=not offline)
+    missing = open_negative_cache(missing_cache, missing_ttl, recheck_missing)
+    tokens = make_token_source(session, token or ("offline" if offline else None), token_broker)
+    if not tokens.get():
+        logger.error("Failed to get token. Exiting.")
+        if result_store:
+            result_store.close()
+        raise typer.Exit(1)
+    tokens.start()
+    
+    def fetch(acn: str) -> Optional[Dict]:
+        return fetch_acn(session, acn, tokens, limiter, cache, missing)
+    
+    updates: Dict[str, Dict] = {}
+    not_found = failed = 0
+    results_in_order = fetch_in_order(fetch, iter(acns), workers)
+    try:
+        for acn, data in results_in_order:
+            if is_unauthorized(data):
+                logger.error("Failed to refresh token. Saving what was refreshed so far.")
+                break
+            
+            if data is None:
+                logger.warning(f"ACN {acn} is no longer found (404), keeping the stored record")
+                not_found += 1
+                continue
+            if is_error_result(data):
+                failed += 1
+                continue
+            
+            updates[acn] = data
+            if result_store:
+                result_store.write(data)
+                if result_store.should_flush():
+                    result_store.flush()
+            if len(updates) % 10 == 0:
+                logger.info(f"Refreshed {len(updates)} of {len(acns)} items")
+    except KeyboardInterrupt:
+        logger.info("Refresh interrupted by user")
+    finally:
+        results_in_order.close()
+        tokens.stop()
+        if cache:
+            cache.close()
+        if missing:
+            missing.close()
+        if result_store:
+            result_store.close()
+        elif updates:
+            rewrite_csv(input_path, updates)
+            write_referrals_csv(iter_csv_records(input_path), referrals_path(input_path))
+            if CsvIndex.index_path_for(input_path).exists():
+                open_csv_index(input_path)
+        logger.info(f"Refresh complete. Updated {len(updates)} items, {not_found} not found, {failed} failed.")
+
+class RecheckSchedule:
+    """
+    When each pending work item watched by the watch command is due for a re-check.
+    
+    A newly seen item is first re-checked after `base` seconds. Every check
+    that finds it unchanged doubles its interval up to `maximum`; a change
+    resets it to `base`. Items that reach a terminal state, or were registered
+    before `cutoff` (an ISO date), are dropped. Entries are kept as
+    {acn: {"due", "interval", "digest", "registered"}} so they can be saved
+    as JSON and the schedule survives restarts.
+    """
+    
+    def __init__(self, base: float, maximum: float, cutoff: Optional[str] = None, entries: Optional[Dict[str, Dict]] = None):
+        self.base = base
+        self.maximum = maximum
+        self.cutoff = cutoff
+        self.entries: Dict[str, Dict] = entries or {}
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def _expired(self, record: Dict) -> bool:
+        registered = to_iso_date(record.get("registrationDate"))
+        return bool(self.cutoff and registered and registered < self.cutoff)
+    
+    def add(self, record: Dict, now: float) -> bool:
+        """
+        Start watching a record if it can still change.
+        
+        Returns:
+            True if the record is now scheduled
+        """
+        if is_terminal(record) or self._expired(record):
+            return False
+        self.entries[record["acn"]] = {
+            "due": now + self.base,
+            "interval": self.base,
+            "digest": record_digest(record).hex(),
+            "registered": to_iso_date(record.get("registrationDate")),
+        }
+        return True
+    
+    def due(self, now: float, limit: Optional[int] = None) -> List[str]:
+        """Return the ACNs due for a re-check, longest overdue first."""
+        due = sorted((entry["due"], acn) for acn, entry in self.entries.items() if entry["due"] <= now)
+        return [acn for _, acn in due[:limit]]
+    
+    def checked(self, acn: str, record: Optional[Dict], now: float) -> bool:
+        """
+        Reschedule an item after a re-check.
+        
+        Args:
+            acn: The re-checked ACN
+            record: The record the API returned, None for a 404
+            now: The time of the check
+            
+        Returns:
+            True if the record changed since the last check
+        """
+        entry = self.entries.get(acn)
+        if entry is None:
+            return False
+        changed = record is not None and record_digest(record).hex() != entry["digest"]
+        if record is not None and (is_terminal(record) or self._expired(record)):
+            del self.entries[acn]
+            return changed
+        entry["interval"] = self.base if changed else min(entry["interval"] * 2, self.maximum)
+        entry["due"] = now + entry["interval"]
+        if record is not None:
+            entry["digest"] = record_digest(record).hex()
+        return changed
+    
+    def next_due(self) -> Optional[float]:
+        """Return when the next item is due, or None if nothing is watched."""
+        return min((entry["due"] for entry in self.entries.values()), default=None)
+
+def load_watch_state(path: Path) -> Optional[Dict]:
+    """Load the high-water mark and re-check schedule saved by watch, if any."""
+    if not path.exists():
+        return None
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to load watch state from {path}: {e}")
+        return None
+
+def find_high_water(result_store: Optional[SqliteStore], output_path: Path) -> Optional[str]:
+    """Return the highest ACN held in a result store or result CSV, or None if there is none."""
+    if result_store is not None:
+        return result_store.newest_acn()
+    if not output_path.exists():
+        return None
+    index = open_csv_index(output_path)
+    return int_to_acn(max(index.offsets), index.prefix) if index.offsets else None
+
+@app.command()
+def watch(
+    output_path: Path = typer.Option(Path("./output.csv"), "--output", "-o", help="The result CSV to append new and changed items to"),
+    store: str = typer.Option(None, "--store", help="Save results to a result store instead of the CSV file, e.g. sqlite:results.db"),
+    from_acn: str = typer.Option(None, "--from", help="Probe above this ACN instead of the newest one held"),
+    poll_interval: str = typer.Option(DEFAULT_POLL_INTERVAL, "--interval", help="Time between ticks, e.g. 90, 5m or 1h"),
+    probe_size: int = typer.Option(DEFAULT_PROBE_SIZE, "--probe-size", min=1, help="ACNs above the high-water mark probed at a time; larger gaps are not crossed"),
+    recheck_interval: str = typer.Option(DEFAULT_RECHECK_INTERVAL, "--recheck-interval", help="First re-check of a pending item, doubled each time it hasn't changed"),
+    recheck_max: str = typer.Option(DEFAULT_RECHECK_MAX, "--recheck-max", help="Longest interval between re-checks of a pending item"),
+    recent: str = typer.Option(DEFAULT_RECENT, "--recent", help="Only re-check pending items registered within this period"),
+    max_rechecks: int = typer.Option(None, "--max-rechecks", help="Re-check at most N items per tick (optional)"),
+    state_path: Path = typer.Option(WATCH_STATE_FILE, "--state", help="Where the high-water mark and re-check schedule are kept"),
+    once: bool = typer.Option(False, "--once", help="Run a single tick and exit, e.g. from cron"),
+    token: str = typer.Option(None, "--token", "-t", help="The authentication token for the SNAPR API (optional)"),
+    token_broker: str = typer.Option(None, "--token-broker", envvar="SNAPR_TOKEN_BROKER", help="Get tokens from a shared token broker, e.g. http://127.0.0.1:8765"),
+    workers: int = typer.Option(4, "--workers", "-w", min=1, help="Number of requests in flight"),
+    rate: float = typer.Option(DEFAULT_RATE, "--rate", help="Global request rate limit in requests/second"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
+):
+    """
+    Follow new work items as they are registered and keep pending ones fresh.
+    
+    Every --interval the ACNs just above the high-water mark (the newest ACN
+    held) are probed --probe-size at a time. New items are saved and the mark
+    moves up until a whole batch is missing. Ticks run at a fixed rate from the
+    start rather than a fixed delay after the previous tick; a tick that
+    overruns skips the ticks it missed.
+    
+    New items that can still change, and on the first run the pending items
+    registered within --recent, are re-checked on a decaying schedule: after
+    --recheck-interval, then twice as long after every check that finds no
+    change, up to --recheck-max. A change starts the schedule over; completed
+    items drop out. The mark and schedule are kept in --state.
+    
+    New and changed items are upserted into the --store or appended to the
+    result CSV, where the last row of an ACN is its current state.
+    
+    Examples:
+        ./query.py watch --store sqlite:results.db            # Poll every 5 minutes
+        ./query.py watch --interval 1m --probe-size 20
+        ./query.py watch --once                               # One tick, e.g. from cron
+    """
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Debug logging enabled")
+    interval = parse_duration(poll_interval)
+    if interval <= 0:
+        raise typer.BadParameter("--interval must be positive")
+    cutoff = time.strftime("%Y-%m-%d", time.localtime(time.time() - parse_duration(recent)))
+    
+    result_store = open_store(store) if store else None
+    sink = result_store or CsvSink(output_path)
+    
+    # Pick up where the last watch left off, else start from the newest item held
+    state = load_watch_state(state_path)
+    if state:
+        high_water = from_acn or state["high_water"]
+        schedule = RecheckSchedule(parse_duration(recheck_interval), parse_duration(recheck_max), cutoff, state.get("schedule"))
+    else:
+        high_water = from_acn or find_high_water(result_store, output_path)
+        schedule = RecheckSchedule(parse_duration(recheck_interval), parse_duration(recheck_max), cutoff)
+        existing = result_store.iter_records() if result_store else iter_csv_records(output_path) if output_path.exists() else iter(())
+        now = time.time()
+        for record in existing:
+            if (to_iso_date(record.get("registrationDate")) or "") >= cutoff:
+                schedule.add(record, now)
+    if high_water is None:
+        logger.error("Nothing to watch from: the output is empty. Use --from ACN or run a crawl first.")
+        sink.close()
+        raise typer.Exit(1)
+    logger.info(f"Watching above {high_water}, {len(schedule)} pending item(s) scheduled for re-checks")
+    
+    limiter = RateLimiter(rate)
+    session = create_session(pool_size=max(workers, 10))
+    tokens = make_token_source(session, token, token_broker)
+    if not tokens.get():
+        logger.error("Failed to get token. Exiting.")
+        sink.close()
+        raise typer.Exit(1)
+    tokens.start()
+    
+    # No negative cache: 404s above the mark are exactly what turns into new items
+    def fetch(acn: str) -> Optional[Dict]:
+        return fetch_acn(session, acn, tokens, limiter)
+    
+    def tick() -> bool:
+        # Probe upwards, then re-check what is due; False if the token is gone
+        nonlocal high_water
+        probed = found = 0
+        unauthorized = False
+        prefix, top = high_water[0], acn_to_int(high_water)
+        for _ in range(MAX_PROBE_BATCHES):
+            batch = [int_to_acn(top + offset, prefix) for offset in range(1, probe_size + 1)]
+            newest = None
+            failed = False
+            for acn, data in list(fetch_in_order(fetch, iter(batch), workers)):
+                probed += 1
+                unauthorized = is_unauthorized(data)
+                if data is None:
+                    continue
+                if unauthorized or is_error_result(data):
+                    # The mark stops below a failed probe, and everything above it
+                    # is left for the next tick so nothing is written twice
+                    failed = True
+                    break
+                sink.write(data)
+                schedule.add(data, time.time())
+                found += 1
+                newest = acn
+            if newest is not None:
+                top = acn_to_int(newest)
+                high_water = newest
+            if newest is None or failed:
+                break
+        
+        due = [] if unauthorized else schedule.due(time.time(), max_rechecks)
+        changed = 0
+        for acn, data in list(fetch_in_order(fetch, iter(due), workers)):
+            if is_unauthorized(data):
+                unauthorized = True
+                break
+            if data is not None and is_error_result(data):
+                continue
+            if schedule.checked(acn, data, time.time()):
+                sink.write(data)
+                changed += 1
+        
+        # Keep what this tick found even if the token was rejected part way
+        sink.flush()
+        write_json_atomic(state_path, {"high_water": high_water, "schedule": schedule.entries, "timestamp": time.time()})
+        logger.info(f"Probed {probed} ACN(s): {found} new, high-water mark {high_water}; "
+                    f"re-checked {len(due)}, {changed} changed, {len(schedule)} pending")
+        return not unauthorized
+    
+    try:
+        next_tick = time.monotonic()
+        while True:
+            if not tick():
+                logger.error("Failed to refresh token. Please update the curl command using the update-curl command.")
+                break
+            if once:
+                break
+            next_tick += interval
+            now = time.monotonic()
+            if next_tick < now:
+                missed = int((now - next_tick) // interval) + 1
+                logger.warning(f"Tick overran the {interval:.0f}s interval, skipping {missed} tick(s)")
+                next_tick += missed * interval
+            time.sleep(next_tick - now)
+    except KeyboardInterrupt:
+        logger.info("Watch stopped by user")
+    finally:
+        tokens.stop()
+        sink.close()
+
+def shard_ranges(hi: int, lo: int, shards: int) -> List[Tuple[int, int]]:
+    """
+    Split the ACN numbers from hi down to lo into contiguous shards.
+    
+    Args:
+        hi: The highest ACN number
+        lo: The lowest ACN number
+        shards: The number of shards
+        
+    Returns:
+        (hi, lo) for each shard, highest shard first
+    """
+    size = -(-(hi - lo + 1) // shards)
+    ranges = []
+    for shard in range(shards):
+        shard_hi = hi - shard * size
+        if shard_hi < lo:
+            break
+        ranges.append((shard_hi, max(lo, shard_hi - size + 1)))
+    return ranges
+
+def shard_output_path(output_path: Path, shard: int) -> Path:
+    """Return the segment file a crawl shard writes to."""
+    return output_path.with_name(f"{output_path.stem}.shard-{shard}{output_path.suffix}")
+
+def _crawl_shard(
+    shard: int,
+    hi: int,
+    lo: int,
+    prefix: str,
+    segment_path: Path,
+    journal_path: Path,
+    limiter: RateLimiter,
+    broker_url: str,
+    workers: int,
+    batch_size: int,
+    cache_path: Optional[Path],
+    missing_cache: Optional[Path],
+    missing_ttl: str,
+    recheck_missing: bool,
+    log_level: int,
+) -> None:
+    """
+    Crawl one shard of a range in a worker process.
+    
+    Every ACN from hi down to lo that the journal has not saved is fetched.
+    Records go to the shard's own segment file and outcomes to the shared
+    journal, which is what a re-run resumes from. The 404s the shard requests
+    are merged into the shared negative cache.
+    """
+    logger.setLevel(log_level)
+    session = create_session(pool_size=max(workers, 10))
+    tokens = BrokerTokenClient(broker_url, session)
+    journal = Journal(journal_path)
+    # The merged output gets the referrals sidecar
+    sink = CsvSink(segment_path, batch_size=batch_size, referrals=False)
+    cache = open_cache(cache_path)
+    missing = open_negative_cache(missing_cache, missing_ttl, recheck_missing)
+    
+    def fetch(acn: str) -> Optional[Dict]:
+        return fetch_acn(session, acn, tokens, limiter, cache, missing)
+    
+    acns = (int_to_acn(number, prefix) for number in range(hi, lo - 1, -1))
+    acns = (acn for acn in acns if not journal.is_saved(acn))
+    count = 0
+    results_in_order = fetch_in_order(fetch, acns, workers)
+    try:
+        for acn, data in results_in_order:
+            if is_unauthorized(data):
+                journal.record(acn, "401")
+                logger.error(f"Shard {shard}: failed to refresh token, stopping")
+                break
+            if data is None:
+                journal.record(acn, "404")
+                continue
+            if is_error_result(data):
+                journal.record(acn, "error")
+                continue
+            sink.write(data)
+            journal.record(acn, "ok")
+            count += 1
+            if sink.should_flush():
+                sink.flush()
+                journal.flush()
+                if missing:
+                    missing.save()
+                logger.info(f"Shard {shard}: saved {count} records, at {acn}")
+    except KeyboardInterrupt:
+        logger.info(f"Shard {shard}: interrupted")
+    finally:
+        results_in_order.close()
+        sink.close()
+        journal.flush()
+        if cache:
+            cache.close()
+        if missing:
+            missing.close()
+        logger.info(f"Shard {shard}: done, {count} records saved to {segment_path}")
+
+def is_acn(value: str) -> bool:
+    """Check whether a string has the shape of an ACN (format: Z#######)."""
+    return len(value) > 1 and value[0].isalpha() and value[1:].isdigit()
+
+def _read_result_rows(path: Path, fields: List[str], counts: Dict[str, int]) -> Iterator[List[str]]:
+    """
+    Read the rows of a result CSV in the column order of fields.
+    
+    save_to_csv can append rows in sorted column order under a header in a
+    different order, and a repeated header line switches the order for the
+    rows after it. A row whose acn cell isn't an ACN is tried in the sorted
+    order; rows that still don't fit are counted as malformed and skipped.
+    """
+    positions = {field: i for i, field in enumerate(fields)}
+    
+    def layouts(columns: List[str]) -> List[Tuple[int, int, List[int]]]:
+        # (row length, acn cell, target of each cell) for the header order and the sorted order
+        return [(len(order), order.index("acn"), [positions[column] for column in order])
+                for order in (columns, sorted(columns))]
+    
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader, None)
+        if not columns or "acn" not in columns:
+            logger.warning(f"Skipping {path}: no acn column")
+            return
+        candidates = layouts(columns)
+        for row in reader:
+            if not row:
+                continue
+            if "acn" in row and all(cell in positions for cell in row):
+                candidates = layouts(row)
+                continue
+            for length, acn_cell, targets in candidates:
+                if len(row) == length and is_acn(row[acn_cell]):
+                    break
+            else:
+                counts["malformed"] += 1
+                continue
+            out = [''] * len(fields)
+            for target, value in zip(targets, row):
+                out[target] = value
+            counts["read"] += 1
+            yield out
+
+def _read_run(path: Path) -> Iterator[List]:
+    """Read back a sorted run written by merge_result_files."""
+    with open(path, 'r', newline='') as f:
+        for row in csv.reader(f):
+            yield [int(row[0]), float(row[1]), int(row[2])] + row[3:]
+
+def _merge_runs(runs: List[Iterator[List]], counts: Dict[str, int]) -> Iterator[List]:
+    """Merge sorted runs, keeping the first (newest) entry of each ACN."""
+    last = None
+    for entry in heapq.merge(*runs, key=_run_order):
+        if entry[0] == last:
+            counts["duplicates"] += 1
+            continue
+        last = entry[0]
+        yield entry
+
+def _run_order(entry: List) -> Tuple:
+    # Descending ACN, newest capture first, later rows first
+    return (-entry[0], -entry[1], -entry[2])
+
+def merge_result_files(input_paths: List[Path], output_path: Path, run_size: int = DEFAULT_MERGE_RUN_SIZE,
+                       tmp_dir: Optional[Path] = None, referrals: bool = True) -> Dict[str, int]:
+    """
+    Merge result CSVs into one CSV sorted by descending ACN without duplicates.
+    
+    Inputs are streamed into sorted runs of run_size rows on disk, which are
+    then merged MERGE_FAN_IN at a time, so memory stays bounded whatever the
+    size of the inputs. The columns of all inputs are unified. For an ACN in
+    several rows the newest capture wins: the capture time of a row is the
+    modification time of its file, as in import-csv, and ties go to the row
+    read last.
+    
+    Args:
+        input_paths: The result CSVs to merge; the output may be one of them
+        output_path: The merged CSV to write
+        run_size: Rows sorted in memory at a time
+        tmp_dir: Directory for the sorted runs (default: next to the output)
+        referrals: Also rewrite the output's referrals sidecar
+        
+    Returns:
+        Counts of rows read, duplicates dropped, malformed rows skipped and records written
+    """
+    counts = {"read": 0, "duplicates": 0, "malformed": 0, "written": 0}
+    fields = set(CSV_FIELDS)
+    for input_path in input_paths:
+        with open(input_path, 'r', newline='') as f:
+            fields.update(next(csv.reader(f), []))
+    fields = sorted(fields)
+    
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="snapr-merge-", dir=tmp_dir or output_path.parent) as work_dir:
+        run_paths: List[Path] = []
+        spilled = 0
+        
+        def spill(entries: Iterator[List]) -> Path:
+            nonlocal spilled
+            spilled += 1
+            run_path = Path(work_dir) / f"run-{spilled}.csv"
+            with open(run_path, 'w', newline='') as f:
+                csv.writer(f).writerows(entries)
+            run_paths.append(run_path)
+            return run_path
+        
+        # Split the inputs into sorted runs
+        entries: List[List] = []
+        acn_column = fields.index("acn")
+        seq = 0
+        for input_path in input_paths:
+            captured_at = input_path.stat().st_mtime
+            for row in _read_result_rows(input_path, fields, counts):
+                seq += 1
+                entries.append([acn_to_int(row[acn_column]), captured_at, seq] + row)
+                if len(entries) >= run_size:
+                    entries.sort(key=_run_order)
+                    spill(entries)
+                    entries = []
+        entries.sort(key=_run_order)
+        logger.debug(f"Read {counts['read']} rows into {len(run_paths) + 1} sorted runs")
+        
+        # Merge runs until few enough are left to open at once
+        while len(run_paths) + 1 > MERGE_FAN_IN:
+            group, run_paths[:] = run_paths[:MERGE_FAN_IN], run_paths[MERGE_FAN_IN:]
+            spill(_merge_runs([_read_run(path) for path in group], counts))
+            for path in group:
+                path.unlink()
+        
+        tmp_path = output_path.with_name(f"{output_path.name}.tmp")
+        with open(tmp_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(fields)
+            for entry in _merge_runs([_read_run(path) for path in run_paths] + [iter(entries)], counts):
+                writer.writerow(entry[3:])
+                counts["written"] += 1
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, output_path)
+    if referrals:
+        write_referrals_csv(iter_csv_records(output_path), referrals_path(output_path))
+    return counts
+
+def merge_segments(segment_paths: List[Path], output_path: Path) -> int:
+    """
+    Merge crawl segments into one CSV sorted by descending ACN without duplicates.
+    
+    Args:
+        segment_paths: The segment files
+        output_path: The merged CSV to write
+        
+    Returns:
+        The number of records written
+    """
+    return merge_result_files([path for path in segment_paths if path.exists()], output_path)["written"]
+
+@app.command()
+def crawl(
+    from_acn: str = typer.Option(..., "--from", help="The highest ACN of the range"),
+    to_acn: str = typer.Option(..., "--to", help="The lowest ACN of the range"),
+    shards: int = typer.Option(4, "--shards", "-n", min=1, help="Number of worker processes"),
+    workers: int = typer.Option(1, "--workers", "-w", min=1, help="Requests in flight per shard"),
+    rate: float = typer.Option(DEFAULT_RATE, "--rate", help="Request rate limit in requests/second, shared by all shards"),
+    output_path: Path = typer.Option(Path("./crawl.csv"), "--output", "-o", help="The merged CSV file"),
+    batch_size: int = typer.Option(DEFAULT_BATCH_SIZE, "--batch-size", min=1, help="Write results to disk every N records"),
+    journal_path: Path = typer.Option(JOURNAL_FILE, "--journal", help="The journal that records the outcome of every ACN"),
+    token: str = typer.Option(None, "--token", "-t", help="The authentication token for the SNAPR API (optional)"),
+    token_broker: str = typer.Option(None, "--token-broker", envvar="SNAPR_TOKEN_BROKER", help="Use an external token broker instead of starting one"),
+    cache_path: Path = typer.Option(None, "--cache", help=f"Cache responses in this file (e.g. {CACHE_FILE})"),
+    missing_cache: Path = typer.Option(MISSING_FILE, "--missing-cache", help="Remember ACNs that returned 404 in this file and skip them"),
+    missing_ttl: str = typer.Option(DEFAULT_MISSING_TTL, "--missing-ttl", help="How long a 404 is remembered, e.g. 12h or 7d"),
+    recheck_missing: bool = typer.Option(False, "--recheck-missing", help="Request ACNs remembered as missing anyway"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
+):
+    """
+    Crawl an ACN range with several worker processes and merge the results.
+    
+    The range is split into --shards contiguous parts, each crawled by its own
+    process with its own session and segment file. All shards share one request
+    rate limit and one token broker. When they finish, the segments are merged into
+    one CSV sorted by ACN without duplicates. Outcomes go to the journal, so running
+    the same command again only fetches what is still missing.
+    
+    Examples:
+        ./query.py crawl --from Z1865690 --to Z1853215 --shards 8 --rate 8
+        ./query.py crawl --from Z1865690 --to Z1853215 -n 4 -w 2 -o crawl.csv
+    """
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Debug logging enabled")
+    hi, lo = acn_to_int(from_acn), acn_to_int(to_acn)
+    if hi < lo:
+        raise typer.BadParameter("--from must be the higher ACN")
+    prefix = from_acn[0]
+    
+    # Worker processes are spawned, never forked, since this process runs threads
+    context = multiprocessing.get_context("spawn")
+    limiter = SharedRateLimiter(rate, context=context)
+    
+    # One process owns the refresh token for every shard
+    broker = tokens = None
+    if not token_broker:
+        tokens = TokenManager(create_session(), token)
+        if not tokens.get():
+            logger.error("Failed to get token. Exiting.")
+            raise typer.Exit(1)
+        tokens.start()
+        broker = start_token_broker(tokens)
+        token_broker = f"http://127.0.0.1:{broker.server_port}"
+    
+    ranges = shard_ranges(hi, lo, shards)
+    segment_paths = [shard_output_path(output_path, shard) for shard in range(len(ranges))]
+    processes = []
+    for shard, (shard_hi, shard_lo) in enumerate(ranges):
+        logger.info(f"Shard {shard}: {int_to_acn(shard_hi, prefix)} - {int_to_acn(shard_lo, prefix)}")
+        process = context.Process(
+            target=_crawl_shard,
+            name=f"shard-{shard}",
+            args=(shard, shard_hi, shard_lo, prefix, segment_paths[shard], journal_path, limiter, token_broker,
+                  workers, batch_size, cache_path, missing_cache, missing_ttl, recheck_missing, logger.level),
+        )
+        process.start()
+        processes.append(process)
+    
+    started = time.time()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        logger.info("Crawl interrupted by user, waiting for shards to save their progress")
+        for process in processes:
+            process.join()
+    finally:
+        if broker:
+            broker.shutdown()
+            tokens.stop()
+    
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if failed:
+        logger.error(f"Shards failed: {', '.join(failed)}")
+    
+    journal = Journal(journal_path)
+    merged = merge_segments(segment_paths, output_path)
+    remaining = journal.done().missing(lo, hi)
+    logger.info(f"Crawl complete in {time.time() - started:.1f}s. Merged {merged} records into {output_path}; "
+                f"{len(remaining)} ACNs in the range still not done")
+
+class Coordinator:
+    """
+    Leases blocks of an ACN range to workers and collects their results.
+    
+    A block is leased for `lease_ttl` seconds. Workers may renew a lease while
+    they work on it; a lease that expires is dropped and its ACNs are leased
+    again. Outcomes are recorded in the journal, which decides what is left to
+    do, so a restarted coordinator continues where the last one stopped. ACNs
+    that failed with an error are not leased again until the next run.
+    Safe to call from the server's handler threads.
+    """
+    
+    def __init__(self, hi: int, lo: int, prefix: str, sink: BatchSink, journal: Journal,
+                 block_size: int = DEFAULT_BLOCK_SIZE, lease_ttl: float = DEFAULT_LEASE_TTL):
+        self.hi = hi
+        self.lo = lo
+        self.prefix = prefix
+        self.sink = sink
+        self.journal = journal
+        self.block_size = block_size
+        self.lease_ttl = lease_ttl
+        self.leases: Dict[str, Dict] = {}
+        # Bounds of every lease issued, so late results can still be checked
+        self.issued: Dict[str, Tuple[int, int]] = {}
+        self.failed = IntervalSet()
+        self.records = 0
+        self._next_lease = 0
+        self._lock = threading.Lock()
+    
+    def _expire(self) -> None:
+        now = time.time()
+        for lease_id, lease in list(self.leases.items()):
+            if lease["expires_at"] < now:
+                logger.warning(f"Lease {lease_id} of worker {lease['worker']} expired, "
+                               f"re-issuing {int_to_acn(lease['hi'], self.prefix)} - {int_to_acn(lease['lo'], self.prefix)}")
+                del self.leases[lease_id]
+    
+    def _remaining(self) -> IntervalSet:
+        return self.journal.done().union(self.failed).missing(self.lo, self.hi)
+    
+    def lease(self, worker: str) -> Optional[Dict]:
+        """
+        Lease the highest block that is neither done nor leased.
+        
+        Args:
+            worker: The worker's name, for logging
+            
+        Returns:
+            The lease or None if every remaining ACN is leased
+        """
+        with self._lock:
+            self._expire()
+            available = self._remaining()
+            for lease in self.leases.values():
+                available.discard_range(lease["lo"], lease["hi"])
+            if not available:
+                return None
+            start, end = list(available)[-1]
+            self._next_lease += 1
+            lease_id = str(self._next_lease)
+            self.leases[lease_id] = {
+                "worker": worker,
+                "hi": end,
+                "lo": max(start, end - self.block_size + 1),
+                "expires_at": time.time() + self.lease_ttl,
+            }
+            self.issued[lease_id] = (self.leases[lease_id]["lo"], end)
+            return self._describe(lease_id)
+    
+    def _describe(self, lease_id: str) -> Dict:
+        lease = self.leases[lease_id]
+        return {
+            "lease": lease_id,
+            "from": int_to_acn(lease["hi"], self.prefix),
+            "to": int_to_acn(lease["lo"], self.prefix),
+            "expires_in": round(lease["expires_at"] - time.time(), 1),
+        }
+    
+    def renew(self, lease_id: str) -> Optional[Dict]:
+        """Extend a lease; returns None if it already expired."""
+        with self._lock:
+            self._expire()
+            if lease_id not in self.leases:
+                return None
+            self.leases[lease_id]["expires_at"] = time.time() + self.lease_ttl
+            return self._describe(lease_id)
+    
+    def complete(self, lease_id: str, records: List[Dict], outcomes: Dict[str, str]) -> bool:
+        """
+        Save a worker's results and release its lease.
+        
+        Results are accepted even if the lease expired in the meantime; records
+        the journal has already saved are dropped, so a block done twice is not
+        written twice. Records and outcomes outside the lease's range are
+        dropped as well. ACNs of the block without an outcome are leased again.
+        
+        Args:
+            lease_id: The lease the results are for
+            records: The fetched records
+            outcomes: The outcome for each fetched ACN
+            
+        Returns:
+            Whether the lease was still held
+            
+        Raises:
+            ValueError: If the lease is unknown or the results are malformed
+        """
+        if not isinstance(records, list) or not all(isinstance(r, dict) and self._is_acn(r.get("acn")) for r in records):
+            raise ValueError("records must be a list of records with an acn")
+        if not isinstance(outcomes, dict) or not all(self._is_acn(acn) and outcome in Journal.OUTCOMES
+                                                     for acn, outcome in outcomes.items()):
+            raise ValueError(f"outcomes must map ACNs to one of {', '.join(Journal.OUTCOMES)}")
+        with self._lock:
+            if lease_id not in self.issued:
+                raise ValueError(f"Unknown lease {lease_id}")
+            lo, hi = self.issued[lease_id]
+            in_range = [record for record in records if lo <= acn_to_int(record["acn"]) <= hi]
+            outcomes = {acn: outcome for acn, outcome in outcomes.items() if lo <= acn_to_int(acn) <= hi}
+            if len(in_range) < len(records):
+                logger.warning(f"Dropped {len(records) - len(in_range)} records outside lease {lease_id}")
+            fetched = {record["acn"] for record in in_range}
+            for record in in_range:
+                if not self.journal.is_saved(record["acn"]):
+                    self.sink.write(record)
+                    self.records += 1
+            for acn, outcome in outcomes.items():
+                if outcome == "ok" and acn not in fetched:
+                    continue
+                self.journal.record(acn, outcome)
+                if outcome == "error":
+                    self.failed.add(acn_to_int(acn))
+            # Rows first, then the journal that covers them
+            self.sink.flush()
+            self.journal.flush()
+            return self.leases.pop(lease_id, None) is not None
+    
+    def _is_acn(self, value) -> bool:
+        return isinstance(value, str) and is_acn(value) and value[0] == self.prefix
+    
+    def status(self) -> Dict:
+        """Return the progress of the crawl."""
+        with self._lock:
+            self._expire()
+            remaining = len(self._remaining())
+            return {
+                "from": int_to_acn(self.hi, self.prefix),
+                "to": int_to_acn(self.lo, self.prefix),
+                "remaining": remaining,
+                "failed": len(self.failed),
+                "records": self.records,
+                "leases": {lease_id: self._describe(lease_id) | {"worker": lease["worker"]}
+                           for lease_id, lease in self.leases.items()},
+                "done": remaining == 0,
+            }
+
+class CoordinatorHandler(TokenBrokerHandler):
+    """
+    HTTP handler for the crawl coordinator.
+    
+    POST /lease with {"worker": ...} leases a block, POST /renew and
+    POST /complete with {"lease": ...} renew and finish it, and GET /status
+    reports progress. The token broker endpoints are served as well, so
+    workers only need the coordinator's URL. Every endpoint checks the secret.
+    """
+    
+    coordinator: Coordinator
+    
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"Coordinator: {format % args}")
+    
+    def _send_json(self, data: Dict) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_GET(self) -> None:
+        if self.path == "/status":
+            if self._authorized():
+                self._send_json(self.coordinator.status())
+            return
+        super().do_GET()
+    
+    def do_POST(self) -> None:
+        if self.path not in ("/lease", "/renew", "/complete"):
+            super().do_POST()
+            return
+        if not self._authorized():
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self.send_error(400, "Invalid JSON")
+            return
+        if not isinstance(payload, dict):
+            self.send_error(400, "Expected a JSON object")
+            return
+        coordinator = self.coordinator
+        if self.path == "/lease":
+            lease = coordinator.lease(payload.get("worker", self.client_address[0]))
+            if lease is None:
+                status = coordinator.status()
+                self._send_json({"lease": None, "done": status["done"]})
+                return
+            logger.info(f"Leased {lease['from']} - {lease['to']} to worker {payload.get('worker')}")
+            self._send_json(lease)
+        elif self.path == "/renew":
+            lease = coordinator.renew(str(payload.get("lease")))
+            self._send_json(lease or {"lease": None})
+        else:
+            try:
+                held = coordinator.complete(str(payload.get("lease")), payload.get("records", []), payload.get("outcomes", {}))
+            except ValueError as e:
+                logger.warning(f"Rejected results from worker {self.client_address[0]}: {e}")
+                self.send_error(400, str(e))
+                return
+            if not held:
+                logger.warning(f"Results for expired lease {payload.get('lease')} accepted")
+            self._send_json({"ok": True})
+
+@app.command()
+def coordinator(
+    from_acn: str = typer.Option(..., "--from", help="The highest ACN of the range"),
+    to_acn: str = typer.Option(..., "--to", help="The lowest ACN of the range"),
+    host: str = typer.Option("127.0.0.1", "--host", help="The address to listen on"),
+    port: int = typer.Option(DEFAULT_COORDINATOR_PORT, "--port", "-p", help="The port to listen on"),
+    secret: str = typer.Option(None, "--secret", envvar="SNAPR_SECRET", help="Shared secret workers must send (required off localhost)"),
+    block_size: int = typer.Option(DEFAULT_BLOCK_SIZE, "--block-size", min=1, help="Number of ACNs per lease"),
+    lease_ttl: float = typer.Option(DEFAULT_LEASE_TTL, "--lease-ttl", help="Seconds before an unrenewed lease is re-issued"),
+    output_path: Path = typer.Option(DEFAULT_OUTPUT_PATH, "--output", "-o", help="The path to save the CSV file"),
+    store: str = typer.Option(None, "--store", help="Save results to a result store instead of the CSV file, e.g. sqlite:results.db"),
+    journal_path: Path = typer.Option(JOURNAL_FILE, "--journal", help="The journal that records the outcome of every ACN"),
+    token: str = typer.Option(None, "--token", "-t", help="The authentication token for the SNAPR API (optional)"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
+):
+    """
+    Coordinate a crawl of an ACN range across workers on several machines.
+    
+    The coordinator leases blocks of --block-size ACNs to workers started with
+    the worker command and saves the records and outcomes they send back. A block
+    whose lease is not renewed within --lease-ttl seconds, e.g. because its worker
+    died, is leased to another worker. The coordinator also acts as the token broker
+    for its workers. It exits once every ACN in the range is done; restarting it
+    continues from the journal. To accept workers from other machines, listen on
+    another --host and give the coordinator and its workers the same --secret.
+    
+    Example:
+        SNAPR_SECRET=... ./query.py coordinator --from Z1865690 --to Z1853215 --host 0.0.0.0 --store sqlite:results.db
+        SNAPR_SECRET=... ./query.py worker --coordinator http://10.1.0.1:8766 -w 4 --rate 4
+    """
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Debug logging enabled")
+    hi, lo = acn_to_int(from_acn), acn_to_int(to_acn)
+    if hi < lo:
+        raise typer.BadParameter("--from must be the higher ACN")
+    check_listen_address(host, secret)
+    
+    tokens = TokenManager(create_session(), token)
+    if not tokens.get():
+        logger.error("Failed to get token. Exiting.")
+        raise typer.Exit(1)
+    tokens.start()
+    
+    if store:
+        sink = open_store(store)
+        logger.info(f"Saving results to {sink.spec}")
+    else:
+        if not str(output_path).endswith('.csv'):
+            output_path = Path(f"{output_path}.csv")
+        sink = CsvSink(output_path)
+    state = Coordinator(hi, lo, from_acn[0], sink, Journal(journal_path), block_size, lease_ttl)
+    
+    handler = type("BoundCoordinatorHandler", (CoordinatorHandler,), {"tokens": tokens, "coordinator": state, "secret": secret})
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="coordinator", daemon=True).start()
+    logger.info(f"Coordinator for {from_acn} - {to_acn} listening on http://{host}:{server.server_port}")
+    
+    last_report = 0.0
+    try:
+        while True:
+            status = state.status()
+            if status["done"]:
+                break
+            if time.time() - last_report >= DEFAULT_FLUSH_INTERVAL:
+                logger.info(f"{status['remaining']} ACNs remaining, {len(status['leases'])} leases out, "
+                            f"{status['records']} records saved")
+                last_report = time.time()
+            time.sleep(WORKER_POLL_INTERVAL)
+        # Give polling workers a chance to hear that the crawl is done
+        logger.info("All ACNs done, waiting for workers to finish")
+        time.sleep(2 * WORKER_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        logger.info("Coordinator stopped by user")
+    finally:
+        server.shutdown()
+        tokens.stop()
+        sink.close()
+        state.journal.flush()
+    logger.info(f"Coordinator finished: {state.records} records saved, {len(state.failed)} ACNs failed")
+
+class CoordinatorClient:
+    """Client for the coordinator's lease endpoints."""
+    
+    def __init__(self, url: str, session: requests.Session, worker: str, secret: Optional[str] = None):
+        self.url = url.rstrip("/")
+        self.session = session
+        self.worker = worker
+        self.headers = {"Authorization": f"Bearer {secret}"} if secret else {}
+    
+    def _post(self, path: str, payload: Dict) -> Optional[Dict]:
+        try:
+            response = self.session.post(f"{self.url}{path}", json=payload, headers=self.headers, timeout=60)
+            response.raise_for_status()
+            return response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error(f"Coordinator at {self.url} failed: {e}")
+            return None
+    
+    def lease(self) -> Optional[Dict]:
+        return self._post("/lease", {"worker": self.worker})
+    
+    def renew(self, lease_id: str) -> bool:
+        reply = self._post("/renew", {"lease": lease_id})
+        return bool(reply and reply.get("lease"))
+    
+    def complete(self, lease_id: str, records: List[Dict], outcomes: Dict[str, str]) -> bool:
+        # Results are precious; retry until the coordinator takes them
+        for attempt in range(MAX_RETRIES):
+            if self._post("/complete", {"lease": lease_id, "records": records, "outcomes": outcomes}):
+                return True
+            time.sleep(WORKER_POLL_INTERVAL * (attempt + 1))
+        return False
+
+@app.command()
+def worker(
+    coordinator_url: str = typer.Option(..., "--coordinator", "-c", envvar="SNAPR_COORDINATOR", help="The coordinator URL, e.g. http://10.1.0.1:8766"),
+    name: str = typer.Option(None, "--name", help="The worker name reported to the coordinator (default: host:pid)"),
+    workers: int = typer.Option(1, "--workers", "-w", min=1, help="Number of requests in flight (1 = sequential)"),
+    rate: float = typer.Option(DEFAULT_RATE, "--rate", help="Request rate limit of this worker in requests/second"),
+    token_broker: str = typer.Option(None, "--token-broker", envvar="SNAPR_TOKEN_BROKER", help="Get tokens from this broker instead of the coordinator"),
+    secret: str = typer.Option(None, "--secret", envvar="SNAPR_SECRET", help="The coordinator's shared secret"),
+    cache_path: Path = typer.Option(None, "--cache", help=f"Cache responses in this file (e.g. {CACHE_FILE})"),
+    missing_cache: Path = typer.Option(None, "--missing-cache", help="Skip ACNs remembered as missing in this file"),
+    missing_ttl: str = typer.Option(DEFAULT_MISSING_TTL, "--missing-ttl", help="How long a 404 is remembered, e.g. 12h or 7d"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
+):
+    """
+    Fetch blocks of ACNs leased from a coordinator until the crawl is done.
+    
+    Each block is fetched and its records and outcomes are sent back to the
+    coordinator, which saves them. Tokens come from the coordinator unless
+    --token-broker is given. Any number of workers can run on any number of
+    machines, and a worker can be stopped at any time; its block is leased
+    to another worker once the lease expires.
+    
+    Example:
+        ./query.py worker --coordinator http://10.1.0.1:8766 -w 4 --rate 4
+    """
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Debug logging enabled")
+    name = name or f"{os.uname().nodename}:{os.getpid()}"
+    limiter = RateLimiter(rate)
+    session = create_session(pool_size=max(workers, 10))
+    client = CoordinatorClient(coordinator_url, session, name, secret)
+    tokens = BrokerTokenClient(token_broker or coordinator_url, session, secret)
+    cache = open_cache(cache_path)
+    missing = open_negative_cache(missing_cache, missing_ttl)
+    
+    def fetch(acn: str) -> Optional[Dict]:
+        return fetch_acn(session, acn, tokens, limiter, cache, missing)
+    
+    total = 0
+    stop = False
+    try:
+        while not stop:
+            lease = client.lease()
+            if lease is None:
+                time.sleep(WORKER_POLL_INTERVAL)
+                continue
+            if not lease.get("lease"):
+                if lease.get("done"):
+                    break
+                # Everything left is leased; wait for leases to expire or finish
+                time.sleep(WORKER_POLL_INTERVAL)
+                continue
+            
+            lease_id = lease["lease"]
+            logger.info(f"Leased {lease['from']} - {lease['to']}")
+            renew_at = time.time() + lease["expires_in"] / 2
+            hi, lo = acn_to_int(lease["from"]), acn_to_int(lease["to"])
+            acns = [int_to_acn(number, lease["from"][0]) for number in range(hi, lo - 1, -1)]
+            records: List[Dict] = []
+            outcomes: Dict[str, str] = {}
+            results_in_order = fetch_in_order(fetch, acns, workers)
+            try:
+                for acn, data in results_in_order:
+                    if is_unauthorized(data):
+                        logger.error("Failed to refresh token, stopping")
+                        stop = True
+                        break
+                    if data is None:
+                        outcomes[acn] = "404"
+                    elif is_error_result(data):
+                        outcomes[acn] = "error"
+                    else:
+                        outcomes[acn] = "ok"
+                        records.append(data)
+                    if time.time() >= renew_at:
+                        if not client.renew(lease_id):
+                            logger.warning(f"Lease {lease_id} expired, finishing the block anyway")
+                        renew_at = time.time() + lease["expires_in"] / 2
+            except KeyboardInterrupt:
+                stop = True
+            finally:
+                results_in_order.close()
+            
+            if client.complete(lease_id, records, outcomes):
+                total += len(records)
+                logger.info(f"Sent {len(records)} records for {lease['from']} - {lease['to']}")
+            else:
+                logger.error(f"Could not send results for {lease['from']} - {lease['to']}; they will be fetched again")
+    except KeyboardInterrupt:
+        logger.info("Worker stopped by user")
+    finally:
+        if cache:
+            cache.close()
+    logger.info(f"Worker finished: {total} records sent")
+
+@app.command()
+def coverage(
+    journal_path: Path = typer.Option(JOURNAL_FILE, "--journal", help="The crawl journal to report on"),
+    from_acn: str = typer.Option(None, "--from", help="Highest ACN of the range to report on (default: highest journaled)"),
+    to_acn: str = typer.Option(None, "--to", help="Lowest ACN of the range to report on (default: lowest journaled)"),
+    compact: bool = typer.Option(False, "--compact", help="Rewrite the journal as ranges (only while no crawl is running)"),
+):
+    """
+    Report which ACN ranges are done, failed or still missing according to a crawl journal.
+    
+    Examples:
+        ./query.py coverage
+        ./query.py coverage --from Z1865690 --to Z1853215
+        ./query.py coverage --compact
+    """
+    if not journal_path.exists():
+        logger.error(f"Journal {journal_path} does not exist")
+        raise typer.Exit(1)
+    journal = Journal(journal_path)
+    if compact:
+        journal.compact()
+        logger.info(f"Compacted {journal_path} to {journal_path.stat().st_size} bytes")
+    
+    done = journal.done()
+    known = done.union(journal.outcomes["error"]).union(journal.outcomes["401"])
+    bounds = known.bounds()
+    if bounds is None and not (from_acn and to_acn):
+        typer.echo("Journal is empty")
+        return
+    lo = acn_to_int(to_acn) if to_acn else bounds[0]
+    hi = acn_to_int(from_acn) if from_acn else bounds[1]
+    missing = done.missing(lo, hi)
+    prefix = journal.prefix
+    
+    typer.echo(f"Range:   {int_to_acn(hi, prefix)} - {int_to_acn(lo, prefix)} ({hi - lo + 1} ACNs)")
+    for outcome in Journal.OUTCOMES:
+        ranges = journal.outcomes[outcome]
+        typer.echo(f"{outcome + ':':8} {len(ranges):>8} ACNs in {sum(1 for _ in ranges)} ranges")
+    typer.echo(f"Done:    {format_ranges(done, prefix, limit=20)}")
+    typer.echo(f"Missing: {len(missing)} ACNs: {format_ranges(missing, prefix, limit=20)}")
+    failed = journal.outcomes["error"].union(journal.outcomes["401"])
+    if failed:
+        typer.echo(f"Failed:  {format_ranges(failed, prefix, limit=20)}")
+
+@app.command("import-csv")
+def import_csv(
+    inputs: List[Path] = typer.Argument(..., help="Result CSV files to import"),
+    store: str = typer.Option(..., "--store", help="The result store to import into, e.g. sqlite:results.db"),
+    batch_size: int = typer.Option(1000, "--batch-size", min=1, help="Records per transaction"),
+):
+    """
+    Import result CSV files into a result store.
+    
+    Records are upserted by ACN, so overlapping files are deduplicated. Files are
+    applied in the order given; for an ACN present in several files the last one wins.
+    Example:
+        ./query.py import-csv "output copy.csv" output-Z1860693.csv output.csv --store sqlite:results.db
+    """
+    result_store = open_store(store, batch_size=batch_size)
+    for input_path in inputs:
+        captured_at = input_path.stat().st_mtime
+        imported = 0
+        batch = []
+        with open(input_path, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                record = decode_csv_record(row)
+                if not record.get("acn"):
+                    continue
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    result_store.upsert_many(batch, fetched_at=captured_at)
+                    imported += len(batch)
+                    batch = []
+        if batch:
+            result_store.upsert_many(batch, fetched_at=captured_at)
+            imported += len(batch)
+        logger.info(f"Imported {imported} records from {input_path}")
+    logger.info(f"{result_store.spec} now holds {result_store.count()} records")
+    result_store.close()
+
+@app.command("export-csv")
+def export_csv(
+    output_path: Path = typer.Argument(..., help="The CSV file to write"),
+    store: str = typer.Option(..., "--store", help="The result store to export, e.g. sqlite:results.db"),
+):
+    """
+    Export a result store to a CSV file in descending ACN order.
+    
+    The file is written in the same layout as the query command's CSV output.
+    Example:
+        ./query.py export-csv output.csv --store sqlite:results.db
+    """
+    result_store = open_store(store)
+    
+    # Collect the columns first so the header covers every record
+    keys = set(CSV_FIELDS)
+    for record in result_store.iter_records():
+        keys.update(record.keys())
+    
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    exported = 0
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=sorted(keys))
+        writer.writeheader()
+        for record in result_store.iter_records():
+            writer.writerow(record)
+            exported += 1
+    write_referrals_csv(result_store.iter_records(), referrals_path(output_path))
+    result_store.close()
+    logger.info(f"Exported {exported} records to {output_path} and their referrals to {referrals_path(output_path)}")
+
+@app.command("backfill-referrals")
+def backfill_referrals(
+    input_path: Path = typer.Option(Path("./output.csv"), "--input", "-i", help="The result CSV to extract referrals from"),
+    output_path: Path = typer.Option(None, "--output", "-o", help="The referrals CSV to write (default: <input>.referrals.csv)"),
+    store: str = typer.Option(None, "--store", help="Rebuild the referrals table of a result store instead, e.g. sqlite:results.db"),
+):
+    """
+    Build the referrals table for results saved before it existed.
+    
+    Referral lists in the CSV cells, including the Python repr form written by
+    earlier versions, are parsed once and written one referral per row with ISO
+    dates, so agency-level analysis doesn't have to parse every cell.
+    
+    Examples:
+        ./query.py backfill-referrals                          # output.csv -> output.referrals.csv
+        ./query.py backfill-referrals -i output-Z1860693.csv
+        ./query.py backfill-referrals --store sqlite:results.db
+    """
+    if store:
+        result_store = open_store(store)
+        written = result_store.rebuild_referrals()
+        result_store.close()
+        logger.info(f"Rebuilt {written} referral rows in {result_store.spec}")
+        return
+    if not input_path.exists():
+        logger.error(f"Input file {input_path} does not exist")
+        raise typer.Exit(1)
+    output_path = output_path or referrals_path(input_path)
+    written = write_referrals_csv(iter_csv_records(input_path), output_path)
+    logger.info(f"Wrote {written} referral rows from {input_path} to {output_path}")
+
+@app.command()
+def lookup(
+    acns: List[str] = typer.Argument(..., help="The ACNs to look up"),
+    input_path: Path = typer.Option(Path("./output.csv"), "--input", "-i", help="The result CSV to read"),
+    rebuild: bool = typer.Option(False, "--rebuild", help="Index the whole file again"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
+):
+    """
+    Print saved records by ACN without parsing the whole result CSV.
+    
+    The first lookup builds an index next to the CSV (output.csv.idx) mapping
+    each ACN to its row's byte offset. Later lookups only index rows appended
+    since, then seek straight to the requested rows. query keeps an existing
+    index current as it appends; a rewritten file is indexed again.
+    
+    Examples:
+        ./query.py lookup Z1860693                        # Print one record as JSON
+        ./query.py lookup Z1860693 Z1860690 -i output.csv
+        ./query.py lookup Z1860693 --rebuild               # Re-index after editing the CSV by hand
+    """
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Debug logging enabled")
+    
+    if not input_path.exists():
+        logger.error(f"Input file {input_path} does not exist")
+        raise typer.Exit(1)
+    index = open_csv_index(input_path, rebuild)
+    records = index.get_many(acns)
+    for acn in acns:
+        if acn in records:
+            print(json.dumps(records[acn]))
+        else:
+            logger.warning(f"ACN {acn} is not in {input_path}")
+    if len(records) < len(set(acns)):
+        raise typer.Exit(1)
+
+@app.command()
+def merge(
+    inputs: List[Path] = typer.Argument(..., help="Result CSV files to merge"),
+    output_path: Path = typer.Option(..., "--output", "-o", help="The merged CSV file to write; may be one of the inputs"),
+    run_size: int = typer.Option(DEFAULT_MERGE_RUN_SIZE, "--run-size", min=1, help="Rows sorted in memory at a time"),
+    tmp_dir: Path = typer.Option(None, "--tmp-dir", help="Directory for temporary sorted runs (default: next to the output)"),
+    referrals: bool = typer.Option(True, "--referrals/--no-referrals", help="Also rewrite the output's referrals sidecar"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
+):
+    """
+    Consolidate result CSVs into one file sorted by ACN, keeping one row per ACN.
+    
+    Files with different column orders are unified, and rows that save_to_csv
+    appended under a mismatched header are put back in place. For duplicate
+    ACNs the record from the most recently modified file wins. Inputs are
+    sorted externally, so files larger than memory are fine.
+    
+    Examples:
+        ./query.py merge output.csv "output copy.csv" output-Z1860693.csv -o merged.csv
+        ./query.py merge old.csv output.csv -o output.csv --tmp-dir /var/tmp
+    """
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Debug logging enabled")
+    
+    for input_path in inputs:
+        if not input_path.exists():
+            logger.error(f"Input file {input_path} does not exist")
+            raise typer.Exit(1)
+    started = time.time()
+    counts = merge_result_files(inputs, output_path, run_size, tmp_dir, referrals)
+    logger.info(f"Merged {counts['read']} rows from {len(inputs)} files into {counts['written']} records in {output_path} "
+                f"in {time.time() - started:.1f}s ({counts['duplicates']} duplicates dropped, {counts['malformed']} malformed rows skipped)")
+
+def is_store_spec(spec: str) -> bool:
+    """Check whether a command-line source names a result store rather than a CSV file."""
+    return spec.partition(":")[0] == "sqlite"
+
+class Snapshot:
+    """
+    The results of one crawl as read by diff: a result CSV or a result store.
+    
+    entries() streams (ACN, digest, item) for every record. A CSV yields a
+    hash of its raw cells unless canonical digests are asked for, which costs
+    decoding every row. Equal raw digests mean equal records; different ones
+    may still be the same record in another column order or referral
+    encoding. Records are fetched back by ACN through the CSV's index or the
+    store.
+    """
+    
+    def __init__(self, spec: str):
+        self.spec = spec
+        self.store = open_store(spec) if is_store_spec(spec) else None
+        self.path = None if self.store else Path(spec)
+        self.prefix = "Z"
+        self._columns: List[str] = []
+        self._index: Optional[CsvIndex] = None
+    
+    def entries(self, canonical: bool) -> Iterator[Tuple[str, bytes, Union[Dict, List[str]]]]:
+        """Yield (ACN, digest, record or raw row) for every record."""
+        if self.store:
+            for record in self.store.iter_records():
+                yield record["acn"], record_digest(record), record
+            return
+        with open(self.path, 'r', newline='') as f:
+            reader = csv.reader(f)
+            self._columns = next(reader, [])
+            if "acn" not in self._columns:
+                return
+            acn_cell = self._columns.index("acn")
+            # Cells are hashed with their column names in name order
+            order = sorted(range(len(self._columns)), key=self._columns.__getitem__)
+            cells = itemgetter(*order)
+            names = [f"{self._columns[i]}\x1e" for i in order]
+            for row in reader:
+                if len(row) != len(self._columns) or not row[acn_cell]:
+                    continue
+                if canonical:
+                    digest = record_digest(self.decode(row))
+                else:
+                    digest = hashlib.blake2b("\x1f".join(map(str.__add__, names, cells(row))).encode("utf-8"), digest_size=16).digest()
+                yield row[acn_cell], digest, row
+    
+    def decode(self, item: Union[Dict, List[str]]) -> Dict:
+        """Turn an item yielded by entries() into a record."""
+        return item if self.store else decode_csv_record(dict(zip(self._columns, item)))
+    
+    def get_many(self, acns: List[str]) -> Dict[str, Dict]:
+        """Look up records by ACN."""
+        if self.store:
+            records = {acn: self.store.get(acn) for acn in acns}
+            return {acn: record for acn, record in records.items() if record is not None}
+        if self._index is None:
+            self._index = open_csv_index(self.path)
+        return self._index.get_many(acns)
+    
+    def close(self) -> None:
+        """Close the store, if any."""
+        if self.store:
+            self.store.close()
+
+def record_changes(before: Dict, after: Dict) -> List[str]:
+    """Return the fields whose values differ between two versions of a record."""
+    return sorted(key for key in set(before) | set(after)
+                  if _canonical_value(key, before.get(key)) != _canonical_value(key, after.get(key)))
+
+def diff_snapshots(old: Snapshot, new: Snapshot, emit: Callable[[Dict], None], removed: bool = False,
+                   batch_size: int = 1000) -> Dict[str, int]:
+    """
+    Compare two crawls and emit a change record for every ACN that differs.
+    
+    The old crawl is reduced to one digest per ACN and the new one streamed
+    against it, so unchanged records cost one hash each. Records whose
+    digests differ are fetched from the old crawl in batches and compared
+    field by field.
+    
+    Args:
+        old: The earlier crawl
+        new: The later crawl
+        emit: Called with each change: acn, change (added, changed or removed),
+            fields, and before/after holding the changed fields
+        removed: Also emit ACNs missing from the new crawl
+        batch_size: Old records fetched at a time
+        
+    Returns:
+        Counts of unchanged, changed, added and removed ACNs, and of reviewStatus transitions
+    """
+    # Raw row digests are only comparable between two CSVs
+    canonical = old.store is not None or new.store is not None
+    counts: Dict[str, int] = {"unchanged": 0, "changed": 0, "added": 0, "removed": 0}
+    old_digests = {}
+    for acn, digest, _ in old.entries(canonical):
+        old_digests[acn_to_int(acn)] = digest
+        old.prefix = acn[0]
+    logger.debug(f"Read {len(old_digests)} digests from {old.spec}")
+    
+    pending: List[Tuple[str, Dict]] = []
+    
+    def compare_pending() -> None:
+        before_records = old.get_many([acn for acn, _ in pending])
+        for acn, after in pending:
+            before = before_records.get(acn, {})
+            fields = record_changes(before, after)
+            if not fields:
+                counts["unchanged"] += 1
+                continue
+            counts["changed"] += 1
+            if "reviewStatus" in fields:
+                transition = f"{before.get('reviewStatus')} -> {after.get('reviewStatus')}"
+                counts[transition] = counts.get(transition, 0) + 1
+            emit({
+                "acn": acn,
+                "change": "changed",
+                "fields": fields,
+                "before": {field: before.get(field) for field in fields},
+                "after": {field: after.get(field) for field in fields},
+            })
+        pending.clear()
+    
+    for acn, digest, item in new.entries(canonical):
+        old_digest = old_digests.pop(acn_to_int(acn), None)
+        if old_digest == digest:
+            counts["unchanged"] += 1
+        elif old_digest is None:
+            counts["added"] += 1
+            after = new.decode(item)
+            emit({"acn": acn, "change": "added", "fields": sorted(after), "before": None, "after": after})
+        else:
+            pending.append((acn, new.decode(item)))
+            if len(pending) >= batch_size:
+                compare_pending()
+    if pending:
+        compare_pending()
+    
+    counts["removed"] = len(old_digests)
+    if removed and old_digests:
+        acns = [int_to_acn(number, old.prefix) for number in sorted(old_digests, reverse=True)]
+        for start in range(0, len(acns), batch_size):
+            before_records = old.get_many(acns[start:start + batch_size])
+            for acn in acns[start:start + batch_size]:
+                before = before_records.get(acn, {"acn": acn})
+                emit({"acn": acn, "change": "removed", "fields": sorted(before), "before": before, "after": None})
+    return counts
+
+@app.command()
+def diff(
+    old: str = typer.Argument(..., help="The earlier crawl: a result CSV or a store, e.g. sqlite:results.db"),
+    new: str = typer.Argument(..., help="The later crawl: a result CSV or a store"),
+    output_path: Path = typer.Option(None, "--output", "-o", help="Write the changes to this NDJSON file instead of stdout"),
+    removed: bool = typer.Option(False, "--removed", help="Also report ACNs that are missing from the later crawl"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
+):
+    """
+    Print the work items that changed between two crawls as NDJSON.
+    
+    Each line holds an ACN, whether it was added, changed or removed, the
+    changed fields and their values before and after, e.g. a reviewStatus
+    going from PENDING to COMPLETED or new referrals. Unchanged records are
+    skipped by hash without comparing fields. ACNs missing from the later
+    crawl are only reported with --removed, since crawls often cover
+    different ranges.
+    
+    Examples:
+        ./query.py diff yesterday.csv output.csv                # Changes since yesterday's crawl
+        ./query.py diff sqlite:results.db output.csv -o changes.ndjson
+        ./query.py diff old.csv new.csv | jq 'select(.fields | index("reviewStatus"))'
+    """
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Debug logging enabled")
+    
+    for spec in (old, new):
+        if not is_store_spec(spec) and not Path(spec).exists():
+            logger.error(f"Input file {spec} does not exist")
+            raise typer.Exit(1)
+    started = time.time()
+    old_snapshot, new_snapshot = Snapshot(old), Snapshot(new)
+    out = open(output_path, 'w') if output_path else sys.stdout
+    try:
+        counts = diff_snapshots(old_snapshot, new_snapshot, lambda change: out.write(json.dumps(change) + "\n"), removed)
+    finally:
+        if output_path:
+            out.close()
+        old_snapshot.close()
+        new_snapshot.close()
+    
+    transitions = ", ".join(f"{key}: {value}" for key, value in counts.items() if " -> " in key)
+    logger.info(f"Compared {old} with {new} in {time.time() - started:.1f}s: {counts['changed']} changed, "
+                f"{counts['added']} added, {counts['removed']} removed, {counts['unchanged']} unchanged"
+                + (f" (status changes: {transitions})" if transitions else ""))
+
+def require_numpy() -> None:
+    """Exit with a hint if numpy, which only the analytics commands need, is missing."""
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        logger.error("This command needs numpy: pip install numpy (uv run installs it automatically)")
+        raise typer.Exit(1)
+
+def parse_api_dates(values: List[str]):
+    """
+    Parse API dates (MM/DD/YYYY) into a datetime64[D] array in one pass.
+    
+    The strings are reordered into ISO form as a character matrix, so no
+    per-row Python work is done. Empty or malformed values become NaT.
+    
+    Args:
+        values: The dates as returned by the API, "" if missing
+        
+    Returns:
+        A numpy datetime64[D] array
+    """
+    import numpy as np
+    chars = np.array(values, dtype="U10").reshape(-1).view("U1").reshape(-1, 10)
+    valid = (chars[:, 2] == "/") & (chars[:, 5] == "/")
+    iso = chars[:, [6, 7, 8, 9, 2, 0, 1, 5, 3, 4]].copy()
+    iso[:, 4] = "-"
+    iso[:, 7] = "-"
+    iso = iso.view("U10").ravel()
+    return np.where(valid, iso, "NaT").astype("datetime64[D]")
+
+def parse_iso_dates(values: List[str]):
+    """Parse ISO dates into a datetime64[D] array; empty values become NaT."""
+    import numpy as np
+    dates = np.array(values, dtype="U10").reshape(-1)
+    return np.where(dates == "", "NaT", dates).astype("datetime64[D]")
+
+def factorize(values: List[str]):
+    """
+    Encode strings as integer codes into a table of distinct values.
+    
+    Args:
+        values: The strings
+        
+    Returns:
+        (codes, labels) where labels[codes[i]] is values[i]
+    """
+    import numpy as np
+    labels = list(dict.fromkeys(values))
+    index = {label: code for code, label in enumerate(labels)}
+    codes = np.fromiter(map(index.__getitem__, values), dtype=np.int32, count=len(values))
+    return codes, np.array(labels, dtype=str).reshape(-1)
+
+def read_csv_columns(path: Path, fields: List[str]) -> List[List[str]]:
+    """Read the named columns of a CSV file; missing columns come back empty."""
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        rows = [row for row in reader if row]
+    width = len(header)
+    if any(len(row) < width for row in rows):
+        rows = [row + [""] * (width - len(row)) for row in rows]
+    return [list(map(itemgetter(header.index(field)), rows)) if field in header else [""] * len(rows) for field in fields]
+
+def read_stats_columns(input_path: Optional[Path] = None, store: Optional[str] = None) -> Dict:
+    """
+    Load the fields the stats command needs as numpy arrays.
+    
+    Referrals come from the store's referrals table or the CSV's referrals
+    sidecar. Without a sidecar the referral cells of the CSV are parsed
+    instead, which is slow; backfill-referrals creates the sidecar.
+    
+    Args:
+        input_path: A result CSV
+        store: A result store spec, used instead of input_path if given
+        
+    Returns:
+        Integer codes "reviewStatus", "renewingDivision", "finalDecision" and
+        "agency", each with a "<name>_labels" array of their values, and the
+        datetime64[D] arrays "registered", "completed", "referred" and "closed"
+    """
+    if store:
+        result_store = open_store(store)
+        rows = result_store.conn.execute(
+            """
+            SELECT COALESCE(reviewStatus, ''), COALESCE(renewingDivision, ''),
+                   COALESCE(json_extract(data, '$.finalDecision'), ''),
+                   COALESCE(json_extract(data, '$.registrationDate'), ''),
+                   COALESCE(json_extract(data, '$.completionDate'), '')
+            FROM work_items
+            """
+        ).fetchall()
+        items = list(zip(*rows)) if rows else [()] * 5
+        rows = result_store.conn.execute(
+            "SELECT COALESCE(agency, ''), COALESCE(referralDate, ''), COALESCE(closedDate, '') FROM referrals"
+        ).fetchall()
+        referrals = list(zip(*rows)) if rows else [()] * 3
+        result_store.close()
+    else:
+        items = read_csv_columns(input_path, ["reviewStatus", "renewingDivision", "finalDecision", "registrationDate", "completionDate"])
+        if referrals_path(input_path).exists():
+            referrals = read_csv_columns(referrals_path(input_path), ["agency", "referralDate", "closedDate"])
+        else:
+            logger.warning(f"No {referrals_path(input_path)}, parsing referral cells (run backfill-referrals to speed this up)")
+            rows = [
+                (row["agency"] or "", row["referralDate"] or "", row["closedDate"] or "")
+                for record in iter_csv_records(input_path) for row in referral_rows(record)
+            ]
+            referrals = list(zip(*rows)) if rows else [()] * 3
+    
+    columns = {}
+    for name, values in (("reviewStatus", items[0]), ("renewingDivision", items[1]), ("finalDecision", items[2]), ("agency", referrals[0])):
+        columns[name], columns[f"{name}_labels"] = factorize(values)
+    columns["registered"] = parse_api_dates(items[3])
+    columns["completed"] = parse_api_dates(items[4])
+    columns["referred"] = parse_iso_dates(referrals[1])
+    columns["closed"] = parse_iso_dates(referrals[2])
+    return columns
+
+def load_stats_columns(input_path: Optional[Path] = None, store: Optional[str] = None, use_cache: bool = True) -> Dict:
+    """
+    Load the stats columns, from a cache next to the source if it is current.
+    
+    Parsing is done once per version of the source: the arrays are saved to
+    <source>.stats.npz together with the size and modification time of the
+    files they were read from, and reused until those change.
+    
+    Args:
+        input_path: A result CSV
+        store: A result store spec, used instead of input_path if given
+        use_cache: Read and write the cache
+        
+    Returns:
+        The arrays described in read_stats_columns
+    """
+    import numpy as np
+    if store:
+        source = open_store(store)
+        source.close()
+        paths = [source.db_path, source.db_path.with_name(f"{source.db_path.name}-wal")]
+    else:
+        paths = [input_path, referrals_path(input_path)]
+    signature = np.array([(p.stat().st_size, p.stat().st_mtime_ns) if p.exists() else (0, 0) for p in paths], dtype=np.int64)
+    cache_path = paths[0].with_name(f"{paths[0].stem}.stats.npz")
+    
+    if use_cache and cache_path.exists():
+        try:
+            with np.load(cache_path) as cached:
+                if np.array_equal(cached["signature"], signature):
+                    logger.debug(f"Loaded stats columns from {cache_path}")
+                    return {name: cached[name] for name in cached.files if name != "signature"}
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable stats cache {cache_path}: {e}")
+    
+    columns = read_stats_columns(input_path, store)
+    if use_cache:
+        tmp_path = cache_path.with_name(f"{cache_path.name}.tmp")
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, signature=signature, **columns)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning(f"Could not write stats cache {cache_path}: {e}")
+    return columns
+
+def grouped_percentiles(codes, labels, days, percentiles: List[float]) -> List[Dict]:
+    """
+    Summarize durations per group.
+    
+    Args:
+        codes: The group of each item, as an index into labels
+        labels: The group names
+        days: The duration of each item in days, NaN if it isn't finished
+        percentiles: The percentiles to report, e.g. [50, 90]
+        
+    Returns:
+        One row per group, largest group first, with the item count, the
+        number finished and the requested percentiles of the finished ones
+    """
+    import numpy as np
+    totals = np.bincount(codes, minlength=len(labels))
+    done = ~np.isnan(days)
+    finished = np.bincount(codes[done], minlength=len(labels))
+    # Sort finished durations by group once; each group is then a contiguous slice
+    order = np.lexsort((days[done], codes[done]))
+    sorted_days = days[done][order]
+    bounds = np.concatenate(([0], np.cumsum(finished)))
+    rows = []
+    for g in np.argsort(-totals, kind="stable"):
+        if not totals[g]:
+            continue
+        values = sorted_days[bounds[g]:bounds[g + 1]]
+        row = {"group": str(labels[g]) or "(none)", "items": int(totals[g]), "finished": int(finished[g])}
+        row["mean"] = round(float(values.mean()), 1) if len(values) else None
+        for p, value in zip(percentiles, np.percentile(values, percentiles) if len(values) else [None] * len(percentiles)):
+            row[f"p{p:g}"] = round(float(value), 1) if value is not None else None
+        rows.append(row)
+    return rows
+
+def weekly_throughput(registered, completed, weeks: int) -> List[Dict]:
+    """
+    Count registrations and completions per week (weeks start on Monday).
+    
+    Args:
+        registered: Registration dates (datetime64[D])
+        completed: Completion dates (datetime64[D], NaT if open)
+        weeks: Number of most recent weeks to report
+        
+    Returns:
+        One row per week, oldest first
+    """
+    import numpy as np
+    monday = np.datetime64("1970-01-05")
+    reg_weeks = (registered[~np.isnat(registered)] - monday).astype(int) // 7
+    done_weeks = (completed[~np.isnat(completed)] - monday).astype(int) // 7
+    if not len(reg_weeks) and not len(done_weeks):
+        return []
+    last = int(max(reg_weeks.max(initial=-10**6), done_weeks.max(initial=-10**6)))
+    first = last - weeks + 1
+    reg_counts = np.bincount(reg_weeks[reg_weeks >= first] - first, minlength=weeks)
+    done_counts = np.bincount(done_weeks[done_weeks >= first] - first, minlength=weeks)
+    return [
+        {"week": str(monday + np.timedelta64(7 * (first + i), "D")), "registered": int(reg_counts[i]), "completed": int(done_counts[i])}
+        for i in range(weeks)
+    ]
+
+def format_table(rows: List[Dict]) -> str:
+    """Format rows with the same keys as an aligned text table."""
+    if not rows:
+        return "(no data)"
+    columns = list(rows[0])
+    cells = [[("-" if row[c] is None else str(row[c])) for c in columns] for row in rows]
+    widths = [max(len(c), *(len(line[i]) for line in cells)) for i, c in enumerate(columns)]
+    lines = ["  ".join(c.ljust(w) if i == 0 else c.rjust(w) for i, (c, w) in enumerate(zip(columns, widths)))]
+    for line in cells:
+        lines.append("  ".join(v.ljust(w) if i == 0 else v.rjust(w) for i, (v, w) in enumerate(zip(line, widths))))
+    return "\n".join(lines)
+
+@app.command()
+def stats(
+    input_path: Path = typer.Option(Path("./output.csv"), "--input", "-i", help="The result CSV to analyze"),
+    store: str = typer.Option(None, "--store", help="Analyze a result store instead, e.g. sqlite:results.db"),
+    by: str = typer.Option("division", "--by", help="Group turnaround by division, decision, status or none"),
+    percentiles: str = typer.Option("50,75,90,95", "--percentiles", "-p", help="Comma-separated percentiles to report"),
+    weeks: int = typer.Option(12, "--weeks", min=1, help="Number of recent weeks of throughput to report"),
+    output_format: str = typer.Option("table", "--format", "-f", help="Output format: table or json"),
+    use_cache: bool = typer.Option(True, "--cache/--no-cache", help="Keep parsed columns in <input>.stats.npz for the next run"),
+    debug: bool = typer.Option(False, "--debug", "-d", help="Enable debug logging"),
+):
+    """
+    Report turnaround times, referral latency by agency and weekly throughput.
+    
+    Turnaround is the number of days from registrationDate to completionDate of
+    completed items, grouped by --by. Referral latency is the number of days from
+    referral to closure, per agency. Throughput counts registrations and
+    completions per week. Results are loaded into numpy arrays with dates parsed
+    once and kept in a cache next to the input until it changes, so repeated runs
+    take well under a second for hundreds of thousands of rows.
+    
+    Examples:
+        ./query.py stats                                  # Tables for output.csv
+        ./query.py stats --by decision -p 50,90 --weeks 26
+        ./query.py stats --store sqlite:results.db --format json
+    """
+    if debug:
+        logger.setLevel(logging.DEBUG)
+        logger.debug("Debug logging enabled")
+    group_fields = {"division": "renewingDivision", "decision": "finalDecision", "status": "reviewStatus", "none": None}
+    if by not in group_fields:
+        raise typer.BadParameter("--by must be division, decision, status or none")
+    if output_format not in ("table", "json"):
+        raise typer.BadParameter("--format must be table or json")
+    try:
+        levels = [float(p) for p in percentiles.split(",") if p.strip()]
+    except ValueError:
+        raise typer.BadParameter("--percentiles must be numbers, e.g. 50,90")
+    if not store and not input_path.exists():
+        logger.error(f"Input file {input_path} does not exist")
+        raise typer.Exit(1)
+    require_numpy()
+    import numpy as np
+    
+    started = time.perf_counter()
+    columns = load_stats_columns(input_path, store, use_cache)
+    logger.debug(f"Loaded columns in {time.perf_counter() - started:.3f}s")
+    
+    registered, completed = columns["registered"], columns["completed"]
+    turnaround = (completed - registered).astype(float)
+    turnaround[np.isnat(completed) | np.isnat(registered)] = np.nan
+    field = group_fields[by]
+    if field:
+        codes, labels = columns[field], columns[f"{field}_labels"]
+    else:
+        codes, labels = np.zeros(len(turnaround), dtype=np.int32), np.array(["all"])
+    latency = (columns["closed"] - columns["referred"]).astype(float)
+    latency[np.isnat(columns["closed"]) | np.isnat(columns["referred"])] = np.nan
+    
+    report = {
+        "items": int(len(turnaround)),
+        "turnaround_days": grouped_percentiles(codes, labels, turnaround, levels),
+        "referral_latency_days": grouped_percentiles(columns["agency"], columns["agency_labels"], latency, levels),
+        "weekly": weekly_throughput(registered, completed, weeks),
+    }
+    logger.debug(f"Computed stats in {time.perf_counter() - started:.3f}s")
+    
+    if output_format == "json":
+        typer.echo(json.dumps(report, indent=2))
+        return
+    typer.echo(f"Turnaround in days from registration to completion, by {by} ({report['items']} items)")
+    typer.echo(format_table(report["turnaround_days"]))
+    typer.echo("\nReferral latency in days from referral to closure, by agency")
+    typer.echo(format_table(report["referral_latency_days"]))
+    typer.echo(f"\nThroughput per week (last {weeks} weeks)")
+    typer.echo(format_table(report["weekly"]))
+
 if __name__ == "__main__":
     app()